@@ -0,0 +1,231 @@
+"""Binary storage of experimental AP sets and simulated/scored AP traces.
+
+Experimental AP set (one .npz per cell, see convert_ap_set):
+  keys     names of the APs (file name between prefix and suffix)
+  columns  column names of the text files
+  <key>    (rows, columns) float64 array of each AP
+
+Trace store (one indexed .aps file per run, see APTraceStore):
+  8 byte magic | records ... | JSON index | 8 byte index length | 8 byte magic
+  record: 4 byte magic | 4 byte header length | JSON header | raw data
+The data are raw row-major arrays. The index lists the headers (model_id,
+key, kind 'scored' or 'simulated', columns, rows, dtype) with the offset
+of the data, so a reader can memory-map any trace without parsing the
+others. Without an index (a crashed run) the records are scanned instead.
+"""
+import os
+import sys
+import json
+import struct
+import numpy as np
+import pandas as pd
+
+
+STORE_MAGIC = b'DCAPTRC1'
+INDEX_MAGIC = b'DCAPIDX1'
+RECORD_MAGIC = b'REC1'
+
+
+def convert_ap_set(path, file_prefix, file_suffix, out_filename):
+    """One-time converter of a directory of *_SAP.txt files (the layout
+    read by ExperimentalAPSet) to a single .npz file."""
+    arrays = {}
+    columns = None
+    for i in sorted(os.listdir(path)):
+        if (i.find(file_prefix) >= 0 and i.find(file_suffix) >= 0):
+            key = i[len(file_prefix):i.find(file_suffix)]
+            ap = pd.read_csv(path+'/'+i, delimiter=' ')
+            if columns is None:
+                columns = list(ap.columns)
+            arrays[key] = np.ascontiguousarray(ap.to_numpy(dtype=np.float64))
+    if (len(arrays) == 0):
+        print('Could not locate file(s). Check file(s) and/or directory.')
+        return
+    np.savez(out_filename, keys=np.array(list(arrays.keys())),
+             columns=np.array(columns), **arrays)
+
+
+def load_ap_set(filename):
+    """Returns the AP_set dict of DataFrames stored by convert_ap_set."""
+    AP_set = {}
+    with np.load(filename) as data:
+        columns = [str(c) for c in data['columns']]
+        for key in data['keys']:
+            AP_set[str(key)] = pd.DataFrame(data[str(key)], columns=columns)
+    return AP_set
+
+
+class APTraceStore:
+    """ Single indexed file of AP traces written by one run.
+    Records are appended with write() and the index is written by flush()
+    and close(). Opening an existing store in mode 'a' appends to its
+    records, if a crashed run left no index the complete records are found
+    by scanning the file. Mode 'r' memory-maps the file for reading.
+    Attributes:
+      filename: path of the .aps file.
+      index: list of record dicts (model_id, key, kind, columns, offset,
+             rows, dtype).
+    """
+
+    def __init__(self, filename, mode='a', dtype=np.float64):
+        self.filename = filename
+        self.mode = mode
+        self.dtype = np.dtype(dtype)
+        self.index = []
+        self.data_end = len(STORE_MAGIC)
+        self.indexed = False
+        if (os.path.exists(filename) and os.path.getsize(filename) > 0):
+            self._read_index()
+        elif (mode == 'r'):
+            raise FileNotFoundError(filename)
+        if (mode == 'r'):
+            self.f = None
+            self.mmap = np.memmap(filename, dtype=np.uint8, mode='r')
+        else:
+            if os.path.exists(filename):
+                self.f = open(filename, 'r+b')
+            else:
+                self.f = open(filename, 'w+b')
+                self.f.write(STORE_MAGIC)
+            # Drop the old index (and anything not indexed), it is rewritten.
+            self.f.truncate(self.data_end)
+            self.f.seek(self.data_end)
+
+    def _read_index(self):
+        with open(self.filename, 'rb') as f:
+            if (f.read(len(STORE_MAGIC)) != STORE_MAGIC):
+                raise ValueError(self.filename+' is not an AP trace store.')
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            magic = None
+            if (size >= len(STORE_MAGIC) + 16):
+                f.seek(-16, os.SEEK_END)
+                length, magic = struct.unpack('<Q8s', f.read(16))
+            if (magic == INDEX_MAGIC and length <= size - 16):
+                f.seek(-16-length, os.SEEK_END)
+                self.index = json.loads(f.read(length).decode())
+                if self.index:
+                    self.data_end = record_end(self.index[-1])
+            else:
+                print('No index in '+self.filename+', scanning records.')
+                self._scan(f, size)
+
+    def _scan(self, f, size):
+        offset = len(STORE_MAGIC)
+        while (offset + 8 <= size):
+            f.seek(offset)
+            magic, length = struct.unpack('<4sI', f.read(8))
+            if (magic != RECORD_MAGIC or offset + 8 + length > size):
+                break
+            try:
+                record = json.loads(f.read(length).decode())
+            except ValueError:
+                break
+            record['offset'] = offset + 8 + length
+            if (record_end(record) > size):
+                break
+            self.index.append(record)
+            offset = record_end(record)
+        self.data_end = offset
+
+    def write(self, model_id, key, data, columns, kind='scored'):
+        """Append a (rows, columns) array or a dict/DataFrame of columns."""
+        if isinstance(data, (dict, pd.DataFrame)):
+            data = np.column_stack([np.asarray(data[c]) for c in columns])
+        data = np.ascontiguousarray(data, dtype=self.dtype)
+        record = {'model_id': int(model_id), 'key': key, 'kind': kind,
+                  'columns': list(columns), 'rows': int(data.shape[0]),
+                  'dtype': self.dtype.str}
+        header = json.dumps(record).encode()
+        if self.indexed:
+            # Records are appended over the old index.
+            self.f.truncate(self.data_end)
+            self.indexed = False
+        self.f.seek(self.data_end)
+        self.f.write(struct.pack('<4sI', RECORD_MAGIC, len(header)))
+        self.f.write(header)
+        self.f.write(data.tobytes())
+        record['offset'] = self.data_end + 8 + len(header)
+        self.index.append(record)
+        self.data_end = record['offset'] + data.nbytes
+
+    def flush(self):
+        """Write the index after the records."""
+        index = json.dumps(self.index).encode()
+        self.f.seek(self.data_end)
+        self.f.write(index)
+        self.f.write(struct.pack('<Q8s', len(index), INDEX_MAGIC))
+        self.f.truncate()
+        self.f.flush()
+        self.f.seek(self.data_end)
+        self.indexed = True
+
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+            self.f = None
+
+    def model_ids(self):
+        return sorted(set(i['model_id'] for i in self.index))
+
+    def records(self, model_id=None, key=None, kind=None):
+        return [i for i in self.index
+                if (model_id is None or i['model_id'] == model_id)
+                and (key is None or i['key'] == key)
+                and (kind is None or i['kind'] == kind)]
+
+    def read(self, record):
+        """Returns the record as a DataFrame (a view of the memory map in
+        mode 'r')."""
+        dtype = np.dtype(record['dtype'])
+        ncols = len(record['columns'])
+        nbytes = record['rows'] * ncols * dtype.itemsize
+        if self.f is None:
+            buf = self.mmap[record['offset']:record['offset']+nbytes]
+            data = buf.view(dtype).reshape(record['rows'], ncols)
+        else:
+            self.f.flush()
+            data = np.fromfile(self.filename, dtype=dtype, count=record['rows']*ncols,
+                               offset=record['offset']).reshape(record['rows'], ncols)
+            self.f.seek(self.data_end)
+        return pd.DataFrame(data, columns=record['columns'])
+
+
+class TraceCollector:
+    """ In-memory stand-in for an APTraceStore in a worker process.
+    write() keeps every step-th row of each trace as dtype, so the traces
+    sent back to the driver are small, replay() writes them to a store.
+    """
+
+    def __init__(self, step=1, dtype=np.float64):
+        self.step = step
+        self.dtype = np.dtype(dtype)
+        self.traces = []
+
+    def write(self, model_id, key, data, columns, kind='scored'):
+        if isinstance(data, (dict, pd.DataFrame)):
+            data = np.column_stack([np.asarray(data[c]) for c in columns])
+        data = np.ascontiguousarray(np.asarray(data)[::self.step], dtype=self.dtype)
+        self.traces.append((model_id, key, data, list(columns), kind))
+
+    def replay(self, store, skip_stored=False):
+        """Write the traces to store. With skip_stored the traces the store
+        already has a record of (same model_id, key and kind) are left out."""
+        for model_id, key, data, columns, kind in self.traces:
+            if (skip_stored and store.records(model_id, key, kind)):
+                continue
+            store.write(model_id, key, data, columns, kind=kind)
+
+
+def record_end(record):
+    """Offset of the end of the data of a record."""
+    return record['offset'] + record['rows'] * len(record['columns']) * \
+        np.dtype(record['dtype']).itemsize
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) == 6 and sys.argv[1] == 'convert'):
+        convert_ap_set(*sys.argv[2:])
+    else:
+        print('ap_store.py convert path file_prefix file_suffix out_file.npz')
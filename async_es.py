@@ -0,0 +1,133 @@
+import math
+import queue
+import random
+
+from deap import tools
+
+
+def breed(parents, toolbox, cxpb, mutpb):
+    """Create one offspring from the parent pool with the variation of
+    algorithms.varOr. Reproduction (a plain clone) is left out because the
+    clone would not need an evaluation, so the crossover and mutation
+    probabilities are renormalized to cxpb/(cxpb+mutpb) and mutpb/(cxpb+mutpb)."""
+    if (random.random() < cxpb / (cxpb + mutpb) and len(parents) > 1):
+        ind1, ind2 = [toolbox.clone(i) for i in random.sample(parents, 2)]
+        ind1, ind2 = toolbox.mate(ind1, ind2)
+        del ind1.fitness.values
+        return ind1
+    ind = toolbox.clone(random.choice(parents))
+    ind, = toolbox.mutate(ind)
+    del ind.fitness.values
+    return ind
+
+
+def eaAsyncSteadyState(population, toolbox, executor, mu, cxpb, mutpb, n_evals,
+                       in_flight, stats=None, halloffame=None, log_every=100,
+                       max_age=None, start_frac=1.0, with_status=False,
+                       verbose=__debug__):
+    """Asynchronous steady-state evolution strategy.
+    There is no generation barrier: in_flight evaluations are kept running on
+    the executor and a new offspring is bred from the parent pool as soon
+    as any evaluation returns. The evaluated offspring joins the mu-sized
+    parent pool, which then drops its worst individual. With max_age (in
+    completed evaluations) the oldest individual above that age is dropped
+    instead, which forgets stale parents like the comma selection does.
+    The initial population is evaluated first, also with at most in_flight
+    evaluations running. Breeding starts once start_frac of the mu initial
+    individuals are evaluated (by default all of them), since a pool of the
+    first returns would favour the individuals that evaluate fast. The run
+    stops after n_evals evaluations (use mu + ngen*lambda for the budget of
+    eaMuCommaLambda). The logbook is recorded every log_every completed
+    evaluations, with the total 'evals' and the 'nevals' since the last
+    record in place of the generation. With with_status toolbox.evaluate
+    returns (fitness values, status, simulated seconds) and the logbook has
+    the number of 'timeout' statuses and the simulated seconds ('simulated_s')
+    since the last record.
+    Returns the final parent pool and the logbook."""
+    logbook = tools.Logbook()
+    logbook.header = (['evals', 'nevals', 'timeouts'] + (['simulated_s'] if with_status else [])
+                      + (stats.fields if stats else []))
+
+    results = queue.Queue()
+    pending = {}
+    births = {}
+    parents = []
+    n_submitted = 0
+    n_done = 0
+    n_logged = 0
+    n_timeouts = 0
+    simulated_s = 0.0
+
+    def submit(ind):
+        ticket = id(ind)
+        pending[ticket] = ind
+        executor.submit(toolbox.evaluate, (ind,),
+                        callback=lambda fit, t=ticket: results.put((t, fit, None)),
+                        error_callback=lambda exc, t=ticket: results.put((t, None, exc)))
+
+    def record():
+        nonlocal n_timeouts, simulated_s
+        record = stats.compile(parents) if stats is not None else {}
+        counts = {'simulated_s': simulated_s} if with_status else {}
+        logbook.record(evals=n_done, nevals=n_done-n_logged, timeouts=n_timeouts, **counts,
+                       **record)
+        n_timeouts = 0
+        simulated_s = 0.0
+        if verbose:
+            print(logbook.stream)
+
+    initial = list(population)
+    n_start = max(1, math.ceil(start_frac * min(mu, len(initial))))
+
+    def top_up():
+        """Keep in_flight evaluations running, the initial population first."""
+        nonlocal n_submitted
+        while (len(pending) < in_flight and n_submitted < n_evals):
+            if initial:
+                submit(initial.pop(0))
+            elif (len(parents) >= n_start):
+                submit(breed(parents, toolbox, cxpb, mutpb))
+            else:
+                break
+            n_submitted += 1
+
+    top_up()
+
+    while pending:
+        ticket, fit, exc = results.get()
+        if exc is not None:
+            raise exc
+        ind = pending.pop(ticket)
+        if with_status:
+            fit, status, seconds = fit
+            simulated_s += seconds
+            if (status == 'timeout'):
+                n_timeouts += 1
+        ind.fitness.values = fit
+        births[id(ind)] = n_done
+        n_done += 1
+        if halloffame is not None:
+            halloffame.update([ind])
+
+        parents.append(ind)
+        if (len(parents) > mu):
+            old = []
+            if max_age is not None:
+                old = [i for i in parents if (n_done - births[id(i)]) > max_age]
+            if old:
+                drop = min(old, key=lambda i: births[id(i)])
+            else:
+                drop = min(parents, key=lambda i: i.fitness)
+            parents.remove(drop)
+            del births[id(drop)]
+
+        if (n_done - n_logged >= log_every):
+            record()
+            n_logged = n_done
+
+        top_up()
+
+    if (n_done > n_logged):
+        record()
+    population[:] = parents
+    return population, logbook
@@ -0,0 +1,241 @@
+import os
+import sys
+import random
+import argparse
+import threading
+import traceback
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+from deap import tools
+
+from cell_recording import ExperimentalAPSet
+from eval_cache import EvaluationCache
+from checkpoint import eaMuCommaLambdaCheckpoint
+from executors import add_executor_args
+from executors import make_executor
+from run_dclamp_simulation import add_pacing_args
+from run_dclamp_simulation import make_pacing
+import iPSC_DEAP_fit
+
+
+class FairShareScheduler:
+    """ Shares one executor between several ES runs.
+    Each run maps its evaluations through its own client (client(name)),
+    the tasks are queued per run and dispatched to the executor so that at
+    most slots tasks are in flight. The next task always comes from the run
+    with the fewest in-flight tasks relative to its weight, so a run with a
+    big generation cannot starve the others and the workers stay busy
+    while a run is breeding its next generation.
+    """
+
+    def __init__(self, executor, slots):
+        self.executor = executor
+        self.slots = slots
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.weights = {}
+        self.in_flight = {}
+        self.total_in_flight = 0
+
+    def client(self, name, weight=1.0):
+        with self.lock:
+            self.queues[name] = []
+            self.weights[name] = weight
+            self.in_flight[name] = 0
+        return FairShareMap(self, name)
+
+    def submit(self, name, func, args, callback, error_callback):
+        with self.lock:
+            self.queues[name].append((func, args, callback, error_callback))
+        self._dispatch()
+
+    def _done(self, name):
+        with self.lock:
+            self.in_flight[name] -= 1
+            self.total_in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        # Pick the tasks under the lock, submit them outside of it.
+        todo = []
+        with self.lock:
+            while (self.total_in_flight < self.slots):
+                waiting = [n for n in self.queues if self.queues[n]]
+                if (len(waiting) == 0):
+                    break
+                name = min(waiting, key=lambda n: self.in_flight[n] / self.weights[n])
+                todo.append((name, self.queues[name].pop(0)))
+                self.in_flight[name] += 1
+                self.total_in_flight += 1
+        for name, (func, args, callback, error_callback) in todo:
+            def on_result(result, name=name, callback=callback):
+                callback(result)
+                self._done(name)
+
+            def on_error(exc, name=name, error_callback=error_callback):
+                error_callback(exc)
+                self._done(name)
+            self.executor.submit(func, args, on_result, on_error)
+
+
+class FairShareMap:
+    """toolbox.map of one run of a FairShareScheduler."""
+
+    def __init__(self, scheduler, name):
+        self.scheduler = scheduler
+        self.name = name
+
+    def __call__(self, func, iterable):
+        items = list(iterable)
+        results = [None] * len(items)
+        errors = []
+        remaining = [len(items)]
+        lock = threading.Lock()
+        done = threading.Event()
+        if (len(items) == 0):
+            return results
+
+        def finish():
+            with lock:
+                remaining[0] -= 1
+                if (remaining[0] == 0):
+                    done.set()
+
+        for i, item in enumerate(items):
+            def on_result(result, i=i):
+                results[i] = result
+                finish()
+
+            def on_error(exc):
+                errors.append(exc)
+                finish()
+            self.scheduler.submit(self.name, func, (item,), on_result, on_error)
+        done.wait()
+        if errors:
+            raise errors[0]
+        return results
+
+
+def read_manifest(filename):
+    """Space-delimited manifest with one cell per row and the columns
+    name path file_prefix file_suffix dc_ik1, optionally cell_id and weight."""
+    manifest = pd.read_csv(filename, delimiter=' ')
+    for column in ['name', 'path', 'file_prefix', 'file_suffix', 'dc_ik1']:
+        if column not in manifest.columns:
+            raise ValueError('Manifest is missing the column '+column)
+    return manifest
+
+
+def run_cell(cell, scheduler, args, dt, cache=None):
+    """Run the (mu,lambda) ES of one manifest row. The outputs go to
+    outdir/<name>/."""
+    name = str(cell['name'])
+    cell_id = cell['cell_id'] if 'cell_id' in cell else 0
+    weight = cell['weight'] if 'weight' in cell else 1.0
+    ExperAPSet = ExperimentalAPSet(path=cell['path'], file_prefix=cell['file_prefix'],
+                                   file_suffix=cell['file_suffix'], cell_id=cell_id,
+                                   dc_ik1=float(cell['dc_ik1']))
+    # Each worker loads the AP set of the cell on its first task.
+    ExperAPSet.by_reference = not args.ship_ap_set
+    toolbox = iPSC_DEAP_fit.build_toolbox(ExperAPSet, cache=cache, timeout=args.timeout,
+                                          condition_timeout=args.condition_timeout,
+                                          pacing=make_pacing(args))
+    toolbox.register("map", scheduler.client(name, weight))
+
+    N_HOF = int((0.1) * args.mu * args.ngen)
+    hof = tools.HallOfFame(N_HOF)
+    pop = toolbox.population(n=args.mu)
+    prefix = os.path.join(args.outdir, name) + '/'
+    os.makedirs(prefix, exist_ok=True)
+    pd.DataFrame(pop, columns=iPSC_DEAP_fit.PARAM_NAMES).to_csv(
+        prefix+'pop_first_'+dt+'.txt', sep=' ', index=False)
+
+    pop, logbook = eaMuCommaLambdaCheckpoint(pop, toolbox, mu=args.mu, lambda_=args.lambda_,
+                                             cxpb=0.6, mutpb=0.3, ngen=args.ngen,
+                                             stats=iPSC_DEAP_fit.build_stats(),
+                                             halloffame=hof, verbose=False)
+    iPSC_DEAP_fit.write_outputs(prefix, dt, pop, hof, logbook)
+    print(name+' done: best fitness '+str(hof[0].fitness.values[0]))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Fit a cohort of cells listed in a '
+                                     'manifest, one (mu,lambda) ES per cell sharing '
+                                     'one worker pool.')
+    parser.add_argument('manifest', help='space-delimited file: name path file_prefix '
+                        'file_suffix dc_ik1 [cell_id] [weight]')
+    parser.add_argument('--outdir', default='.', help='per-cell outputs go to outdir/<name>/')
+    parser.add_argument('--mu', type=int, default=100)
+    parser.add_argument('--lambda', dest='lambda_', type=int, default=150)
+    parser.add_argument('--ngen', type=int, default=10)
+    parser.add_argument('--slots', type=int, default=None,
+                        help='tasks in flight on the shared pool (default: the local '
+                        'workers, required with --executor broker)')
+    parser.add_argument('--cache', default=None,
+                        help='SQLite evaluation cache shared by all runs')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='wall-clock budget (s) of one evaluation')
+    parser.add_argument('--condition-timeout', type=float, default=None,
+                        help='wall-clock budget (s) of each dynamic-clamp condition')
+    parser.add_argument('--ship-ap-set', action='store_true',
+                        help='send the experimental AP sets with every task instead of '
+                        'loading them once per worker from their paths')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed of the Python and NumPy RNGs (the runs share them, '
+                        'so a batch is not bit-reproducible)')
+    add_pacing_args(parser)
+    add_executor_args(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    if (args.executor == 'broker' and args.slots is None):
+        # The broker workers connect from other hosts at any time.
+        print('--executor broker needs --slots, e.g. the number of broker workers.')
+        return
+    manifest = read_manifest(args.manifest)
+
+    now = datetime.now()
+    dt = now.strftime("%m%d%y_%H%M%S")
+    print('Batch start time: '+dt)
+    print('Cells: '+str(list(manifest['name'])))
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+
+    iPSC_DEAP_fit.create_deap_classes()
+    cache = None
+    if args.cache is not None:
+        cache = EvaluationCache(args.cache)
+
+    p = make_executor(args, setup='iPSC_DEAP_fit:create_deap_classes')
+    slots = args.slots
+    if slots is None:
+        slots = args.workers if args.workers is not None else os.cpu_count()
+    scheduler = FairShareScheduler(p, slots)
+
+    # The ES loops only breed and select, so one driver thread per cell.
+    def target(cell):
+        try:
+            run_cell(cell, scheduler, args, dt, cache)
+        except Exception:
+            print('Cell '+str(cell['name'])+' failed:')
+            traceback.print_exc()
+    threads = []
+    for i in range(manifest.shape[0]):
+        t = threading.Thread(target=target, args=(manifest.iloc[i],))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    p.close()
+    now = datetime.now()
+    print('Batch end time: '+now.strftime("%m%d%y_%H%M%S"))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,255 @@
+"""Population-batched simulation of the dynamic-clamp conditions.
+
+The models of a population share the PacedProtocol and differ only in their
+parameters, so their states are stacked into one (23, n) matrix and
+integrated together: one solve_ivp (BDF) of the 23*n system whose
+right-hand side is kernik_jit.kernik_rhs evaluated with NumPy on the whole
+population. The Jacobian is block diagonal, it is estimated by forward
+differences with 23 vectorized evaluations whatever n and handed to the
+solver as a sparse matrix. The error norm of solve_ivp is
+an RMS over all components, the tolerances are divided by sqrt(n) so the
+error of one model is not diluted by the others.
+
+The conditions are paced beat by beat in the order of CONDITIONS. After
+every beat the models whose state is not finite (the OverflowError of the
+single model) fail, and with AdaptivePacing the models at the limit cycle
+stop pre-pacing; both are masked out of the following beats. The last AP
+is taken from a final run of record beats, as AdaptivePacing does;
+FixedPacing(duration) is duration/1000 - 5 pre-pacing beats and 5 record
+beats (get_last_ap then takes the same beat as from the whole trace).
+If the shared solve fails the models of the beat are solved one by one.
+
+The results are the list of run_ind_dclamp results, so they can be scored
+with ExperimentalAPSet.score/score_many. There is no TimeBudget, and the
+memory of the record run grows with the batch size. The backend of the
+pacing is not used: the right-hand side is always the NumPy one, so the
+batch is only faster than the python backend, not the compiled model.
+"""
+import numpy as np
+from scipy import integrate
+from scipy import sparse
+from cell_models import protocols
+
+from kernik_jit import kernik_rhs
+from kernik_jit import model_parameters
+from kernik_jit import JitTrace
+from kernik_jit import N_STATES
+from kernik_jit import FD_STEP
+from kernik_jit import NAI
+from kernik_jit import KI
+from kernik_jit import STIM_END
+from run_dclamp_simulation import CONDITIONS
+from run_dclamp_simulation import CONDITION_KEYS
+from run_dclamp_simulation import AdaptivePacing
+from run_dclamp_simulation import FixedPacing
+from run_dclamp_simulation import init_model
+from run_dclamp_simulation import ap_failed
+import telemetry
+
+
+RTOL = 1e-3
+ATOL = 1e-6
+MAX_STEP = 0.8
+# Record beats of FixedPacing.
+RECORD_BEATS = 5
+
+
+def pacing_schedule(pacing):
+    """(pre-pacing beats, record beats, bcl, rtol, atol) of a pacing, rtol
+    is None without a limit-cycle check."""
+    if isinstance(pacing, AdaptivePacing):
+        return (pacing.max_beats - pacing.record_beats, pacing.record_beats, pacing.bcl,
+                pacing.rtol, pacing.atol)
+    beats = int(pacing.duration // 1000)
+    record = min(RECORD_BEATS, beats)
+    return beats - record, record, 1000, None, None
+
+
+def solve(p, y0, t_end):
+    """Integrate the states y0 (23, n) of the models p (N_PARAMS, n) from 0
+    to t_end ms. Returns the solve_ivp solution, or None if it failed."""
+    n = y0.shape[1]
+    p = p.copy()
+    p[STIM_END] = t_end
+    # Nai and Ki are held at the given concentrations (see KernikModel).
+    pinned = np.zeros((N_STATES, n), dtype=bool)
+    pinned[3] = ~np.isnan(p[NAI])
+    pinned[4] = ~np.isnan(p[KI])
+    y0 = y0.copy()
+    np.copyto(y0[3], p[NAI], where=pinned[3])
+    np.copyto(y0[4], p[KI], where=pinned[4])
+    dy = np.empty((N_STATES, n))
+
+    def rhs(t, y):
+        kernik_rhs(t, y.reshape(N_STATES, n), p, dy)
+        dy[pinned] = 0.0
+        return dy.ravel().copy()
+
+    # CSC layout of the blocks: column j*n+k holds d f_i / d y_j of model k
+    # in the rows i*n+k.
+    indices = (np.arange(N_STATES)[None, None, :] * n + np.arange(n)[None, :, None]) * \
+        np.ones((N_STATES, 1, 1), dtype=np.int64)
+    indices = indices.ravel()
+    indptr = np.arange(0, N_STATES * N_STATES * n + 1, N_STATES)
+    blocks = np.empty((N_STATES, n, N_STATES))
+
+    def jac(t, y):
+        y = y.reshape(N_STATES, n)
+        f0 = rhs(t, y).reshape(N_STATES, n)
+        yh = y.copy()
+        for j in range(N_STATES):
+            h = FD_STEP * np.maximum(np.abs(y[j]), 1e-3)
+            yh[j] = y[j] + h
+            blocks[j] = ((rhs(t, yh).reshape(N_STATES, n) - f0) / h).T
+            yh[j] = y[j]
+        return sparse.csc_matrix((blocks.ravel(), indices, indptr),
+                                 shape=(N_STATES * n, N_STATES * n))
+
+    with np.errstate(all='ignore'):
+        solution = integrate.solve_ivp(rhs, [0, t_end], y0.ravel(), method='BDF',
+                                       jac=jac, max_step=MAX_STEP,
+                                       rtol=RTOL / np.sqrt(n), atol=ATOL / np.sqrt(n))
+    if (solution.status < 0):
+        return None
+    return solution
+
+
+def run_beats(p, y0, t_end, record=False):
+    """Pace the models together for t_end ms.
+    Returns (y_end, ok, traces): the final states, the mask of the models
+    with a finite solution and, if record, the (t, y) trace of each model."""
+    n = y0.shape[1]
+    solution = solve(p, y0, t_end)
+    if solution is None:
+        if (n == 1):
+            return y0.copy(), np.zeros(1, dtype=bool), [None]
+        # One model can stall the shared step size.
+        parts = [run_beats(p[:, i:i+1], y0[:, i:i+1], t_end, record) for i in range(n)]
+        y_end = np.column_stack([y for y, ok, traces in parts])
+        ok = np.concatenate([ok for y, ok, traces in parts])
+        traces = [traces[0] for y, ok, traces in parts] if record else None
+        return y_end, ok, traces
+    y = solution.y.reshape(N_STATES, n, -1)
+    ok = np.all(np.isfinite(y), axis=(0, 2))
+    traces = [(solution.t, y[:, i]) for i in range(n)] if record else None
+    return y[:, :, -1], ok, traces
+
+
+def last_ap(t, y, p):
+    """Last AP (t, V, I DataFrame) of a recorded trace of one model."""
+    dy = np.empty(y.shape)
+    with np.errstate(all='ignore'):
+        current = kernik_rhs(t, y, p, dy)
+    tr = JitTrace(t, y[0], current)
+    tr.get_last_ap()
+    return tr.last_ap
+
+
+def run_condition_batch(p, y0, pacing):
+    """Pace the models (columns of p and y0) under one condition.
+    Returns (aps, y_end, ok): the last AP of each model (None if it
+    failed), the final states and the mask of the models that did not fail."""
+    pre_beats, record_beats, bcl, rtol, atol = pacing_schedule(pacing)
+    n = y0.shape[1]
+    y = y0.copy()
+    ok = np.ones(n, dtype=bool)
+    pre_pacing = np.ones(n, dtype=bool)
+    for beat in range(pre_beats):
+        idx = np.flatnonzero(ok & pre_pacing)
+        if (len(idx) == 0):
+            break
+        y_new, ok[idx], traces = run_beats(p[:, idx], y[:, idx], bcl)
+        telemetry.count('simulated_ms', bcl * len(idx))
+        telemetry.count('beats', len(idx))
+        if rtol is not None:
+            with np.errstate(invalid='ignore'):
+                converged = np.all(np.abs(y_new - y[:, idx]) <= rtol * np.abs(y_new) + atol,
+                                   axis=0)
+            pre_pacing[idx[converged]] = False
+        y[:, idx] = y_new
+
+    aps = [None] * n
+    idx = np.flatnonzero(ok)
+    if len(idx):
+        y[:, idx], ok[idx], traces = run_beats(p[:, idx], y[:, idx], record_beats * bcl,
+                                               record=True)
+        telemetry.count('simulated_ms', record_beats * bcl * len(idx))
+        telemetry.count('beats', record_beats * len(idx))
+        for j, i in enumerate(idx):
+            if not ok[i]:
+                continue
+            try:
+                aps[i] = last_ap(traces[j][0], traces[j][1], p[:, i])
+            except (OverflowError, IndexError):
+                ok[i] = False
+    return aps, y, ok
+
+
+def condition_parameters(model, ind, condition, protocol):
+    """Parameter vector of a model of init_model under a Condition (the
+    leak of run_condition)."""
+    kci, ik1_leak = model
+    leak = {'I_K1_Ishi': ik1_leak}
+    if condition.current is not None:
+        leak[condition.current] = ind[0] * condition.scale
+    kci._CellModel__no_ion_selective = leak
+    return model_parameters(kci, protocol)
+
+
+@telemetry.evaluation('run_population_dclamp')
+def run_population_dclamp(inds, dc_ik1=1.0, nai=10.0, ki=130.0, pacing=None, keys=None):
+    """ Batched run_ind_dclamp of a list of individuals: the conditions
+    named in keys (default all, the control is always run) are simulated
+    for all individuals together.
+    Returns the list of run_ind_dclamp results: (ap_set, ap_failure), or
+    None for an individual out of range.
+    """
+    if pacing is None:
+        pacing = FixedPacing()
+    if keys is None:
+        keys = CONDITION_KEYS
+    protocol = protocols.PacedProtocol(model_name="Kernik", stim_end=1000, stim_mag=2)
+    models = [init_model(ind, dc_ik1=dc_ik1, nai=nai, ki=ki) for ind in inds]
+    steady_states = pacing.steady_states()
+    results = [None] * len(inds)
+    live = [i for i in range(len(inds)) if models[i] is not None]
+    ap_sets = dict((i, {}) for i in live)
+    y = None
+    for condition in CONDITIONS:
+        if (len(live) == 0):
+            break
+        if (condition.key != 'cntrl' and condition.key not in keys):
+            continue
+        telemetry.set_condition(condition.key)
+        p = np.column_stack([condition_parameters(models[i], inds[i], condition, protocol)
+                             for i in live])
+        if y is None:
+            y0 = np.column_stack([np.asarray(models[i][0].y_initial, dtype=np.float64)
+                                  for i in live])
+            if steady_states is not None:
+                for j, i in enumerate(live):
+                    y_warm = steady_states.get(inds[i], dc_ik1)
+                    if y_warm is not None:
+                        y0[:, j] = y_warm
+        else:
+            # The perturbations start from the control steady state.
+            y0 = np.column_stack([y[i] for i in live])
+        aps, y_end, ok = run_condition_batch(p, y0, pacing)
+        if y is None:
+            y = dict((i, y_end[:, j]) for j, i in enumerate(live))
+        still_live = []
+        for j, i in enumerate(live):
+            if not ok[j]:
+                results[i] = ({}, True)
+            elif ap_failed(aps[j]):
+                ap_sets[i][condition.key] = aps[j]
+                results[i] = (ap_sets[i], True)
+            else:
+                ap_sets[i][condition.key] = aps[j]
+                still_live.append(i)
+                if (condition.key == 'cntrl' and steady_states is not None):
+                    steady_states.put(inds[i], dc_ik1, y[i])
+        live = still_live
+    for i in live:
+        results[i] = (ap_sets[i], False)
+    return results
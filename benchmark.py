@@ -0,0 +1,313 @@
+"""Reproducible benchmarks of the scoring, the ES operators, single
+evaluations and short (mu,lambda) runs.
+
+  python benchmark.py run [--quick] [--only micro|macro] [--workers 1 2 4]
+                          [--out results.json] [--baseline old.json]
+  python benchmark.py compare old.json new.json [--threshold 0.1]
+
+The experimental AP set is synthetic (analytic AP waveforms written in the
+ExperimentalAPSet layout), so no lab data is needed. The reference
+individuals are drawn with a fixed seed and include known AP Failure
+cases; run exits with status 1 if one of them is not scored as a failure.
+The results are a JSON file with the timings (median, min, mean of
+the repeats, in seconds) of every benchmark and the machine they ran on.
+compare reports the benchmarks whose median is more than threshold slower
+than the baseline and exits with status 1 if there is any.
+The micro benchmarks do not simulate, the macro benchmarks run the Kernik
+model. Both import iPSC_DEAP_fit, so cell_models must be installed.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+
+from deap import algorithms
+from deap import creator
+from deap import tools
+
+import iPSC_DEAP_fit
+from cell_recording import ExperimentalAPSet
+from checkpoint import eaMuCommaLambdaCheckpoint
+from executors import LocalPoolExecutor
+from run_dclamp_simulation import CONDITION_KEYS
+
+
+SEED = 2021
+AP_KEYS = CONDITION_KEYS
+
+# Named individuals that are scored as AP Failures, the rest are drawn with
+# SEED. The default Kernik parameters are 1.0. Without G_K1 (and no
+# dynamic-clamp leak) the cell fires on its own faster than the 1 Hz
+# pacing, so its last AP is shorter than MIN_AP_DURATION.
+FAILURE_CASES = {'phi_out_of_range': [1.2] + [1.0] * 13,
+                 'negative_conductance': [0.5, 1.0, -0.1] + [1.0] * 11,
+                 'spontaneous': [0.0, 0.01] + [1.0] * 12}
+BASELINE_IND = [0.5] + [1.0] * 13
+
+
+def synthetic_ap(apd, v_rest=-75.0, v_peak=35.0, v_plateau=10.0, t_start=-100.0,
+                 t_end=900.0, dt=0.2):
+    """Analytic AP waveform with the upstroke (dV/dt max) at t = 0 and a
+    90% repolarization near apd ms. Returns a (t, V) DataFrame."""
+    t = np.round(np.arange(t_start, t_end, dt), 1)
+    upstroke = 1.0 / (1.0 + np.exp(-t / 0.5))
+    spike = (v_peak - v_plateau) * np.exp(-np.maximum(t, 0.0) / 5.0)
+    repol = 1.0 / (1.0 + np.exp((t - 0.8 * apd) / (0.08 * apd)))
+    V = v_rest + upstroke * ((v_plateau - v_rest) * repol + spike * repol)
+    return pd.DataFrame({'t': t, 'V': V})
+
+
+def synthetic_ap_set(path, prefix='synth_', suffix='_SAP.txt', seed=SEED):
+    """Write a synthetic AP set (one file per dynamic-clamp condition) to
+    path and return it as an ExperimentalAPSet."""
+    rng = np.random.RandomState(seed)
+    os.makedirs(path, exist_ok=True)
+    for key in AP_KEYS:
+        ap = synthetic_ap(apd=rng.uniform(250.0, 450.0))
+        ap.to_csv(os.path.join(path, prefix+key+suffix), sep=' ', index=False)
+    return ExperimentalAPSet(path=path, file_prefix=prefix, file_suffix=suffix,
+                             cell_id=0, dc_ik1=1.0)
+
+
+def synthetic_model_sets(n, seed=SEED):
+    """n model AP sets in the format of run_ind_dclamp (simulated APs with
+    t, V and I columns), for the scoring benchmarks."""
+    rng = np.random.RandomState(seed + 1)
+    sets = []
+    for i in range(n):
+        ap_set = {}
+        for key in AP_KEYS:
+            ap = synthetic_ap(apd=rng.uniform(200.0, 500.0), t_start=-rng.uniform(50.0, 150.0),
+                              t_end=rng.uniform(800.0, 1000.0), dt=rng.choice([0.1, 0.2, 0.5]))
+            ap['I'] = 0.0
+            ap_set[key] = ap
+        sets.append((ap_set, False))
+    return sets
+
+
+def reference_individuals(n, seed=SEED):
+    """Returns a dict name: Individual of the failure cases, the baseline
+    Kernik model and n individuals drawn by generateES with seed."""
+    iPSC_DEAP_fit.create_deap_classes()
+    random.seed(seed)
+    np.random.seed(seed)
+    inds = {}
+    for name, params in FAILURE_CASES.items():
+        inds[name] = make_individual(params)
+    inds['baseline'] = make_individual(BASELINE_IND)
+    for i in range(n):
+        inds['random_%02d' % i] = iPSC_DEAP_fit.generateES(creator.Individual, creator.Strategy,
+                                                            iPSC_DEAP_fit.NUM_PARAMS)
+    return inds
+
+
+def make_individual(params):
+    ind = creator.Individual(params)
+    ind.strategy = creator.Strategy([0.5] * len(params))
+    return ind
+
+
+def timeit(func, repeat, number=1):
+    """Run func number times per repeat, returns the timing dict of the
+    seconds per call."""
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        for j in range(number):
+            func()
+        times.append((time.perf_counter() - t0) / number)
+    return {'median': float(np.median(times)), 'min': float(np.min(times)),
+            'mean': float(np.mean(times)), 'repeat': repeat, 'number': number}
+
+
+def micro_benchmarks(cell, inds, quick=False):
+    results = {}
+    repeat = 5 if quick else 20
+    model_sets = synthetic_model_sets(20 if quick else 100)
+
+    results['score'] = timeit(lambda: cell.score(model_sets[0]), repeat, number=20)
+    results['score_ap'] = timeit(lambda: cell.score_ap('cntrl', model_sets[0][0]['cntrl']),
+                                 repeat, number=100)
+    results['score_many_%d' % len(model_sets)] = timeit(lambda: cell.score_many(model_sets),
+                                                          repeat)
+
+    # The operators work on clones so every call sees the same parents.
+    toolbox = iPSC_DEAP_fit.build_toolbox(cell)
+    parents = [inds[k] for k in inds if k.startswith('random_')]
+    random.seed(SEED)
+    np.random.seed(SEED)
+    results['generateES'] = timeit(toolbox.individual, repeat, number=50)
+    results['mutateES'] = timeit(lambda: toolbox.mutate(toolbox.clone(parents[0])),
+                                 repeat, number=50)
+    results['cxESBlend'] = timeit(lambda: toolbox.mate(toolbox.clone(parents[0]),
+                                                       toolbox.clone(parents[1])),
+                                  repeat, number=50)
+    results['clone'] = timeit(lambda: toolbox.clone(parents[0]), repeat, number=200)
+
+    # Breeding and selection of a large generation, per individual and batched.
+    lambda_ = 1000 if quick else 10000
+    breeders = [toolbox.clone(ind) for ind in parents]
+    for i, ind in enumerate(breeders):
+        ind.fitness.values = (float(i),)
+    array_toolbox = iPSC_DEAP_fit.build_toolbox(cell, array_ops=True)
+    for name, tb in [('', toolbox), ('_array', array_toolbox)]:
+        vary = getattr(tb, 'vary', algorithms.varOr)
+        results['varOr%s_%d' % (name, lambda_)] = timeit(
+            lambda: vary(breeders, tb, lambda_, 0.6, 0.3), 1 if quick else 3)
+        offspring = vary(breeders, tb, lambda_, 0.6, 0.3)
+        for i, ind in enumerate(offspring):
+            ind.fitness.values = (float(i),)
+        results['select%s_%d' % (name, lambda_)] = timeit(
+            lambda: tb.select(offspring, len(offspring) // 10), 1 if quick else 3)
+        results['population%s_%d' % (name, lambda_)] = timeit(
+            lambda: tb.population(n=lambda_), 1 if quick else 3)
+    return results
+
+
+def macro_benchmarks(cell, inds, workers, quick=False):
+    results = {}
+    repeat = 1 if quick else 3
+
+    # One evaluation of each reference individual, with its outcome.
+    for name, ind in inds.items():
+        fit = [None]
+
+        def evaluate():
+            fit[0] = iPSC_DEAP_fit.fitness_status(ind, cell)
+        results['evaluation_'+name] = timeit(evaluate, repeat)
+        results['evaluation_'+name]['fitness'] = float(fit[0][0])
+        results['evaluation_'+name]['status'] = fit[0][1]
+        if name in FAILURE_CASES:
+            results['evaluation_'+name]['expected_status'] = 'failure'
+
+    # Short fixed runs, the pool start up is timed separately.
+    mu, lambda_, ngen = (4, 8, 1) if quick else (8, 16, 2)
+    for n in workers:
+        t0 = time.perf_counter()
+        p = LocalPoolExecutor(n)
+        p.map(abs, range(n))
+        startup = time.perf_counter() - t0
+        toolbox = iPSC_DEAP_fit.build_toolbox(cell)
+        toolbox.register("map", p.map)
+        random.seed(SEED)
+        np.random.seed(SEED)
+        pop = toolbox.population(n=mu)
+        hof = tools.HallOfFame(1)
+        t0 = time.perf_counter()
+        pop, logbook = eaMuCommaLambdaCheckpoint(pop, toolbox, mu=mu, lambda_=lambda_,
+                                                 cxpb=0.6, mutpb=0.3, ngen=ngen,
+                                                 halloffame=hof, verbose=False)
+        wall = time.perf_counter() - t0
+        p.close()
+        nevals = sum(logbook.select('nevals'))
+        results['run_workers_%d' % n] = {'median': wall, 'min': wall, 'mean': wall,
+                                         'repeat': 1, 'number': 1, 'startup': startup,
+                                         'nevals': nevals, 'evals_per_s': nevals / wall,
+                                         'mu': mu, 'lambda': lambda_, 'ngen': ngen,
+                                         'best_fitness': hof[0].fitness.values[0]}
+    return results
+
+
+def machine_info():
+    info = {'python': platform.python_version(), 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'numpy': np.__version__, 'seed': SEED,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    try:
+        info['commit'] = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return info
+
+
+def compare(baseline, current, threshold=0.1):
+    """Print the change of every benchmark in both result dicts. Returns the
+    names of the benchmarks more than threshold slower than the baseline."""
+    regressions = []
+    for name in sorted(current['benchmarks']):
+        if name not in baseline['benchmarks']:
+            continue
+        old = baseline['benchmarks'][name]['median']
+        new = current['benchmarks'][name]['median']
+        change = (new - old) / old if old > 0 else 0.0
+        flag = ''
+        if (change > threshold):
+            flag = ' REGRESSION'
+            regressions.append(name)
+        print('%-36s %12.6f %12.6f %+8.1f%%%s' % (name, old, new, 100.0 * change, flag))
+    return regressions
+
+
+def run(args):
+    inds = reference_individuals(2 if args.quick else 8)
+    benchmarks = {}
+    with tempfile.TemporaryDirectory(prefix='dclamp_bench_') as workdir:
+        cell = synthetic_ap_set(os.path.join(workdir, 'AP_set'))
+        if args.only in (None, 'micro'):
+            benchmarks.update(micro_benchmarks(cell, inds, args.quick))
+        if args.only in (None, 'macro'):
+            workers = args.workers
+            if workers is None:
+                workers = sorted(set(n for n in [1, 2, 4, os.cpu_count()]
+                                     if n <= os.cpu_count()))
+            benchmarks.update(macro_benchmarks(cell, inds, workers, args.quick))
+    results = {'machine': machine_info(), 'quick': args.quick, 'benchmarks': benchmarks}
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+    for name, r in benchmarks.items():
+        print('%-36s %12.6f s' % (name, r['median']))
+    print('Results written to '+args.out)
+    failed = False
+    for name, r in benchmarks.items():
+        if ('expected_status' in r and r['status'] != r['expected_status']):
+            print(name+': status '+r['status']+', expected '+r['expected_status'])
+            failed = True
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.threshold):
+            failed = True
+    return 1 if failed else 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks of the AP fitting.')
+    sub = parser.add_subparsers(dest='command')
+    p_run = sub.add_parser('run')
+    p_run.add_argument('--quick', action='store_true', help='fewer repeats and smaller runs')
+    p_run.add_argument('--only', choices=['micro', 'macro'], default=None)
+    p_run.add_argument('--workers', type=int, nargs='+', default=None,
+                       help='pool sizes of the run benchmark (default 1 2 4 N)')
+    p_run.add_argument('--out', default='benchmark_'+time.strftime('%m%d%y_%H%M%S')+'.json')
+    p_run.add_argument('--baseline', default=None, help='results file to compare against')
+    p_run.add_argument('--threshold', type=float, default=0.1,
+                       help='relative slowdown of the median reported as a regression')
+    p_cmp = sub.add_parser('compare')
+    p_cmp.add_argument('baseline')
+    p_cmp.add_argument('current')
+    p_cmp.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if (args.command == 'run'):
+        return run(args)
+    elif (args.command == 'compare'):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        return 1 if compare(baseline, current, args.threshold) else 0
+    parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
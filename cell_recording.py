@@ -1,7 +1,9 @@
 import os
+import hashlib
 import pandas as pd
-from scipy.interpolate import interp1d
 import numpy as np
+from ap_store import load_ap_set
+import telemetry
 
 
 class ExperimentalAPSet:
@@ -11,7 +13,15 @@ class ExperimentalAPSet:
       AP_set: A dict containing single action potentials from experimental
               dynamic-clamp recording.
       score(model_AP_set): function for evaluating model fitness.
+      MAX_SCORE: score assigned to each AP if there was an AP Failure.
+      by_reference: if True the set is pickled as spec() only and loaded
+                    once per worker process (load_by_reference), the
+                    workers need the files at the same path.
+      digest: SHA-1 of the prepared traces, the same for the text files
+              and their .npz conversion.
     """
+    MAX_SCORE = 1000.0
+    by_reference = False
 
     def __init__(self, path, dc_ik1, file_prefix='cell_', file_suffix='.txt',
                  cell_id=0):
@@ -20,6 +30,12 @@ class ExperimentalAPSet:
         self.file_suffix = file_suffix
         self.cell_id = cell_id # optional identifier for organization
         self.dc_ik1 = dc_ik1 # scaling coefficients on Ishihara IK1
+
+        # Binary AP set written by ap_store.convert_ap_set
+        if (os.path.isfile(path) and path.endswith('.npz')):
+            self.AP_set = load_ap_set(path)
+            self.prepare_traces()
+            return
         filenames = os.listdir(path)
 
         """Data is formatted so that each file contains an single AP waveform.
@@ -38,6 +54,37 @@ class ExperimentalAPSet:
                 print('Could not local file(s). Check file(s) and/or directory.')
                 print('path: '+self.path)
                 print('filename: '+i)
+        self.prepare_traces()
+
+    def prepare_traces(self):
+        """Convert the experimental APs to contiguous arrays (t, V) and
+        precompute the rounded grid bounds (t_first, t_last, t_resolution)
+        used to align the simulated APs in score_ap, and the digest of the
+        traces."""
+        self.traces = {}
+        self.bounds = {}
+        for key, real in self.AP_set.items():
+            t, V = trace_arrays(real)
+            self.traces[key] = (t, V)
+            t_resolution = round(round(t[1], 1) - round(t[0], 1), 1)
+            self.bounds[key] = (round(t[0], 1), round(t[-1], 1), t_resolution)
+        digest = hashlib.sha1()
+        for key in sorted(self.traces):
+            t, V = self.traces[key]
+            digest.update(key.encode())
+            digest.update(t.tobytes())
+            digest.update(V.tobytes())
+        self.digest = digest.hexdigest()
+
+    def spec(self):
+        """Arguments that reload this AP set (see load_by_reference)."""
+        return (os.path.abspath(self.path), self.dc_ik1, self.file_prefix,
+                self.file_suffix, self.cell_id)
+
+    def __reduce_ex__(self, protocol):
+        if self.by_reference:
+            return (load_by_reference, (self.spec(),))
+        return super().__reduce_ex__(protocol)
 
     def get_info(self):
         info_string = 'cell_id: '+str(self.cell_id)+'/n'
@@ -48,61 +95,151 @@ class ExperimentalAPSet:
     def get_AP_set(self):
         return self.AP_set
 
-    def score(self, model_AP_set, model_id=0, write_data=False):
-        # Score assigned if there was an AP Failure
-        MAX_SCORE = 1000.0
-        
+    def score(self, model_AP_set, model_id=0, write_data=False, store=None):
         scores = {}
         ap_keys = list(self.AP_set.keys())
 
         # Check for AP Failure
-        if (model_AP_set[1]):
+        if (model_AP_set is None or model_AP_set[1]):
             for i in ap_keys:
-                scores[i] = MAX_SCORE
+                scores[i] = self.MAX_SCORE
             return scores
         for i in ap_keys:
             try:
-                real = self.AP_set[i]
-                simu = model_AP_set[0][i]
-                # Find time series boundaries
-                t_first_real = round(real.iat[0, 0], 1)
-                nrows_real = real.shape[0]
-                t_last_real = round(real.iat[(nrows_real-1), 0], 1)
-                t_resolution = round(real.iat[1, 0], 1) - round(real.iat[0, 0], 1)
-                t_resolution = round(t_resolution, 1)
-                t_first_simu = round(simu.iat[0, 0], 1)
-                nrows_simu = simu.shape[0]
-                t_last_simu = round(simu.iat[(nrows_simu-1), 0], 1)
-
-                # Align curves within interpolation bounds
-                if (t_first_real >= t_first_simu):
-                    t_first = t_first_real + t_resolution
-                else:
-                    t_first = t_first_simu + t_resolution
-
-                if (t_last_real >= t_last_simu):
-                    t_last = t_last_simu - t_resolution
-                else:
-                    t_last = t_last_real - t_resolution
-                N = int((t_last - t_first)/t_resolution)
-                t_new = np.linspace(t_first, t_last, N)
-
-                f_simu = interp1d(simu.iloc[:, 0], simu.iloc[:, 1])
-                mV_new_simu = f_simu(t_new)
-                f_real = interp1d(real.iloc[:, 0], real.iloc[:, 1])
-                mV_new_real = f_real(t_new)
-
-                # Calculate Root Mean Square Error
-                n = float(len(t_new))
-                rmse = (sum((mV_new_real - mV_new_simu)**2) / n)**0.5
-                scores[i] = rmse
-
-                # Write AP files
-                if write_data:
-                    d = {'t':t_new, 'mV_cell':mV_new_real, 'mV_simu':mV_new_simu}
-                    d = pd.DataFrame(d)
-                    filename = self.file_prefix + i + '_scored_AP_'+str(model_id)+'.txt'
-                    d.to_csv(filename, sep=' ', index=False)
+                scores[i] = self.score_ap(i, model_AP_set[0][i], model_id,
+                                          write_data, store)
             except KeyError:
                 print('Model AP_set keys did not match ExperimentalAPSet keys.')
         return scores
+
+    def score_ap(self, key, simu, model_id=0, write_data=False, store=None):
+        """Returns the RMSE between the experimental AP self.AP_set[key]
+        and a single simulated last_ap (t, V) DataFrame.
+        With write_data the aligned APs are written to a text file, or to
+        the ap_store.APTraceStore store if one is given."""
+        with telemetry.stage('score', key):
+            t_simu, V_simu = trace_arrays(simu)
+            t_new = self.grid(key, t_simu)
+            if (len(t_new) == 0):
+                # The simulated AP does not overlap the recording.
+                return self.MAX_SCORE
+            mV_new_simu = np.interp(t_new, t_simu, V_simu)
+            mV_new_real = np.interp(t_new, *self.traces[key])
+
+            # Calculate Root Mean Square Error
+            rmse = np.sqrt(np.mean((mV_new_real - mV_new_simu)**2))
+
+        # Write AP files
+        if write_data:
+            self.write_scored_ap(key, model_id, t_new, mV_new_real, mV_new_simu, store)
+        return rmse
+
+    def grid(self, key, t_simu):
+        """Common time grid of the experimental AP key and a simulated AP,
+        one resolution step inside the overlap of both traces."""
+        t_first_real, t_last_real, t_resolution = self.bounds[key]
+        t_first_simu = round(t_simu[0], 1)
+        t_last_simu = round(t_simu[-1], 1)
+
+        # Align curves within interpolation bounds
+        if (t_first_real >= t_first_simu):
+            t_first = t_first_real + t_resolution
+        else:
+            t_first = t_first_simu + t_resolution
+
+        if (t_last_real >= t_last_simu):
+            t_last = t_last_simu - t_resolution
+        else:
+            t_last = t_last_real - t_resolution
+        N = int((t_last - t_first)/t_resolution)
+        return np.linspace(t_first, t_last, max(N, 0))
+
+    def score_many(self, model_AP_sets, model_ids=None, write_data=False, store=None):
+        """Score a list of model AP sets (as returned by run_ind_dclamp).
+        For each experimental AP the grids of all models are concatenated so
+        the experimental trace is interpolated once, the squared errors are
+        summed per model with np.add.reduceat.
+        Returns a list of score dicts in the order of model_AP_sets."""
+        if model_ids is None:
+            model_ids = range(len(model_AP_sets))
+        model_ids = list(model_ids)
+        scores = [{} for i in model_AP_sets]
+        valid = []
+        for j, model_AP_set in enumerate(model_AP_sets):
+            if (model_AP_set is None or model_AP_set[1]):
+                scores[j] = dict.fromkeys(self.AP_set.keys(), self.MAX_SCORE)
+            else:
+                valid.append(j)
+
+        for key in self.AP_set.keys():
+            grids = []
+            simus = []
+            models = []
+            for j in valid:
+                try:
+                    t_simu, V_simu = trace_arrays(model_AP_sets[j][0][key])
+                except KeyError:
+                    print('Model AP_set keys did not match ExperimentalAPSet keys.')
+                    continue
+                t_new = self.grid(key, t_simu)
+                if (len(t_new) == 0):
+                    scores[j][key] = self.MAX_SCORE
+                    continue
+                grids.append(t_new)
+                simus.append(np.interp(t_new, t_simu, V_simu))
+                models.append(j)
+            if (len(models) == 0):
+                continue
+            lengths = np.array([len(t_new) for t_new in grids])
+            offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            t_all = np.concatenate(grids)
+            mV_real_all = np.interp(t_all, *self.traces[key])
+            mV_simu_all = np.concatenate(simus)
+            sq_sums = np.add.reduceat((mV_real_all - mV_simu_all)**2, offsets)
+            rmse = np.sqrt(sq_sums / lengths)
+            for n, j in enumerate(models):
+                scores[j][key] = rmse[n]
+                if write_data:
+                    s = slice(offsets[n], offsets[n] + lengths[n])
+                    self.write_scored_ap(key, model_ids[j], t_all[s],
+                                         mV_real_all[s], mV_simu_all[s], store)
+        return scores
+
+    def write_scored_ap(self, key, model_id, t_new, mV_new_real, mV_new_simu,
+                        store=None):
+        d = {'t':t_new, 'mV_cell':mV_new_real, 'mV_simu':mV_new_simu}
+        if store is not None:
+            store.write(model_id, key, d, ['t', 'mV_cell', 'mV_simu'])
+            return
+        d = pd.DataFrame(d)
+        filename = self.file_prefix + key + '_scored_AP_'+str(model_id)+'.txt'
+        d.to_csv(filename, sep=' ', index=False)
+
+
+# AP sets loaded by reference in this process, keyed by spec().
+_LOADED_AP_SETS = {}
+
+
+def load_by_reference(spec):
+    """Returns the ExperimentalAPSet of spec, loaded once per process."""
+    if spec not in _LOADED_AP_SETS:
+        path, dc_ik1, file_prefix, file_suffix, cell_id = spec
+        ap_set = ExperimentalAPSet(path=path, dc_ik1=dc_ik1, file_prefix=file_prefix,
+                                   file_suffix=file_suffix, cell_id=cell_id)
+        ap_set.by_reference = True
+        _LOADED_AP_SETS[spec] = ap_set
+    return _LOADED_AP_SETS[spec]
+
+
+def init_worker(*specs):
+    """Pool initializer that loads AP sets before the first task."""
+    for spec in specs:
+        load_by_reference(spec)
+
+
+def trace_arrays(ap):
+    """Returns the first two columns (t, V) of an AP DataFrame as contiguous
+    float64 arrays."""
+    t = np.ascontiguousarray(ap.iloc[:, 0].to_numpy(dtype=np.float64))
+    V = np.ascontiguousarray(ap.iloc[:, 1].to_numpy(dtype=np.float64))
+    return t, V
@@ -0,0 +1,195 @@
+import os
+import glob
+import pickle
+import random
+import numpy as np
+
+from deap import algorithms
+from deap import tools
+
+
+class Checkpointer:
+    """ Writes an atomic checkpoint of the (mu,lambda) run after every
+    generation and finds the newest one to resume from.
+    A checkpoint is a pickled dict with the generation, population (with
+    strategies and fitnesses), HallOfFame, logbook, the Python and NumPy
+    RNG states, the run id used in the output filenames, the state of
+    toolbox.map if it has one (e.g. the racing threshold) and the archive of
+    the surrogate stage.
+    Attributes:
+      directory: where checkpoint_<run_id>_gen<N>.pkl files are written.
+      run_id: identifier of the run (the start time stamp).
+      keep: number of newest checkpoints kept on disk.
+    """
+
+    def __init__(self, directory, run_id, keep=2):
+        self.directory = directory
+        self.run_id = run_id
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+    def filename(self, gen):
+        return os.path.join(self.directory, 'checkpoint_'+self.run_id+'_gen%04d.pkl' % gen)
+
+    def save(self, gen, population, halloffame, logbook, map_state=None,
+             surrogate_state=None):
+        state = {'gen': gen,
+                 'run_id': self.run_id,
+                 'population': population,
+                 'halloffame': halloffame,
+                 'logbook': logbook,
+                 'map_state': map_state,
+                 'surrogate_state': surrogate_state,
+                 'random_state': random.getstate(),
+                 'numpy_state': np.random.get_state()}
+        # Write to a temporary file and rename so a checkpoint is never
+        # left half written by a preemption.
+        filename = self.filename(gen)
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+
+        old = sorted(glob.glob(os.path.join(self.directory, 'checkpoint_'+self.run_id+'_gen*.pkl')))
+        for i in old[:-self.keep]:
+            os.remove(i)
+
+
+def latest_checkpoint(directory, run_id):
+    """Returns the filename of the checkpoint of the last generation of the
+    run run_id in directory or None."""
+    filenames = glob.glob(os.path.join(directory, 'checkpoint_'+run_id+'_gen*.pkl'))
+    if (len(filenames) == 0):
+        return None
+    return max(filenames)
+
+
+def load_checkpoint(filename):
+    """Load a checkpoint and restore the Python and NumPy RNG states.
+    The DEAP creator classes must be created before loading."""
+    with open(filename, 'rb') as f:
+        state = pickle.load(f)
+    random.setstate(state['random_state'])
+    np.random.set_state(state['numpy_state'])
+    return state
+
+
+def registered(func):
+    """The object registered as a toolbox function. Toolbox.register wraps
+    it in a functools.partial that copies its attributes but not its methods
+    and properties (get_state, set_state, TelemetryMap.counts)."""
+    return getattr(func, 'func', func)
+
+
+def last_counts(map_func):
+    """Logbook fields of the last call of toolbox.map, read from its status
+    counts (StatusMap, RacingMap, ...): the number of timed out evaluations
+    and the simulated seconds if the map counts them."""
+    counts = getattr(registered(map_func), 'counts', None)
+    if not counts:
+        return {'timeouts': 0}
+    fields = {'timeouts': counts[-1].get('timeout', 0)}
+    if 'simulated_s' in counts[-1]:
+        fields['simulated_s'] = counts[-1]['simulated_s']
+    return fields
+
+
+def eaMuCommaLambdaCheckpoint(population, toolbox, mu, lambda_, cxpb, mutpb, ngen,
+                              stats=None, halloffame=None, verbose=__debug__,
+                              checkpointer=None, start_gen=0, logbook=None,
+                              surrogate=None):
+    """The (mu,lambda) algorithm of algorithms.eaMuCommaLambda with a
+    checkpoint written after every generation. To resume, pass the
+    population, halloffame and logbook of the checkpoint and its generation
+    as start_gen (load_checkpoint restores the RNG states). The random
+    numbers are drawn in the same order as in DEAP, so a resumed run gives
+    the same result as an uninterrupted one.
+    With a surrogate.SurrogateScreen, lambda_*oversample offspring are bred
+    and only the ones it selects are simulated. Offspring with a predicted
+    fitness take part in the selection (mode 'predict') but never enter
+    the Hall of Fame, nor do the individuals a map marks as predicted
+    (MultiFidelityMap).
+    The offspring are bred by toolbox.vary if the toolbox has one (same
+    arguments as algorithms.varOr, e.g. es_array.varOrArray).
+    The logbook records the number of timed out evaluations and, if the
+    map counts them, the simulated seconds of every generation (last_counts)."""
+    assert lambda_ >= mu, "lambda must be greater or equal to mu."
+    n_offspring = lambda_
+    vary = getattr(toolbox, 'vary', algorithms.varOr)
+    if surrogate is not None:
+        n_offspring = lambda_ * surrogate.oversample
+        if (surrogate.mode == 'discard'):
+            assert surrogate.n_real >= mu, "n_real must be greater or equal to mu."
+
+    def save(gen):
+        if checkpointer is not None:
+            map_state = None
+            if hasattr(registered(toolbox.map), 'get_state'):
+                map_state = registered(toolbox.map).get_state()
+            surrogate_state = None
+            if surrogate is not None:
+                surrogate_state = surrogate.get_state()
+            checkpointer.save(gen, population, halloffame, logbook, map_state,
+                              surrogate_state)
+
+    if logbook is None:
+        logbook = tools.Logbook()
+
+        # Evaluate the individuals with an invalid fitness
+        invalid_ind = [ind for ind in population if not ind.fitness.valid]
+        fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
+        counts = last_counts(toolbox.map)
+        logbook.header = ['gen', 'nevals'] + list(counts) + (stats.fields if stats else [])
+        for ind, fit in zip(invalid_ind, fitnesses):
+            ind.fitness.values = fit
+        if surrogate is not None:
+            surrogate.update(invalid_ind, gen=0)
+
+        if halloffame is not None:
+            halloffame.update([ind for ind in population if not getattr(ind, 'predicted', False)])
+
+        record = stats.compile(population) if stats is not None else {}
+        logbook.record(gen=0, nevals=len(invalid_ind), **counts, **record)
+        if verbose:
+            print(logbook.stream)
+        save(0)
+
+    for gen in range(start_gen + 1, ngen + 1):
+        # Vary the population
+        offspring = vary(population, toolbox, n_offspring, cxpb, mutpb)
+
+        # Evaluate the individuals with an invalid fitness
+        invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
+        if surrogate is not None:
+            invalid_ind, screened = surrogate.screen(invalid_ind)
+            # Clones of a predicted individual keep the mark.
+            for ind in screened:
+                ind.predicted = True
+        fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
+        counts = last_counts(toolbox.map)
+        for ind, fit in zip(invalid_ind, fitnesses):
+            ind.fitness.values = fit
+        if surrogate is not None:
+            for ind in invalid_ind:
+                ind.predicted = False
+            surrogate.update(invalid_ind, gen=gen)
+            if (surrogate.mode == 'discard'):
+                offspring = [ind for ind in offspring if not getattr(ind, 'predicted', False)]
+
+        # Update the hall of fame with the generated individuals
+        if halloffame is not None:
+            halloffame.update([ind for ind in offspring if not getattr(ind, 'predicted', False)])
+
+        # Select the next generation population
+        population[:] = toolbox.select(offspring, mu)
+
+        # Update the statistics with the new population
+        record = stats.compile(population) if stats is not None else {}
+        logbook.record(gen=gen, nevals=len(invalid_ind), **counts, **record)
+        if verbose:
+            print(logbook.stream)
+        save(gen)
+
+    return population, logbook
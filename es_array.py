@@ -0,0 +1,162 @@
+"""Array-backed (mu,lambda) ES operators for large populations.
+
+The parameters and strategies of a population are held in two (n, size)
+NumPy arrays, so initialization, variation and selection draw all their
+random numbers in a few calls instead of one scipy.stats call per gene.
+The operators keep the semantics of generateES, mutateES, cxESBlend and
+tools.selTournament of iPSC_DEAP_fit: phi (column 0) uniform on [0,1) and
+reset when it leaves it, log-uniform parameters on [0.01,5.0], log-normal
+mutation of the parameters and the strategies. The random numbers come
+from np.random in a different order, a seeded run does not breed the same
+individuals as the per-individual operators.
+
+varOrArray, selTournamentArray and initPopulationArray take and return the
+creator.Individual lists of the DEAP algorithms (toolbox.vary,
+toolbox.select and toolbox.population).
+"""
+import numpy as np
+
+
+PARAM_LOW = 1e-2
+PARAM_HIGH = 5.0
+# Shape of the log-normal initial strategies.
+STRATEGY_SHAPE = 0.5
+# Conductances below this are clipped before taking the log.
+MIN_PARAM = 1e-6
+
+
+def log_params(x):
+    """Parameters x (phi first) with phi as is and the log of the others,
+    the space the parameters are mutated in (refine, warm_start)."""
+    z = np.array(x, dtype=np.float64)
+    z[1:] = np.log(np.maximum(z[1:], MIN_PARAM))
+    return z
+
+
+class ArrayPopulation:
+    """Parameters and strategies of n individuals.
+    Attributes:
+      params: (n, size) array of the parameters, phi in column 0.
+      strategy: (n, size) array of the mutation strengths.
+    """
+
+    def __init__(self, params, strategy):
+        self.params = np.array(params, dtype=np.float64, ndmin=2)
+        self.strategy = np.array(strategy, dtype=np.float64, ndmin=2)
+
+    def __len__(self):
+        return self.params.shape[0]
+
+    def take(self, idx):
+        """ArrayPopulation of the rows idx (a copy)."""
+        return ArrayPopulation(self.params[idx], self.strategy[idx])
+
+    def to_individuals(self, ind_clss, strategy_clss):
+        """List of ind_clss individuals with a strategy_clss strategy and
+        an invalid fitness."""
+        inds = []
+        for params, strategy in zip(self.params.tolist(), self.strategy.tolist()):
+            ind = ind_clss(params)
+            ind.strategy = strategy_clss(strategy)
+            inds.append(ind)
+        return inds
+
+
+def from_individuals(inds):
+    """ArrayPopulation of a list of individuals with a strategy."""
+    return ArrayPopulation([list(ind) for ind in inds], [list(ind.strategy) for ind in inds])
+
+
+def generateESArray(n, size):
+    """generateES of n individuals."""
+    params = np.empty((n, size))
+    params[:, 0] = np.random.uniform(0.0, 1.0, size=n)
+    params[:, 1:] = np.exp(np.random.uniform(np.log(PARAM_LOW), np.log(PARAM_HIGH),
+                                             size=(n, size-1)))
+    strategy = np.empty((n, size))
+    strategy[:, 0] = np.random.uniform(0.0, 1.0, size=n)
+    strategy[:, 1:] = np.exp(STRATEGY_SHAPE * np.random.standard_normal((n, size-1)))
+    return ArrayPopulation(params, strategy)
+
+
+def mutateESArray(pop, indpb=0.3):
+    """mutateES of every row of pop, in place. Each gene is mutated with
+    probability indpb: the parameter and the strategy are multiplied by
+    log-normal numbers of shape the (old) strategy."""
+    shape = pop.params.shape
+    mask = np.random.random_sample(shape) < indpb
+    z = np.random.standard_normal((2,) + shape)
+    params = pop.params * np.exp(pop.strategy * z[0])
+    strategy = pop.strategy * np.exp(pop.strategy * z[1])
+    pop.params = np.where(mask, params, pop.params)
+    pop.strategy = np.where(mask, strategy, pop.strategy)
+    # Check that Phi is in [0,1)
+    reset = np.flatnonzero(pop.params[:, 0] > 1.0)
+    pop.params[reset, 0] = np.random.random_sample(len(reset))
+    pop.strategy[reset, 0] = np.random.random_sample(len(reset))
+    return pop
+
+
+def cxESBlendArray(pop1, pop2, alpha):
+    """cxESBlend of the rows of pop1 with the rows of pop2.
+    Returns the two populations of children."""
+    shape = pop1.params.shape
+    gamma = 1.0 - np.random.random_sample(shape) * alpha
+    params1 = gamma * pop1.params + (1.0 - gamma) * pop2.params
+    params2 = gamma * pop2.params + (1.0 - gamma) * pop1.params
+    gamma = 1.0 - np.random.random_sample(shape) * alpha
+    strategy1 = (1. - gamma) * pop1.strategy + gamma * pop2.strategy
+    strategy2 = gamma * pop1.strategy + (1. - gamma) * pop2.strategy
+    return ArrayPopulation(params1, strategy1), ArrayPopulation(params2, strategy2)
+
+
+def tournament(fitness, k, tournsize):
+    """Indices of k tournament winners (the lowest fitness of tournsize
+    individuals drawn with replacement)."""
+    aspirants = np.random.randint(len(fitness), size=(k, tournsize))
+    return aspirants[np.arange(k), np.argmin(np.asarray(fitness)[aspirants], axis=1)]
+
+
+def varOrArray(population, toolbox, lambda_, cxpb, mutpb, indpb=0.3, alpha=0.3):
+    """algorithms.varOr with the array operators. Each offspring is the
+    first child of a crossover of two distinct parents (probability cxpb),
+    a mutated parent (mutpb) or a toolbox.clone of a parent that keeps its
+    fitness. Returns a list of lambda_ individuals."""
+    assert (cxpb + mutpb) <= 1.0, (
+        "The sum of the crossover and mutation probabilities must be smaller "
+        "or equal to 1.0.")
+    n = len(population)
+    pop = from_individuals(population)
+    op = np.random.random_sample(lambda_)
+    cx = np.flatnonzero(op < cxpb)
+    mut = np.flatnonzero((op >= cxpb) & (op < cxpb + mutpb))
+    rep = np.flatnonzero(op >= cxpb + mutpb)
+
+    # Two distinct parents of each crossover, as random.sample.
+    first = np.random.randint(n, size=len(cx))
+    second = (first + np.random.randint(1, n, size=len(cx))) % n
+    children = cxESBlendArray(pop.take(first), pop.take(second), alpha)[0]
+    mutants = mutateESArray(pop.take(np.random.randint(n, size=len(mut))), indpb)
+    parents = np.random.randint(n, size=len(rep))
+
+    ind_clss = type(population[0])
+    strategy_clss = type(population[0].strategy)
+    offspring = [None] * lambda_
+    for i, ind in zip(cx, children.to_individuals(ind_clss, strategy_clss)):
+        offspring[i] = ind
+    for i, ind in zip(mut, mutants.to_individuals(ind_clss, strategy_clss)):
+        offspring[i] = ind
+    for i, j in zip(rep, parents):
+        offspring[i] = toolbox.clone(population[j])
+    return offspring
+
+
+def selTournamentArray(individuals, k, tournsize):
+    """tools.selTournament for a minimized single objective."""
+    fitness = [ind.fitness.values[0] for ind in individuals]
+    return [individuals[i] for i in tournament(fitness, k, tournsize)]
+
+
+def initPopulationArray(n, ind_clss, strategy_clss, size):
+    """n individuals of generateES."""
+    return generateESArray(n, size).to_individuals(ind_clss, strategy_clss)
@@ -0,0 +1,176 @@
+import os
+import math
+import json
+import time
+import sqlite3
+
+
+# Lookups counted in memory before the counters are written.
+FLUSH_EVERY = 100
+
+# Lookups not yet written, per (cache filename, process id). The copies of a
+# cache unpickled with every pool task share the counts of their process.
+_lookups = {}
+
+
+class EvaluationCache:
+    """ Persistent on-disk cache of ExperimentalAPSet.score results.
+    The key is the individual (phi, G_K1..G_PCa) quantized with a relative
+    tolerance, together with dc_ik1, nai, ki and a namespace identifying the
+    experimental AP set. The value is the per-condition score dict.
+
+    The cache is a SQLite database so it can be shared between generations,
+    between runs on the same cell and between pool workers. Each process
+    opens its own connection, writes are serialized by SQLite (WAL journal
+    with a busy timeout). The least recently used entries are evicted once
+    the cache holds more than max_entries. Hit/miss counters are kept in the
+    database so they include lookups made by every worker. Lookups only
+    read: each process counts its hits and misses, and the last use of its
+    hits, in memory and writes them with its next put (or after FLUSH_EVERY
+    lookups), so the workers do not wait for the write lock on the read
+    path. The last lookups of a worker that never writes again are missing
+    from the counters.
+    Attributes:
+      filename: path to the SQLite database.
+      tol: relative tolerance on the parameters (absolute on phi).
+      max_entries: number of entries kept after eviction (None: unbounded).
+    """
+
+    def __init__(self, filename, tol=1e-4, max_entries=None, timeout=60.0):
+        self.filename = filename
+        self.tol = tol
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._conn = None
+        self._pid = None
+        self._n_puts = 0
+        conn = self._connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS scores ('
+                     'namespace TEXT, key TEXT, scores TEXT, last_used REAL, '
+                     'PRIMARY KEY (namespace, key))')
+        conn.execute('CREATE INDEX IF NOT EXISTS scores_last_used '
+                     'ON scores (last_used)')
+        conn.execute('CREATE TABLE IF NOT EXISTS counters ('
+                     'name TEXT PRIMARY KEY, value INTEGER)')
+        conn.execute("INSERT OR IGNORE INTO counters VALUES ('hits', 0)")
+        conn.execute("INSERT OR IGNORE INTO counters VALUES ('misses', 0)")
+        conn.commit()
+
+    def __getstate__(self):
+        # Connections cannot be pickled, each worker opens its own.
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_pid'] = None
+        return state
+
+    def _connect(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.filename, timeout=self.timeout)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._pid = os.getpid()
+        return self._conn
+
+    def make_key(self, ind, dc_ik1=1.0, nai=10.0, ki=130.0):
+        """Quantize the individual: phi on a linear grid of spacing tol,
+        the conductances on a log grid so the tolerance is relative."""
+        q = [str(int(round(ind[0] / self.tol)))]
+        for x in ind[1:]:
+            if (x > 0.0):
+                q.append(str(int(round(math.log(x) / self.tol))))
+            else:
+                q.append('z')
+        q += [repr(float(dc_ik1)), repr(float(nai)), repr(float(ki))]
+        return ','.join(q)
+
+    def get(self, ind, namespace, dc_ik1=1.0, nai=10.0, ki=130.0):
+        """Returns the cached score dict or None."""
+        key = self.make_key(ind, dc_ik1, nai, ki)
+        conn = self._connect()
+        row = conn.execute('SELECT scores FROM scores WHERE namespace=? AND key=?',
+                           (namespace, key)).fetchone()
+        lookups = self._lookups()
+        if row is None:
+            lookups['misses'] += 1
+        else:
+            lookups['hits'] += 1
+            lookups['used'][(namespace, key)] = time.time()
+        if (lookups['hits'] + lookups['misses'] >= FLUSH_EVERY):
+            self.flush()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, ind, namespace, scores, dc_ik1=1.0, nai=10.0, ki=130.0):
+        key = self.make_key(ind, dc_ik1, nai, ki)
+        conn = self._connect()
+        with conn:
+            self._write_lookups(conn)
+            conn.execute('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)',
+                         (namespace, key, json.dumps(scores), time.time()))
+        # Checking the size on every put would serialize the workers.
+        self._n_puts += 1
+        if (self.max_entries is not None and self._n_puts % 100 == 0):
+            self.evict()
+
+    def _lookups(self):
+        """Lookups of this process not yet written to the database."""
+        return _lookups.setdefault((os.path.abspath(self.filename), os.getpid()),
+                                   {'hits': 0, 'misses': 0, 'used': {}})
+
+    def _write_lookups(self, conn):
+        """Add the counted lookups to the database (in the transaction of
+        the caller)."""
+        lookups = self._lookups()
+        if (lookups['hits'] + lookups['misses'] == 0):
+            return
+        conn.executemany('UPDATE scores SET last_used=? WHERE namespace=? AND key=?',
+                         [(t, namespace, key)
+                          for (namespace, key), t in lookups['used'].items()])
+        conn.execute("UPDATE counters SET value=value+? WHERE name='hits'", (lookups['hits'],))
+        conn.execute("UPDATE counters SET value=value+? WHERE name='misses'",
+                     (lookups['misses'],))
+        lookups['hits'] = 0
+        lookups['misses'] = 0
+        lookups['used'] = {}
+
+    def flush(self):
+        """Write the counted lookups of this process."""
+        conn = self._connect()
+        with conn:
+            self._write_lookups(conn)
+
+    def evict(self):
+        """Delete the least recently used entries above max_entries."""
+        self.flush()
+        if self.max_entries is None:
+            return
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM scores WHERE rowid IN ('
+                         'SELECT rowid FROM scores ORDER BY last_used DESC '
+                         'LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def stats(self):
+        """Returns dict with hits, misses and the number of entries."""
+        self.flush()
+        conn = self._connect()
+        d = dict(conn.execute('SELECT name, value FROM counters').fetchall())
+        d['entries'] = conn.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+        return d
+
+    def close(self):
+        if self._conn is not None:
+            self.flush()
+            self._conn.close()
+            self._conn = None
+
+
+def cell_namespace(ExperAPSet, pacing=None):
+    """Namespace of an ExperimentalAPSet in the cache: the digest of its
+    traces, so replaced AP files get new scores and the same APs loaded from
+    text files or their .npz share them. Scores of a pacing other than the
+    default 10 s protocol are kept apart."""
+    namespace = 'traces:' + ExperAPSet.digest
+    if (pacing is not None and pacing.key() is not None):
+        namespace += '|' + pacing.key()
+    return namespace
@@ -0,0 +1,378 @@
+"""Evaluation backends registered as toolbox.map and used for the starmap in
+write_hof_APs. Every executor has map(func, iterable), starmap(func,
+iterable), submit(func, args, callback, error_callback) and close().
+submit runs func(*args) asynchronously and calls callback(result) (or
+error_callback(exception)) from a background thread. The backends are:
+  pool:    multiprocessing.Pool on the local host.
+  futures: concurrent.futures process (or thread) pool on the local host.
+  broker:  a TCP broker in the driver process with standalone workers
+           (python executors.py worker HOST:PORT) on any number of hosts.
+The broker and its workers share the secret $DCLAMP_BROKER_AUTHKEY: the
+messages are pickles, so whoever can connect with the key can run code on
+the broker and the workers. The broker listens on 127.0.0.1 unless
+--broker-address names another interface.
+"""
+import os
+import sys
+import time
+import queue
+import secrets
+import argparse
+import importlib
+import threading
+import traceback
+import subprocess
+import concurrent.futures
+from multiprocessing import Pool
+from multiprocessing.connection import Listener
+from multiprocessing.connection import Client
+from multiprocessing.reduction import ForkingPickler
+
+
+class LocalPoolExecutor:
+    """multiprocessing.Pool on the local host."""
+
+    def __init__(self, processes=None, initializer=None, initargs=(),
+                 maxtasksperchild=None):
+        self.pool = Pool(processes, initializer=initializer, initargs=initargs,
+                         maxtasksperchild=maxtasksperchild)
+
+    def map(self, func, iterable):
+        return self.pool.map(func, iterable)
+
+    def starmap(self, func, iterable):
+        return self.pool.starmap(func, iterable)
+
+    def submit(self, func, args, callback, error_callback=None):
+        self.pool.apply_async(func, args, callback=callback,
+                              error_callback=error_callback)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class FuturesExecutor:
+    """concurrent.futures executor on the local host. kind is 'process' or
+    'thread'. chunksize batches small tasks for the process pool. The
+    thread pool cannot run evaluations with a timeout (see
+    run_dclamp_simulation.TimeBudget)."""
+
+    def __init__(self, max_workers=None, kind='process', chunksize=1,
+                 initializer=None, initargs=(), max_tasks_per_child=None):
+        if (kind == 'process'):
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers, initializer=initializer, initargs=initargs,
+                max_tasks_per_child=max_tasks_per_child)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers, initializer=initializer, initargs=initargs)
+        self.chunksize = chunksize
+
+    def map(self, func, iterable):
+        return list(self.executor.map(func, iterable, chunksize=self.chunksize))
+
+    def starmap(self, func, iterable):
+        return list(self.executor.map(func, *zip(*iterable), chunksize=self.chunksize))
+
+    def submit(self, func, args, callback, error_callback=None):
+        def done(future):
+            if (future.exception() is None):
+                callback(future.result())
+            elif error_callback is not None:
+                error_callback(future.exception())
+        self.executor.submit(func, *args).add_done_callback(done)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class _Job:
+    """Results of one map call collected by the broker threads."""
+
+    def __init__(self, n, callback=None, error_callback=None):
+        self.results = [None] * n
+        self.remaining = n
+        self.error = None
+        self.callback = callback
+        self.error_callback = error_callback
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        if (n == 0):
+            self.done.set()
+
+    def set_results(self, indices, results):
+        with self.lock:
+            for i, r in zip(indices, results):
+                self.results[i] = r
+            self.remaining -= len(indices)
+            if (self.remaining == 0):
+                self.done.set()
+                if self.callback is not None:
+                    self.callback(self.results[0])
+
+    def fail(self, error):
+        with self.lock:
+            self.error = error
+            self.done.set()
+            if self.error_callback is not None:
+                self.error_callback(error)
+
+
+class SocketBrokerExecutor:
+    """ TCP broker for workers on other machines (or on localhost).
+    Tasks are sent to the workers in batches of batch_size. Each worker
+    sends a heartbeat every few seconds while it computes. A batch is put
+    back in the queue if its worker disconnects or misses heartbeats for
+    heartbeat_timeout seconds. A batch that was lost more than max_retries
+    times makes the map call raise RuntimeError, as does an exception in a
+    task. The connections are authenticated with authkey
+    (multiprocessing.connection), which is required since the messages are
+    unpickled. The tasks are pickled so the functions must be importable by
+    the workers; a task that cannot be pickled makes the map call raise the
+    pickling error.
+    Attributes:
+      address: (host, port) the broker listens on.
+      local_workers: number of worker processes started on this host.
+    """
+
+    def __init__(self, address=('127.0.0.1', 5555), authkey=None, batch_size=1,
+                 heartbeat_timeout=120.0, max_retries=3, local_workers=0,
+                 initializer=None, initargs=(), setup=None):
+        if not authkey:
+            raise ValueError('SocketBrokerExecutor needs an authkey.')
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.authkey = authkey
+        self.batch_size = batch_size
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_retries = max_retries
+        self.initializer = initializer
+        self.initargs = initargs
+        self.tasks = queue.Queue()
+        self.n_workers = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+        self.procs = []
+        for i in range(local_workers):
+            cmd = [sys.executable, os.path.abspath(__file__), 'worker',
+                   'localhost:'+str(self.address[1])]
+            if setup is not None:
+                cmd += ['--setup', setup]
+            env = dict(os.environ, DCLAMP_BROKER_AUTHKEY=authkey.decode())
+            self.procs.append(subprocess.Popen(cmd, env=env))
+
+    def _accept(self):
+        while not self.closed:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                # The listener was closed.
+                return
+            except Exception:
+                # Failed authentication, keep listening.
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with self.lock:
+            self.n_workers += 1
+        batch = None
+        try:
+            if self.initializer is not None:
+                conn.send(('init', self.initializer, self.initargs))
+            while True:
+                batch = self.tasks.get()
+                if batch is None:
+                    conn.send(('stop',))
+                    return
+                job, indices, func, args_list, attempts = batch
+                if job.done.is_set():
+                    # The job already failed.
+                    batch = None
+                    continue
+                try:
+                    # Pickled before sending, so a task that cannot be pickled
+                    # sends nothing.
+                    conn.send_bytes(ForkingPickler.dumps(('run', func, args_list)))
+                    while True:
+                        if not conn.poll(self.heartbeat_timeout):
+                            raise TimeoutError('worker missed heartbeats')
+                        msg = conn.recv()
+                        if (msg[0] == 'result'):
+                            job.set_results(indices, msg[1])
+                            break
+                        elif (msg[0] == 'error'):
+                            job.fail(RuntimeError('Task failed on worker:\n'+msg[1]))
+                            break
+                except (EOFError, OSError, TimeoutError):
+                    raise
+                except Exception as exc:
+                    # e.g. a task that cannot be pickled (a lambda) or a result
+                    # that cannot be unpickled: the job fails, the worker stays.
+                    job.fail(exc)
+                batch = None
+        except (EOFError, OSError, TimeoutError):
+            # Worker lost: retry its batch on another worker.
+            if batch is not None:
+                job, indices, func, args_list, attempts = batch
+                if (attempts >= self.max_retries):
+                    job.fail(RuntimeError('Batch lost '+str(attempts+1)+' times.'))
+                else:
+                    print('Worker lost, retrying batch of '+str(len(indices))+' tasks.')
+                    self.tasks.put((job, indices, func, args_list, attempts+1))
+        finally:
+            with self.lock:
+                self.n_workers -= 1
+            conn.close()
+
+    def starmap(self, func, iterable):
+        args = list(iterable)
+        job = _Job(len(args))
+        for i in range(0, len(args), self.batch_size):
+            indices = list(range(i, min(i+self.batch_size, len(args))))
+            self.tasks.put((job, indices, func, [args[j] for j in indices], 0))
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.results
+
+    def map(self, func, iterable):
+        return self.starmap(func, [(i,) for i in iterable])
+
+    def submit(self, func, args, callback, error_callback=None):
+        job = _Job(1, callback, error_callback)
+        self.tasks.put((job, [0], func, [tuple(args)], 0))
+
+    def close(self):
+        with self.lock:
+            n = self.n_workers
+        for i in range(n):
+            self.tasks.put(None)
+        self.closed = True
+        self.listener.close()
+        for p in self.procs:
+            p.wait()
+
+
+def run_worker(address, authkey, heartbeat_interval=10.0):
+    """Connect to a SocketBrokerExecutor and run tasks until it stops."""
+    conn = Client(address, authkey=authkey)
+    send_lock = threading.Lock()
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(heartbeat_interval):
+            try:
+                with send_lock:
+                    conn.send(('heartbeat',))
+            except OSError:
+                return
+    threading.Thread(target=heartbeat, daemon=True).start()
+
+    try:
+        while True:
+            try:
+                msg = conn.recv()
+            except EOFError:
+                break
+            if (msg[0] == 'stop'):
+                break
+            elif (msg[0] == 'init'):
+                msg[1](*msg[2])
+            elif (msg[0] == 'run'):
+                func, args_list = msg[1], msg[2]
+                try:
+                    results = [func(*args) for args in args_list]
+                    reply = ('result', results)
+                except Exception:
+                    reply = ('error', traceback.format_exc())
+                with send_lock:
+                    conn.send(reply)
+    finally:
+        stop.set()
+        conn.close()
+
+
+def add_executor_args(parser):
+    """Add the executor options to an argparse parser."""
+    parser.add_argument('--executor', default='pool', choices=['pool', 'futures', 'broker'],
+                        help='evaluation backend')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of local worker processes')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='number of tasks sent to a worker at once')
+    parser.add_argument('--max-tasks-per-child', type=int, default=None,
+                        help='recycle local worker processes after this many tasks')
+    parser.add_argument('--broker-address', default='127.0.0.1:5555',
+                        help='HOST:PORT the broker listens on (e.g. 0.0.0.0:5555 for '
+                        'workers on other hosts)')
+    parser.add_argument('--broker-local-workers', type=int, default=0,
+                        help='broker workers started on this host')
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def make_executor(args, initializer=None, initargs=(), setup=None):
+    """Create the executor selected by the add_executor_args options.
+    The broker authkey is read from $DCLAMP_BROKER_AUTHKEY, if it is not set
+    a random key is generated and printed for the workers on other hosts."""
+    if (args.executor == 'futures'):
+        return FuturesExecutor(args.workers, chunksize=args.batch_size,
+                               initializer=initializer, initargs=initargs,
+                               max_tasks_per_child=args.max_tasks_per_child)
+    elif (args.executor == 'broker'):
+        authkey = os.environ.get('DCLAMP_BROKER_AUTHKEY')
+        if not authkey:
+            authkey = secrets.token_hex(16)
+            print('DCLAMP_BROKER_AUTHKEY is not set, the workers on other hosts need '
+                  'DCLAMP_BROKER_AUTHKEY='+authkey)
+        executor = SocketBrokerExecutor(parse_address(args.broker_address),
+                                        authkey=authkey.encode(), batch_size=args.batch_size,
+                                        local_workers=args.broker_local_workers,
+                                        initializer=initializer, initargs=initargs,
+                                        setup=setup)
+        print('Broker listening on '+str(executor.address))
+        return executor
+    return LocalPoolExecutor(args.workers, initializer=initializer, initargs=initargs,
+                             maxtasksperchild=args.max_tasks_per_child)
+
+
+def worker_main(argv):
+    parser = argparse.ArgumentParser(description='Standalone worker of a SocketBrokerExecutor.')
+    parser.add_argument('address', help='HOST:PORT of the broker')
+    parser.add_argument('--setup', default=None,
+                        help='module:function called before connecting, '
+                        'e.g. iPSC_DEAP_fit:create_deap_classes')
+    parser.add_argument('--heartbeat', type=float, default=10.0,
+                        help='seconds between heartbeats')
+    args = parser.parse_args(argv)
+    sys.path.insert(0, os.getcwd())
+    if args.setup is not None:
+        module, function = args.setup.split(':')
+        getattr(importlib.import_module(module), function)()
+    authkey = os.environ.get('DCLAMP_BROKER_AUTHKEY')
+    if not authkey:
+        print('Set DCLAMP_BROKER_AUTHKEY to the key of the broker.')
+        sys.exit(1)
+    authkey = authkey.encode()
+    # Retry while the broker starts up.
+    for i in range(30):
+        try:
+            run_worker(parse_address(args.address), authkey, args.heartbeat)
+            return
+        except ConnectionRefusedError:
+            time.sleep(2.0)
+    print('Could not connect to broker at '+args.address)
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1 and sys.argv[1] == 'worker'):
+        worker_main(sys.argv[2:])
+    else:
+        print('executors.py worker HOST:PORT [--setup module:function]')
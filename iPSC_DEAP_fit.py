@@ -1,3 +1,7 @@
+import os
+import sys
+import time
+import argparse
 import array as arr
 import random
 import numpy as np
@@ -5,16 +9,53 @@ import pandas as pd
 from datetime import datetime
 from scipy.stats import lognorm
 from scipy.stats import loguniform
+from scipy.stats import spearmanr
 from run_dclamp_simulation import run_ind_dclamp
+from run_dclamp_simulation import run_ind_cntrl
+from run_dclamp_simulation import run_ind_perturbation
+from run_dclamp_simulation import run_ind_conditions
+from run_dclamp_simulation import PERTURBATIONS
+from run_dclamp_simulation import TimeBudget
+from run_dclamp_simulation import SimulationTimeout
+from run_dclamp_simulation import add_pacing_args
+from run_dclamp_simulation import make_pacing
 from cell_recording import ExperimentalAPSet
-from multiprocessing import Pool
+from cell_recording import init_worker
+from eval_cache import EvaluationCache
+from eval_cache import cell_namespace
+from ap_store import APTraceStore
+from ap_store import TraceCollector
+from checkpoint import Checkpointer
+from checkpoint import eaMuCommaLambdaCheckpoint
+from checkpoint import latest_checkpoint
+from checkpoint import registered
+from checkpoint import load_checkpoint
+from executors import add_executor_args
+from executors import make_executor
+from async_es import eaAsyncSteadyState
+from batch_sim import run_population_dclamp
+from surrogate import SurrogateScreen
+from es_array import varOrArray
+from es_array import selTournamentArray
+from es_array import initPopulationArray
+from refine import refine_hof
+from islands import eaIslands
+from seeding import seed_population
+import telemetry
+from functools import partial
 
-from deap import algorithms
 from deap import base
 from deap import creator
 from deap import tools
 
 
+NUM_PARAMS = 14
+
+PARAM_NAMES = ['phi', 'G_K1', 'G_Kr', 'G_Ks', 'G_to', 'P_CaL',
+               'G_CaT', 'G_Na', 'G_F', 'K_NaCa', 'P_NaK',
+               'G_b_Na', 'G_b_Ca', 'G_PCa']
+
+
 def generateES(ind_clss, strategy_clss, size):
     """This function constructs an individual and its strategy.
     The regular paramters (ind) are sampled from the log-uniform distribution
@@ -39,10 +80,778 @@ def generateES(ind_clss, strategy_clss, size):
     return ind
 
 
-def fitness(ind, ExperAPSet):
-    model_APSet = run_ind_dclamp(ind, dc_ik1=ExperAPSet.dc_ik1)
-    rmsd_total = (sum(ExperAPSet.score(model_APSet).values()),)
-    return rmsd_total
+def cached_status(scores):
+    """Status of scores read from the EvaluationCache: an AP Failure is
+    cached as MAX_SCORE for every AP."""
+    if all(score == ExperimentalAPSet.MAX_SCORE for score in scores.values()):
+        return 'failure'
+    return 'ok'
+
+
+def fitness(ind, ExperAPSet, cache=None, timeout=None, condition_timeout=None,
+            pacing=None):
+    """Sum of the RMSD of each AP. If an EvaluationCache is given the
+    per-condition scores are looked up before simulating the individual."""
+    return (fitness_status(ind, ExperAPSet, cache, timeout, condition_timeout, pacing)[0],)
+
+
+@telemetry.evaluation('fitness')
+def fitness_status(ind, ExperAPSet, cache=None, timeout=None, condition_timeout=None,
+                   pacing=None):
+    """fitness() that also returns the status of the evaluation.
+    timeout and condition_timeout are the wall-clock budgets (s) of the
+    evaluation and of each condition, a timed out individual is scored as
+    an AP Failure and is not cached. pacing is a FixedPacing (default) or
+    AdaptivePacing of run_dclamp_simulation.
+    Returns (total, status, simulated_s) with status 'ok', 'failure' or
+    'timeout' and the seconds of model time paced (0 for a cached
+    individual)."""
+    total, status, model_APSet, simulated_s = evaluate_status(ind, ExperAPSet, cache, timeout,
+                                                              condition_timeout, pacing)
+    return total, status, simulated_s
+
+
+def fitness_values_status(ind, ExperAPSet, cache=None, timeout=None, condition_timeout=None,
+                          pacing=None):
+    """fitness_status() as ((total,), status, simulated_s), the
+    toolbox.evaluate of eaAsyncSteadyState(with_status=True)."""
+    total, status, simulated_s = fitness_status(ind, ExperAPSet, cache, timeout,
+                                                condition_timeout, pacing)
+    return (total,), status, simulated_s
+
+
+def evaluate_status(ind, ExperAPSet, cache=None, timeout=None, condition_timeout=None,
+                    pacing=None):
+    """Evaluation of fitness_status. Returns (total, status, model_APSet,
+    simulated_s), model_APSet is None if the scores came from the cache or
+    timed out."""
+    if cache is not None:
+        namespace = cell_namespace(ExperAPSet, pacing)
+        scores = cache.get(ind, namespace, dc_ik1=ExperAPSet.dc_ik1)
+        if scores is not None:
+            return sum(scores.values()), cached_status(scores), None, 0.0
+    budget = TimeBudget(timeout, condition_timeout)
+    try:
+        model_APSet = run_ind_dclamp(ind, dc_ik1=ExperAPSet.dc_ik1, budget=budget,
+                                     pacing=pacing)
+    except SimulationTimeout:
+        print('Simulation timeout: '+str(list(ind)))
+        return (ExperimentalAPSet.MAX_SCORE * len(ExperAPSet.AP_set), 'timeout', None,
+                budget.simulated_ms / 1000.0)
+    scores = ExperAPSet.score(model_APSet)
+    if cache is not None:
+        cache.put(ind, namespace, scores, dc_ik1=ExperAPSet.dc_ik1)
+    status = 'failure' if (model_APSet is None or model_APSet[1]) else 'ok'
+    return sum(scores.values()), status, model_APSet, budget.simulated_ms / 1000.0
+
+
+@telemetry.evaluation('fitness_elite')
+def fitness_elite(ind, ExperAPSet, threshold=np.inf, cache=None, timeout=None,
+                  condition_timeout=None, pacing=None, dtype=np.float32):
+    """fitness_status() that also returns the simulated last APs of an
+    individual that enters the Hall of Fame (total below threshold) as a
+    TraceCollector of dtype, otherwise None (also for cached individuals).
+    Returns (total, status, collector)."""
+    total, status, model_APSet, simulated_s = evaluate_status(ind, ExperAPSet, cache, timeout,
+                                                              condition_timeout, pacing)
+    collector = None
+    if (status == 'ok' and model_APSet is not None and total < threshold):
+        collector = TraceCollector(dtype=dtype)
+        for key, last_ap in model_APSet[0].items():
+            collector.write(0, key, last_ap, list(last_ap.columns), kind='simulated')
+    return total, status, collector
+
+
+class EliteTraceMap:
+    """Replacement for toolbox.map that keeps the simulated last APs of the
+    Hall of Fame individuals, so write_hof_APs does not simulate them again.
+    The threshold sent with the tasks is the worst fitness of a full Hall
+    of Fame, only the traces of the individuals below it come back. At the
+    next call they are moved to the archive if they entered the Hall of
+    Fame, and the archive drops the individuals that left it, so at most
+    hof.maxsize traces sets are kept. Individuals scored from the cache or
+    added outside the map (refine_hof) have no traces.
+    The func argument given by the DEAP algorithm is ignored.
+    Attributes:
+      hof: the HallOfFame of the run (set before the first call).
+      archive: tuple(individual): list of (key, data, columns) traces.
+      counts: status counts per call.
+    """
+
+    def __init__(self, map_func, ExperAPSet, hof=None, cache=None, timeout=None,
+                 condition_timeout=None, pacing=None, dtype=np.float32):
+        self.map_func = map_func
+        self.ExperAPSet = ExperAPSet
+        self.hof = hof
+        self.cache = cache
+        self.timeout = timeout
+        self.condition_timeout = condition_timeout
+        self.pacing = pacing
+        self.dtype = dtype
+        self.archive = {}
+        self.pending = {}
+        self.counts = []
+
+    def sync(self):
+        """Keep the traces of the individuals in the Hall of Fame."""
+        archive = {}
+        for ind in self.hof:
+            key = tuple(ind)
+            if key in self.pending:
+                archive[key] = self.pending[key]
+            elif key in self.archive:
+                archive[key] = self.archive[key]
+        self.archive = archive
+        self.pending = {}
+
+    def __call__(self, func, inds):
+        self.sync()
+        threshold = np.inf
+        if (len(self.hof) >= self.hof.maxsize):
+            threshold = self.hof[-1].fitness.values[0]
+        inds = list(inds)
+        results = list(self.map_func(partial(fitness_elite, ExperAPSet=self.ExperAPSet,
+                                             threshold=threshold, cache=self.cache,
+                                             timeout=self.timeout,
+                                             condition_timeout=self.condition_timeout,
+                                             pacing=self.pacing, dtype=self.dtype), inds))
+        counts = {'ok': 0, 'failure': 0, 'timeout': 0}
+        for ind, (total, status, collector) in zip(inds, results):
+            counts[status] += 1
+            if collector is not None:
+                self.pending[tuple(ind)] = [(key, data, columns)
+                                            for model_id, key, data, columns, kind
+                                            in collector.traces]
+        self.counts.append(counts)
+        print('Evaluations: '+str(counts))
+        return [(total,) for total, status, collector in results]
+
+    def write_archive(self, filename):
+        """Write the traces of the Hall of Fame to an APTraceStore, the
+        model_id is the row of the individual in hof_*.txt and a 'params'
+        record holds its parameters. Returns the number of models written."""
+        self.sync()
+        store = APTraceStore(filename, dtype=self.dtype)
+        n = 0
+        for i, ind in enumerate(self.hof):
+            traces = self.archive.get(tuple(ind))
+            if traces is None:
+                continue
+            store.write(i, 'params', np.array([list(ind)]), PARAM_NAMES, kind='params')
+            for key, data, columns in traces:
+                store.write(i, key, data, columns, kind='simulated')
+            n += 1
+        store.close()
+        return n
+
+    def get_state(self):
+        return {'archive': self.archive, 'pending': self.pending, 'counts': self.counts}
+
+    def set_state(self, state):
+        self.archive = state['archive']
+        self.pending = state['pending']
+        self.counts = state['counts']
+
+
+class StatusMap:
+    """Replacement for toolbox.map that evaluates individuals with
+    fitness_status and prints the number of 'ok', 'failure' and 'timeout'
+    evaluations and the simulated seconds ('simulated_s') of every call
+    (one per generation) to the run log.
+    The func argument given by the DEAP algorithm is ignored.
+    Attributes:
+      counts: status counts and simulated seconds per call.
+    """
+
+    def __init__(self, map_func, ExperAPSet, cache=None, timeout=None,
+                 condition_timeout=None, pacing=None):
+        self.map_func = map_func
+        self.ExperAPSet = ExperAPSet
+        self.cache = cache
+        self.timeout = timeout
+        self.condition_timeout = condition_timeout
+        self.pacing = pacing
+        self.counts = []
+
+    def __call__(self, func, inds):
+        results = list(self.map_func(partial(fitness_status, ExperAPSet=self.ExperAPSet,
+                                             cache=self.cache, timeout=self.timeout,
+                                             condition_timeout=self.condition_timeout,
+                                             pacing=self.pacing), inds))
+        counts = {'ok': 0, 'failure': 0, 'timeout': 0, 'simulated_s': 0.0}
+        for total, status, simulated_s in results:
+            counts[status] += 1
+            counts['simulated_s'] += simulated_s
+        self.counts.append(counts)
+        print('Evaluations: '+str(counts))
+        return [(total,) for total, status, simulated_s in results]
+
+    def get_state(self):
+        return {'counts': self.counts}
+
+    def set_state(self, state):
+        self.counts = state['counts']
+
+
+@telemetry.evaluation('fitness_batch')
+def fitness_batch(inds, ExperAPSet, cache=None, pacing=None):
+    """fitness_status() of a list of individuals simulated together by
+    batch_sim.run_population_dclamp. The cached individuals are not
+    simulated, the batch scores are cached apart from the single ones.
+    Returns [(total, status), ...] with status 'ok' or 'failure'."""
+    results = [None] * len(inds)
+    todo = list(range(len(inds)))
+    if cache is not None:
+        namespace = cell_namespace(ExperAPSet, pacing) + '|batch'
+        todo = []
+        for i in range(len(inds)):
+            scores = cache.get(inds[i], namespace, dc_ik1=ExperAPSet.dc_ik1)
+            if scores is not None:
+                results[i] = (sum(scores.values()), cached_status(scores))
+            else:
+                todo.append(i)
+    if (len(todo) == 0):
+        return results
+    model_APSets = run_population_dclamp([inds[i] for i in todo], dc_ik1=ExperAPSet.dc_ik1,
+                                         pacing=pacing)
+    for i, model_APSet in zip(todo, model_APSets):
+        scores = ExperAPSet.score(model_APSet)
+        if cache is not None:
+            cache.put(inds[i], namespace, scores, dc_ik1=ExperAPSet.dc_ik1)
+        status = 'failure' if (model_APSet is None or model_APSet[1]) else 'ok'
+        results[i] = (sum(scores.values()), status)
+    return results
+
+
+class BatchMap:
+    """Replacement for toolbox.map that splits the individuals into batches
+    of batch_size and evaluates each batch in one task with fitness_batch.
+    Fewer, larger tasks: use batches of 64 or more individuals, below that
+    the batched integration is slower than the single model. The batch
+    runs the NumPy right-hand side and only beats the python backend; the
+    compiled single model (--backend numba) is faster than either.
+    The func argument given by the DEAP algorithm is ignored.
+    Attributes:
+      counts: status counts per call.
+    """
+
+    def __init__(self, map_func, ExperAPSet, batch_size, cache=None, pacing=None):
+        self.map_func = map_func
+        self.ExperAPSet = ExperAPSet
+        self.batch_size = batch_size
+        self.cache = cache
+        self.pacing = pacing
+        self.counts = []
+
+    def __call__(self, func, inds):
+        inds = list(inds)
+        batches = [inds[i:i+self.batch_size] for i in range(0, len(inds), self.batch_size)]
+        results = []
+        for batch in self.map_func(partial(fitness_batch, ExperAPSet=self.ExperAPSet,
+                                           cache=self.cache, pacing=self.pacing), batches):
+            results.extend(batch)
+        counts = {'ok': 0, 'failure': 0}
+        for total, status in results:
+            counts[status] += 1
+        self.counts.append(counts)
+        print('Evaluations: '+str(counts))
+        return [(total,) for total, status in results]
+
+    def get_state(self):
+        return {'counts': self.counts}
+
+    def set_state(self, state):
+        self.counts = state['counts']
+
+
+@telemetry.evaluation('fitness_cntrl')
+def fitness_cntrl(ind, ExperAPSet, nai=10.0, ki=130.0, timeout=None,
+                  condition_timeout=None, pacing=None):
+    """Control stage of the split evaluation.
+    Returns (cntrl score, y_ishi_final, status, seconds), the score and
+    state are None if the status is 'failure' or 'timeout'. seconds is the
+    wall-clock time of the stage, taken from the budget of the individual."""
+    start = time.monotonic()
+    budget = TimeBudget(timeout, condition_timeout)
+    try:
+        last_ap, y_ishi_final, ap_failure = run_ind_cntrl(ind, dc_ik1=ExperAPSet.dc_ik1,
+                                                          nai=nai, ki=ki, budget=budget,
+                                                          pacing=pacing)
+    except SimulationTimeout:
+        print('Simulation timeout: '+str(list(ind)))
+        return None, None, 'timeout', time.monotonic() - start
+    if ap_failure:
+        return None, None, 'failure', time.monotonic() - start
+    score = 0.0
+    if 'cntrl' in ExperAPSet.AP_set:
+        score = ExperAPSet.score_ap('cntrl', last_ap)
+    return score, y_ishi_final, 'ok', time.monotonic() - start
+
+
+@telemetry.evaluation('fitness_perturbation')
+def fitness_perturbation(task):
+    """Perturbation stage of the split evaluation. The task is the tuple
+    (ind, key, y_ishi_final, ExperAPSet, nai, ki, timeout, condition_timeout,
+    pacing), timeout is what is left of the budget of the individual.
+    Returns (condition score, status), the score is None if the status
+    is 'failure' or 'timeout'."""
+    ind, key, y_initial, ExperAPSet, nai, ki, timeout, condition_timeout, pacing = task
+    budget = TimeBudget(timeout, condition_timeout)
+    try:
+        last_ap, ap_failure = run_ind_perturbation(ind, key, y_initial,
+                                                   dc_ik1=ExperAPSet.dc_ik1,
+                                                   nai=nai, ki=ki, budget=budget,
+                                                   pacing=pacing)
+    except SimulationTimeout:
+        print('Simulation timeout: '+key+' '+str(list(ind)))
+        return None, 'timeout'
+    if ap_failure:
+        return None, 'failure'
+    if key in ExperAPSet.AP_set:
+        return ExperAPSet.score_ap(key, last_ap), 'ok'
+    return 0.0, 'ok'
+
+
+class SplitConditionMap:
+    """Replacement for toolbox.map that schedules the dynamic-clamp
+    conditions of each individual as separate pool tasks.
+    The control pacing of every individual is mapped first, then the
+    (individual, condition) perturbation runs are mapped together starting
+    from each individual's y_ishi_final. The condition scores are put back
+    together per individual, so the fitness is the same as fitness().
+    Cached individuals (EvaluationCache) are not simulated. Each task is
+    limited to condition_timeout seconds. The timeout of an individual
+    bounds its control plus each of its perturbation tasks: the
+    perturbations run in parallel and get the budget the control left.
+    The func argument given by the DEAP algorithm is ignored.
+    Attributes:
+      counts: number of 'ok', 'failure' and 'timeout' evaluations per call.
+    """
+
+    def __init__(self, map_func, ExperAPSet, nai=10.0, ki=130.0, cache=None,
+                 timeout=None, condition_timeout=None, pacing=None):
+        self.map_func = map_func
+        self.ExperAPSet = ExperAPSet
+        self.nai = nai
+        self.ki = ki
+        self.cache = cache
+        self.timeout = timeout
+        self.condition_timeout = condition_timeout
+        self.pacing = pacing
+        self.counts = []
+
+    def __call__(self, func, inds):
+        inds = list(inds)
+        ap_keys = list(self.ExperAPSet.AP_set.keys())
+        failed = dict.fromkeys(ap_keys, ExperimentalAPSet.MAX_SCORE)
+        scores = [None] * len(inds)
+        if self.cache is not None:
+            namespace = cell_namespace(self.ExperAPSet, self.pacing)
+            for i in range(len(inds)):
+                scores[i] = self.cache.get(inds[i], namespace, dc_ik1=self.ExperAPSet.dc_ik1,
+                                           nai=self.nai, ki=self.ki)
+        todo = [i for i in range(len(inds)) if scores[i] is None]
+
+        cntrl = list(self.map_func(partial(fitness_cntrl, ExperAPSet=self.ExperAPSet,
+                                           nai=self.nai, ki=self.ki, timeout=self.timeout,
+                                           condition_timeout=self.condition_timeout,
+                                           pacing=self.pacing),
+                                   [inds[i] for i in todo]))
+
+        # Only individuals with a control AP go on to the perturbations.
+        timed_out = set()
+        tasks = []
+        owners = []
+        for i, (score, y_ishi_final, status, seconds) in zip(todo, cntrl):
+            if score is None:
+                scores[i] = failed
+                if (status == 'timeout'):
+                    timed_out.add(i)
+                continue
+            scores[i] = {}
+            if 'cntrl' in ap_keys:
+                scores[i]['cntrl'] = score
+            timeout = None if self.timeout is None else self.timeout - seconds
+            for key in PERTURBATIONS.keys():
+                tasks.append((inds[i], key, y_ishi_final, self.ExperAPSet, self.nai, self.ki,
+                              timeout, self.condition_timeout, self.pacing))
+                owners.append(i)
+        results = self.map_func(fitness_perturbation, tasks)
+
+        for i, task, (score, status) in zip(owners, tasks, results):
+            if (status == 'timeout'):
+                timed_out.add(i)
+            if scores[i] is failed:
+                continue
+            if score is None:
+                scores[i] = failed
+            elif task[1] in ap_keys:
+                scores[i][task[1]] = score
+
+        counts = {'ok': 0, 'failure': 0, 'timeout': 0}
+        for i in range(len(inds)):
+            if (i in timed_out):
+                counts['timeout'] += 1
+            elif scores[i] is failed:
+                counts['failure'] += 1
+            else:
+                counts['ok'] += 1
+        self.counts.append(counts)
+        print('Evaluations: '+str(counts))
+        if self.cache is not None:
+            for i in todo:
+                if i not in timed_out:
+                    self.cache.put(inds[i], namespace, scores[i],
+                                   dc_ik1=self.ExperAPSet.dc_ik1, nai=self.nai, ki=self.ki)
+        return [(sum(s.values()),) for s in scores]
+
+    def get_state(self):
+        return {'counts': self.counts}
+
+    def set_state(self, state):
+        self.counts = state['counts']
+
+
+@telemetry.evaluation('fitness_racing')
+def fitness_racing(ind, ExperAPSet, threshold=np.inf, nai=10.0, ki=130.0, cache=None,
+                   timeout=None, condition_timeout=None, pacing=None):
+    """Racing evaluation: the conditions are simulated and scored one at a
+    time. The evaluation stops at the first AP Failure, or once the partial
+    sum of RMSD reaches threshold and the individual cannot enter the top MU.
+    Returns (total, status) with status 'ok', 'failure', 'aborted' or
+    'timeout' (scored as an AP Failure, see fitness_status). An aborted
+    individual gets the deterministic penalty
+      partial sum + MAX_SCORE * (number of unscored APs)
+    which is never better than the fitness of a completed evaluation."""
+    ap_keys = list(ExperAPSet.AP_set.keys())
+    failed = dict.fromkeys(ap_keys, ExperimentalAPSet.MAX_SCORE)
+    if cache is not None:
+        namespace = cell_namespace(ExperAPSet, pacing)
+        scores = cache.get(ind, namespace, dc_ik1=ExperAPSet.dc_ik1, nai=nai, ki=ki)
+        if scores is not None:
+            return sum(scores.values()), cached_status(scores)
+
+    def penalty(scores):
+        return sum(scores.values()) + \
+            ExperimentalAPSet.MAX_SCORE * (len(ap_keys) - len(scores))
+
+    def failure():
+        if cache is not None:
+            cache.put(ind, namespace, failed, dc_ik1=ExperAPSet.dc_ik1, nai=nai, ki=ki)
+        return sum(failed.values()), 'failure'
+
+    scores = {}
+    budget = TimeBudget(timeout, condition_timeout)
+    try:
+        last_ap, y_ishi_final, ap_failure = run_ind_cntrl(ind, dc_ik1=ExperAPSet.dc_ik1,
+                                                          nai=nai, ki=ki, budget=budget,
+                                                          pacing=pacing)
+        if ap_failure:
+            return failure()
+        if 'cntrl' in ap_keys:
+            scores['cntrl'] = ExperAPSet.score_ap('cntrl', last_ap)
+            if (sum(scores.values()) >= threshold):
+                return penalty(scores), 'aborted'
+
+        for key in PERTURBATIONS.keys():
+            last_ap, ap_failure = run_ind_perturbation(ind, key, y_ishi_final,
+                                                       dc_ik1=ExperAPSet.dc_ik1,
+                                                       nai=nai, ki=ki, budget=budget,
+                                                       pacing=pacing)
+            if ap_failure:
+                return failure()
+            if key in ap_keys:
+                scores[key] = ExperAPSet.score_ap(key, last_ap)
+                if (sum(scores.values()) >= threshold):
+                    return penalty(scores), 'aborted'
+    except SimulationTimeout:
+        print('Simulation timeout: '+str(list(ind)))
+        return sum(failed.values()), 'timeout'
+
+    if cache is not None:
+        cache.put(ind, namespace, scores, dc_ik1=ExperAPSet.dc_ik1, nai=nai, ki=ki)
+    return sum(scores.values()), 'ok'
+
+
+class RacingMap:
+    """Replacement for toolbox.map that evaluates individuals with
+    fitness_racing. The threshold sent to the workers is slack times the
+    MU-th best complete fitness seen so far (aborted and timed out
+    evaluations are not complete), updated after every call. Until MU
+    complete fitnesses were seen, e.g. in the first generation or over the
+    first calls of batches smaller than MU, there is no threshold.
+    The func argument given by the DEAP algorithm is ignored.
+    Attributes:
+      threshold: current abort threshold.
+      best: mu best (fitness, individual) of the complete evaluations.
+      counts: number of 'ok', 'failure', 'aborted' and 'timeout' evaluations
+              per call.
+    """
+
+    def __init__(self, map_func, ExperAPSet, mu, slack=1.0, nai=10.0, ki=130.0,
+                 cache=None, timeout=None, condition_timeout=None, pacing=None):
+        self.map_func = map_func
+        self.ExperAPSet = ExperAPSet
+        self.mu = mu
+        self.slack = slack
+        self.nai = nai
+        self.ki = ki
+        self.cache = cache
+        self.timeout = timeout
+        self.condition_timeout = condition_timeout
+        self.pacing = pacing
+        self.threshold = np.inf
+        self.best = []
+        self.counts = []
+        self.warned = False
+
+    def __call__(self, func, inds):
+        inds = list(inds)
+        if (len(inds) < self.mu and not self.warned):
+            print('Racing: batches of '+str(len(inds))+' < MU individuals, the threshold '
+                  'is set once '+str(self.mu)+' complete evaluations were seen.')
+            self.warned = True
+        results = list(self.map_func(partial(fitness_racing, ExperAPSet=self.ExperAPSet,
+                                             threshold=self.threshold, nai=self.nai,
+                                             ki=self.ki, cache=self.cache,
+                                             timeout=self.timeout,
+                                             condition_timeout=self.condition_timeout,
+                                             pacing=self.pacing),
+                                     inds))
+        counts = {'ok': 0, 'failure': 0, 'aborted': 0, 'timeout': 0}
+        for ind, (total, status) in zip(inds, results):
+            counts[status] += 1
+            if (status in ('ok', 'failure')):
+                self.add_complete(ind, total)
+        self.counts.append(counts)
+        print('Racing threshold: '+str(self.threshold)+' '+str(counts))
+
+        if (len(self.best) >= self.mu):
+            self.threshold = self.slack * self.best[-1][0]
+        return [(total,) for total, status in results]
+
+    def add_complete(self, ind, total):
+        key = tuple(ind)
+        if all(key != k for f, k in self.best):
+            self.best.append((total, key))
+            self.best.sort()
+            del self.best[self.mu:]
+
+    def get_state(self):
+        return {'threshold': self.threshold, 'best': self.best, 'counts': self.counts}
+
+    def set_state(self, state):
+        self.threshold = state['threshold']
+        self.best = state.get('best', [])
+        self.counts = state['counts']
+
+
+@telemetry.evaluation('fitness_conditions')
+def fitness_conditions(task):
+    """Stage of the multi-fidelity evaluation. The task is the tuple
+    (ind, keys, y_initial, ExperAPSet, nai, ki, timeout, condition_timeout,
+    pacing), the conditions keys are run from y_initial or after the control
+    if y_initial is None (see run_ind_conditions). timeout is what is left
+    of the budget of the individual.
+    Returns (scores, y_ishi_final, status, seconds), the scores of the
+    conditions that were run are None if the status is 'failure' or
+    'timeout'. seconds is the wall-clock time of the stage."""
+    ind, keys, y_initial, ExperAPSet, nai, ki, timeout, condition_timeout, pacing = task
+    start = time.monotonic()
+    budget = TimeBudget(timeout, condition_timeout)
+    try:
+        result = run_ind_conditions(ind, keys, y_initial, dc_ik1=ExperAPSet.dc_ik1,
+                                    nai=nai, ki=ki, budget=budget, pacing=pacing)
+    except SimulationTimeout:
+        print('Simulation timeout: '+str(list(ind)))
+        return None, None, 'timeout', time.monotonic() - start
+    if (result is None or result[2]):
+        return None, None, 'failure', time.monotonic() - start
+    ap_set, y_ishi_final, ap_failure = result
+    scores = {}
+    for key, last_ap in ap_set.items():
+        if key in ExperAPSet.AP_set:
+            scores[key] = ExperAPSet.score_ap(key, last_ap)
+    return scores, y_ishi_final, 'ok', time.monotonic() - start
+
+
+class MultiFidelityMap:
+    """Replacement for toolbox.map with a two-level evaluation.
+    Level 1 simulates the control and the n_cheap perturbations in keys for
+    every individual. Level 2 simulates the remaining perturbations, from
+    the control steady state of level 1, for the best promote_frac of the
+    partial sums and for every individual whose partial sum is below the
+    worst of the hof_size best complete fitnesses seen so far (the complete
+    sum can only be larger, so the others cannot enter the Hall of Fame).
+    An individual that is not promoted gets its partial sum times the
+    median complete/partial ratio of the promoted ones, which keeps its
+    fitness on the scale of the complete sum, and is marked ind.predicted
+    so eaMuCommaLambdaCheckpoint keeps it out of the Hall of Fame. AP
+    Failures found on level 1 are exact. The timeout of an individual bounds
+    its two levels together.
+    The first call evaluates everything completely. Unless keys is given,
+    the perturbations whose scores rank the complete fitness best
+    (Spearman correlation over the complete evaluations) are chosen again
+    after every call.
+    The func argument given by the DEAP algorithm is ignored.
+    Attributes:
+      keys: perturbations of level 1 (None until the first call).
+      ratio: current complete/partial ratio.
+      best: hof_size best complete fitnesses seen.
+      counts: number of 'complete', 'estimated', 'failure' and 'timeout'
+              evaluations per call.
+    """
+
+    def __init__(self, map_func, ExperAPSet, promote_frac=0.3, keys=None, n_cheap=2,
+                 hof_size=1, nai=10.0, ki=130.0, cache=None, timeout=None,
+                 condition_timeout=None, pacing=None, max_archive=2000):
+        self.map_func = map_func
+        self.ExperAPSet = ExperAPSet
+        self.promote_frac = promote_frac
+        self.fixed_keys = keys
+        self.keys = keys
+        self.n_cheap = n_cheap
+        self.hof_size = hof_size
+        self.nai = nai
+        self.ki = ki
+        self.cache = cache
+        self.timeout = timeout
+        self.condition_timeout = condition_timeout
+        self.pacing = pacing
+        self.max_archive = max_archive
+        self.ratio = None
+        self.best = []
+        self.archive = []
+        self.counts = []
+
+    def task(self, ind, keys, y_initial=None, seconds=0.0):
+        """Stage task of ind, seconds of its budget were used on level 1."""
+        timeout = None if self.timeout is None else self.timeout - seconds
+        return (ind, keys, y_initial, self.ExperAPSet, self.nai, self.ki,
+                timeout, self.condition_timeout, self.pacing)
+
+    def bound(self):
+        if (len(self.best) < self.hof_size):
+            return np.inf
+        return self.best[-1][0]
+
+    def __call__(self, func, inds):
+        inds = list(inds)
+        ap_keys = list(self.ExperAPSet.AP_set.keys())
+        failed = dict.fromkeys(ap_keys, ExperimentalAPSet.MAX_SCORE)
+        counts = {'complete': 0, 'estimated': 0, 'failure': 0, 'timeout': 0}
+        scores = [None] * len(inds)
+        if self.cache is not None:
+            namespace = cell_namespace(self.ExperAPSet, self.pacing)
+            for i in range(len(inds)):
+                scores[i] = self.cache.get(inds[i], namespace, dc_ik1=self.ExperAPSet.dc_ik1,
+                                           nai=self.nai, ki=self.ki)
+        todo = [i for i in range(len(inds)) if scores[i] is None]
+        timed_out = set()
+
+        # Level 1: control and cheap perturbations (everything on the first call).
+        keys1 = list(PERTURBATIONS.keys()) if self.keys is None else self.keys
+        rest = [key for key in PERTURBATIONS.keys() if key not in keys1]
+        level1 = self.map_func(fitness_conditions, [self.task(inds[i], keys1) for i in todo])
+        partial_scores = {}
+        states = {}
+        spent = {}
+        for i, (part, y_ishi_final, status, seconds) in zip(todo, level1):
+            if part is None:
+                scores[i] = failed
+                if (status == 'timeout'):
+                    timed_out.add(i)
+            elif (len(rest) == 0):
+                scores[i] = part
+            else:
+                partial_scores[i] = part
+                states[i] = y_ishi_final
+                spent[i] = seconds
+
+        # Level 2: the rest of the perturbations for the promoted individuals.
+        ranked = sorted(partial_scores, key=lambda i: sum(partial_scores[i].values()))
+        n_promote = int(np.ceil(self.promote_frac * len(ranked)))
+        bound = self.bound()
+        promoted = [i for n, i in enumerate(ranked)
+                    if n < n_promote or sum(partial_scores[i].values()) < bound]
+        level2 = self.map_func(fitness_conditions, [self.task(inds[i], rest, states[i], spent[i])
+                                                    for i in promoted])
+        ratios = []
+        for i, (part, y_ishi_final, status, seconds) in zip(promoted, level2):
+            if part is None:
+                scores[i] = failed
+                if (status == 'timeout'):
+                    timed_out.add(i)
+                continue
+            scores[i] = dict(partial_scores[i], **part)
+            if (sum(partial_scores[i].values()) > 0.0):
+                ratios.append(sum(scores[i].values()) / sum(partial_scores[i].values()))
+        if ratios:
+            self.ratio = float(np.median(ratios))
+        elif self.ratio is None:
+            self.ratio = len(ap_keys) / max(len(keys1) + 1, 1)
+
+        results = []
+        for i, ind in enumerate(inds):
+            if scores[i] is None:
+                results.append((sum(partial_scores[i].values()) * self.ratio,))
+                ind.predicted = True
+                counts['estimated'] += 1
+                continue
+            ind.predicted = False
+            if (i in timed_out):
+                counts['timeout'] += 1
+            elif scores[i] is failed:
+                counts['failure'] += 1
+            else:
+                counts['complete'] += 1
+            results.append((sum(scores[i].values()),))
+            self.add_complete(ind, scores[i])
+            if (self.cache is not None and i in todo and i not in timed_out):
+                self.cache.put(ind, namespace, scores[i], dc_ik1=self.ExperAPSet.dc_ik1,
+                               nai=self.nai, ki=self.ki)
+        self.counts.append(counts)
+        if self.fixed_keys is None:
+            self.choose_keys()
+        print('Multi-fidelity: '+str(counts)+' next keys '+str(self.keys))
+        return results
+
+    def add_complete(self, ind, scores):
+        total = sum(scores.values())
+        key = tuple(ind)
+        if all(key != k for f, k in self.best):
+            self.best.append((total, key))
+            self.best.sort()
+            del self.best[self.hof_size:]
+        if (total < ExperimentalAPSet.MAX_SCORE):
+            self.archive.append(scores)
+            del self.archive[:-self.max_archive]
+
+    def choose_keys(self):
+        """Choose the n_cheap perturbations whose scores correlate best with
+        the complete fitness."""
+        keys = [key for key in PERTURBATIONS.keys() if key in self.ExperAPSet.AP_set]
+        if (len(self.archive) < 10 or len(keys) <= self.n_cheap):
+            if (self.keys is None):
+                self.keys = keys[:self.n_cheap]
+            return
+        totals = [sum(s.values()) for s in self.archive]
+        rho = {}
+        for key in keys:
+            r = spearmanr([s.get(key, 0.0) for s in self.archive], totals)[0]
+            rho[key] = -1.0 if np.isnan(r) else r
+        self.keys = sorted(keys, key=lambda k: -rho[k])[:self.n_cheap]
+
+    def get_state(self):
+        return {'keys': self.keys, 'ratio': self.ratio, 'best': self.best,
+                'archive': self.archive, 'counts': self.counts}
+
+    def set_state(self, state):
+        self.keys = state['keys']
+        self.ratio = state['ratio']
+        self.best = state['best']
+        self.archive = state['archive']
+        self.counts = state['counts']
 
 
 def mutateES(ind, indpb=0.3):
@@ -74,37 +883,12 @@ def cxESBlend(ind1, ind2, alpha):
     return ind1, ind2
 
 
-# Add bash arguments eventually. main() #
-def main():
-    """This function applies the DEAP algorithm (mu,lambda) to fit
-    the Kernik-Clancy model to an experimental AP data set.
-    The 14 membrane conductance parameters are optimized.
-    The fitness is defined as the sum of RMSD from each AP."""
-
-    # Clock the start time.
-    now = datetime.now()
-    dt = now.strftime("%m%d%y_%H%M%S")
-    print('Run start time: '+dt)
-    
-    NUM_PARAMS = 14
-
-    PARAM_NAMES = ['phi', 'G_K1', 'G_Kr', 'G_Ks', 'G_to', 'P_CaL',
-                   'G_CaT', 'G_Na', 'G_F', 'K_NaCa', 'P_NaK',
-                   'G_b_Na', 'G_b_Ca', 'G_PCa']
-    
-    # Load in experimental AP set
-    # Cell 2 recorded 12/24/20 Ishihara dynamic-clamp 1.0 pA/pF
-    path_to_aps = '/home/drew/projects/iPSC_EA_Fitting_Sep2021/cell_2/AP_set'
-    cell_2 = ExperimentalAPSet(path=path_to_aps, file_prefix='cell_2_',
-                               file_suffix='_SAP.txt', cell_id=2, dc_ik1=1.0)
-
-    # Define classes for EA with DEAP libaries. #
-    creator.create("FitnessMin", base.Fitness, weights=(-1.0,))
-    creator.create("Individual", arr.array, typecode="d",
-                   fitness=creator.FitnessMin, strategy=None)
-    creator.create("Strategy", arr.array, typecode="d")
-
-    # Create a toolbox to store the EA objects and functions.
+def build_toolbox(ExperAPSet, cache=None, timeout=None, condition_timeout=None,
+                  pacing=None, array_ops=False):
+    """Create a toolbox to store the EA objects and functions.
+    The map is left to the caller (toolbox.register("map", ...)).
+    With array_ops the population is initialized, bred (toolbox.vary) and
+    selected by the batched operators of es_array."""
     toolbox = base.Toolbox()
 
     # The (mu,lambda)_EA the toolbox must contain: mate, mutate, select, evaluate.
@@ -117,65 +901,484 @@ def main():
     toolbox.register("mutate", mutateES)
 
     # Selection
-    toolbox.register("evaluate", fitness, ExperAPSet=cell_2)
+    toolbox.register("evaluate", fitness, ExperAPSet=ExperAPSet, cache=cache,
+                     timeout=timeout, condition_timeout=condition_timeout, pacing=pacing)
     toolbox.register("select", tools.selTournament, tournsize=3)
 
-    # Register some statistical functions to the toolbox.
+    if array_ops:
+        toolbox.register("population", initPopulationArray, ind_clss=creator.Individual,
+                         strategy_clss=creator.Strategy, size=NUM_PARAMS)
+        toolbox.register("vary", varOrArray, indpb=0.3, alpha=0.3)
+        toolbox.register("select", selTournamentArray, tournsize=3)
+    return toolbox
+
+
+def build_stats():
+    """Register some statistical functions for the logbook."""
     stats = tools.Statistics(lambda ind: ind.fitness.values)
     stats.register("avg", np.mean)
     stats.register("std", np.std)
     stats.register("min", np.min)
     stats.register("max", np.max)
+    return stats
 
-    # To speed things up with multi-threading
-    p = Pool()
-    toolbox.register("map", p.map)
 
-    #  Algorithm specific settings
-    MU = 100  # Population size at the end of each generation including gen(0)
-    LAMBDA = 150  # Number of new individuals generated per generation
-    N_GEN = 10
-    N_HOF = int((0.1) * MU * N_GEN)
-    #N_HOF = 2
-
-    hof = tools.HallOfFame(N_HOF)
+def write_outputs(prefix, dt, pop, hof, logbook):
+    """Write the logbook, final population, fitness, strategy and Hall of
+    Fame files of a run. prefix is prepended to the file names (e.g. a
+    per-cell directory)."""
     hof_fitness = []
     pop_fitness = []
     pop_strategy = []
-    pop = toolbox.population(n=MU)
-    pop_first_df = pd.DataFrame(pop, columns=PARAM_NAMES)
-    pop_first_df.to_csv('pop_first_'+dt+'.txt', sep=' ', index=False)
-
-    print('(mu,lambda): ('+str(MU)+','+str(LAMBDA)+')')
-    
-    pop, logbook = algorithms.eaMuCommaLambda(pop, toolbox, mu=MU, lambda_=LAMBDA,
-                                              cxpb=0.6, mutpb=0.3, ngen=N_GEN, stats=stats,
-                                              halloffame=hof, verbose=False)
-
-    now = datetime.now()
-    dt = now.strftime("%m%d%y_%H%M%S")
-    print('Run end time: '+dt)
     logbook_df = pd.DataFrame(logbook)
-    logbook_df.to_csv('logbook_'+dt+'.txt', sep=' ', index=False)
+    logbook_df.to_csv(prefix+'logbook_'+dt+'.txt', sep=' ', index=False)
 
     pop_df = pd.DataFrame(pop, columns=PARAM_NAMES)
-    pop_df.to_csv('pop_final_'+dt+'.txt', sep=' ', index=False)
+    pop_df.to_csv(prefix+'pop_final_'+dt+'.txt', sep=' ', index=False)
 
     hof_df = pd.DataFrame(hof, columns=PARAM_NAMES)
-    hof_df.to_csv('hof_'+dt+'.txt', sep=' ', index=False)
+    hof_df.to_csv(prefix+'hof_'+dt+'.txt', sep=' ', index=False)
 
     for i in hof:
         hof_fitness.append(i.fitness.values[0])
     hof_fitness_pd = pd.DataFrame(hof_fitness, columns=["fitness"])
-    hof_fitness_pd.to_csv('hof_fitness_'+dt+'.txt', sep=' ', index=False)
+    hof_fitness_pd.to_csv(prefix+'hof_fitness_'+dt+'.txt', sep=' ', index=False)
 
     for i in pop:
         pop_fitness.append(i.fitness.values[0])
         pop_strategy.append(i.strategy)
     pop_fitness_df = pd.DataFrame(pop_fitness, columns=["fitness"])
-    pop_fitness_df.to_csv('pop_fitness_'+dt+'.txt', sep=' ', index=False)
+    pop_fitness_df.to_csv(prefix+'pop_fitness_'+dt+'.txt', sep=' ', index=False)
     pop_strategy_df = pd.DataFrame(pop_strategy, columns=PARAM_NAMES)
-    pop_strategy_df.to_csv('pop_strategy_'+dt+'.txt', sep=' ', index=False)
+    pop_strategy_df.to_csv(prefix+'pop_strategy_'+dt+'.txt', sep=' ', index=False)
+
+
+def create_deap_classes():
+    """Define the DEAP creator classes. Also used as the setup of remote
+    broker workers (executors.py worker --setup iPSC_DEAP_fit:create_deap_classes)
+    so they can unpickle individuals."""
+    if not hasattr(creator, 'Individual'):
+        creator.create("FitnessMin", base.Fitness, weights=(-1.0,))
+        creator.create("Individual", arr.array, typecode="d",
+                       fitness=creator.FitnessMin, strategy=None)
+        creator.create("Strategy", arr.array, typecode="d")
+
+
+def register_seeding(toolbox, args, island=0, n_islands=1):
+    """Build toolbox.population from the --seed-from files of earlier runs.
+    The islands get every n_islands-th of the ranked seeds."""
+    if args.seed_from is not None:
+        toolbox.register("population", seed_population, filenames=args.seed_from,
+                         param_names=PARAM_NAMES, ind_clss=creator.Individual,
+                         strategy_clss=creator.Strategy, generate=toolbox.individual,
+                         top_k=args.seed_top_k, dedup_tol=args.seed_dedup_tol,
+                         jitter=args.seed_jitter, part=island, n_parts=n_islands)
+
+
+def island_setup(island, ExperAPSet, args, cache=None, pacing=None):
+    """Toolbox, statistics and executor of one island of eaIslands, called
+    in the island process. args.workers is the size of its group."""
+    create_deap_classes()
+    toolbox = build_toolbox(ExperAPSet, cache=cache, timeout=args.timeout,
+                            condition_timeout=args.condition_timeout, pacing=pacing,
+                            array_ops=args.array_ops)
+    register_seeding(toolbox, args, island, args.islands)
+    if args.ship_ap_set:
+        p = make_executor(args, setup='iPSC_DEAP_fit:create_deap_classes')
+    else:
+        ExperAPSet.by_reference = True
+        p = make_executor(args, initializer=init_worker, initargs=(ExperAPSet.spec(),),
+                          setup='iPSC_DEAP_fit:create_deap_classes')
+    if (args.timeout is not None or args.condition_timeout is not None
+            or args.adaptive_pacing):
+        toolbox.register("map", StatusMap(p.map, ExperAPSet, cache=cache, timeout=args.timeout,
+                                          condition_timeout=args.condition_timeout,
+                                          pacing=pacing))
+    else:
+        toolbox.register("map", p.map)
+    return toolbox, build_stats(), p
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Fit the Kernik-Clancy model '
+                                     'to a dynamic-clamp AP set with (mu,lambda) ES.')
+    parser.add_argument('--split-conditions', action='store_true',
+                        help='schedule the dynamic-clamp conditions of each '
+                        'individual as separate pool tasks')
+    parser.add_argument('--cache', default=None,
+                        help='SQLite evaluation cache shared across generations and runs')
+    parser.add_argument('--cache-tol', type=float, default=1e-4,
+                        help='relative tolerance of the cache key')
+    parser.add_argument('--cache-max-entries', type=int, default=None,
+                        help='evict least recently used entries above this size')
+    parser.add_argument('--racing', action='store_true',
+                        help='stop evaluating individuals that cannot reach the top MU')
+    parser.add_argument('--racing-slack', type=float, default=1.0,
+                        help='multiplier on the racing threshold')
+    parser.add_argument('--checkpoint-dir', default=None,
+                        help='write a checkpoint of every generation to this directory')
+    parser.add_argument('--resume', default=None, metavar='RUN',
+                        help='resume from this checkpoint file, or from the last checkpoint '
+                        'in --checkpoint-dir of the run with this id (its start time)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed of the Python and NumPy RNGs')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='wall-clock budget (s) of one evaluation')
+    parser.add_argument('--condition-timeout', type=float, default=None,
+                        help='wall-clock budget (s) of each dynamic-clamp condition')
+    parser.add_argument('--surrogate', action='store_true',
+                        help='pre-screen offspring with a random-forest surrogate')
+    parser.add_argument('--surrogate-real', type=int, default=None,
+                        help='real evaluations per generation (default LAMBDA/3)')
+    parser.add_argument('--surrogate-oversample', type=int, default=1,
+                        help='offspring bred per LAMBDA slot')
+    parser.add_argument('--surrogate-explore', type=float, default=0.2,
+                        help='fraction of real evaluations spent on uncertain offspring')
+    parser.add_argument('--surrogate-mode', default='predict', choices=['predict', 'discard'],
+                        help='give unsimulated offspring the predicted fitness or discard them')
+    parser.add_argument('--telemetry', default=None,
+                        help='append per-evaluation timings and per-generation '
+                        'summaries to this JSONL file')
+    parser.add_argument('--multi-fidelity', action='store_true',
+                        help='score every offspring on the control and a few '
+                        'perturbations, complete only the promising ones')
+    parser.add_argument('--mf-promote', type=float, default=0.3,
+                        help='fraction of each generation promoted to the complete set')
+    parser.add_argument('--mf-keys', nargs='+', default=None,
+                        help='perturbations of the cheap level (default: chosen '
+                        'from the data every generation)')
+    parser.add_argument('--mf-n-cheap', type=int, default=2,
+                        help='number of perturbations of the cheap level')
+    parser.add_argument('--ship-ap-set', action='store_true',
+                        help='send the experimental AP set with every task instead of '
+                        'loading it once per worker from its path')
+    parser.add_argument('--async-es', action='store_true',
+                        help='asynchronous steady-state ES without a generation barrier')
+    parser.add_argument('--async-in-flight', type=int, default=os.cpu_count(),
+                        help='evaluations kept running in the asynchronous ES')
+    parser.add_argument('--async-max-age', type=int, default=None,
+                        help='drop parents older than this many evaluations')
+    parser.add_argument('--async-start-frac', type=float, default=1.0,
+                        help='fraction of the initial population evaluated before the '
+                        'asynchronous ES starts breeding')
+    parser.add_argument('--array-ops', action='store_true',
+                        help='breed and select with the batched NumPy operators '
+                        '(es_array), for large LAMBDA')
+    parser.add_argument('--refine-top', type=int, default=0,
+                        help='refine the best N Hall of Fame individuals by pattern '
+                        'search after the run')
+    parser.add_argument('--refine-budget', type=int, default=1000,
+                        help='evaluations of the refinement')
+    parser.add_argument('--refine-step', type=float, default=0.2,
+                        help='initial pattern search step (log parameters)')
+    parser.add_argument('--refine-min-step', type=float, default=0.01,
+                        help='pattern search step the refinement stops at')
+    parser.add_argument('--seed-from', nargs='+', default=None,
+                        help='build the initial population from these pop_final_*/hof_* '
+                        'files of earlier runs')
+    parser.add_argument('--seed-top-k', type=int, default=None,
+                        help='number of seeded individuals (default MU, per island with '
+                        '--islands), the rest is random')
+    parser.add_argument('--seed-dedup-tol', type=float, default=1e-3,
+                        help='seeds closer than this (log parameters) are duplicates')
+    parser.add_argument('--seed-jitter', type=float, default=0.0,
+                        help='log-normal jitter of the seeded parameters')
+    parser.add_argument('--elite-archive', action='store_true',
+                        help='keep the simulated APs of the Hall of Fame and write them '
+                        'to elite_traces_<time>.aps (write_hof_APs.py --from-archive)')
+    parser.add_argument('--islands', type=int, default=None,
+                        help='run this many sub-populations, each with its own '
+                        'group of workers, with periodic migration')
+    parser.add_argument('--migration-interval', type=int, default=5,
+                        help='generations between migrations with --islands')
+    parser.add_argument('--migrants', type=int, default=2,
+                        help='best individuals sent at each migration')
+    parser.add_argument('--migration-topology', default='ring', choices=['ring', 'random'],
+                        help='island the migrants are sent to')
+    parser.add_argument('--sim-batch-size', type=int, default=None,
+                        help='simulate the individuals together in batches of this '
+                        'size (batch_sim), one pool task per batch; NumPy only, not '
+                        'with --backend numba')
+    add_pacing_args(parser)
+    add_executor_args(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    """This function applies the DEAP algorithm (mu,lambda) to fit
+    the Kernik-Clancy model to an experimental AP data set.
+    The 14 membrane conductance parameters are optimized.
+    The fitness is defined as the sum of RMSD from each AP."""
+    args = parse_args(argv)
+    if (args.split_conditions and args.racing):
+        print('--split-conditions and --racing cannot be combined.')
+        return
+    if (args.multi_fidelity and (args.split_conditions or args.racing or args.surrogate
+                                 or args.async_es)):
+        print('--multi-fidelity cannot be combined with --split-conditions, --racing, '
+              '--surrogate or --async-es.')
+        return
+    if (args.mf_keys is not None and not set(args.mf_keys) <= set(PERTURBATIONS.keys())):
+        print('--mf-keys must be perturbations of '+str(list(PERTURBATIONS.keys()))+', got '
+              + str([key for key in args.mf_keys if key not in PERTURBATIONS]))
+        return
+    if (args.async_es and (args.split_conditions or args.racing or args.resume
+                           or args.surrogate or args.checkpoint_dir is not None)):
+        print('--async-es cannot be combined with --split-conditions, --racing, '
+              '--resume, --surrogate or --checkpoint-dir.')
+        return
+    if (args.sim_batch_size is not None and (args.split_conditions or args.racing
+                                             or args.multi_fidelity or args.async_es
+                                             or args.surrogate or args.timeout is not None
+                                             or args.condition_timeout is not None
+                                             or args.backend == 'numba')):
+        print('--sim-batch-size cannot be combined with --split-conditions, --racing, '
+              '--multi-fidelity, --async-es, --surrogate, --timeout, --condition-timeout '
+              'or --backend numba.')
+        return
+    if (args.elite_archive and (args.split_conditions or args.racing or args.multi_fidelity
+                                or args.async_es or args.sim_batch_size is not None
+                                or args.islands is not None)):
+        print('--elite-archive cannot be combined with --split-conditions, --racing, '
+              '--multi-fidelity, --async-es, --sim-batch-size or --islands.')
+        return
+    if (args.islands is not None and (args.split_conditions or args.racing
+                                      or args.multi_fidelity or args.async_es
+                                      or args.surrogate or args.resume
+                                      or args.checkpoint_dir is not None
+                                      or args.sim_batch_size is not None
+                                      or args.refine_top > 0 or args.executor == 'broker')):
+        print('--islands cannot be combined with --split-conditions, --racing, '
+              '--multi-fidelity, --async-es, --surrogate, --resume, --checkpoint-dir, '
+              '--sim-batch-size, --refine-top or the broker executor.')
+        return
+
+    # Clock the start time.
+    now = datetime.now()
+    dt = now.strftime("%m%d%y_%H%M%S")
+    print('Run start time: '+dt)
+
+    # Load in experimental AP set
+    # Cell 2 recorded 12/24/20 Ishihara dynamic-clamp 1.0 pA/pF
+    path_to_aps = '/home/drew/projects/iPSC_EA_Fitting_Sep2021/cell_2/AP_set'
+    cell_2 = ExperimentalAPSet(path=path_to_aps, file_prefix='cell_2_',
+                               file_suffix='_SAP.txt', cell_id=2, dc_ik1=1.0)
+
+    # Define classes for EA with DEAP libaries. #
+    create_deap_classes()
+
+    cache = None
+    if args.cache is not None:
+        cache = EvaluationCache(args.cache, tol=args.cache_tol,
+                                max_entries=args.cache_max_entries)
+    pacing = make_pacing(args)
+    toolbox = build_toolbox(cell_2, cache=cache, timeout=args.timeout,
+                            condition_timeout=args.condition_timeout, pacing=pacing,
+                            array_ops=args.array_ops)
+    register_seeding(toolbox, args)
+    stats = build_stats()
+
+    #  Algorithm specific settings
+    MU = 100  # Population size at the end of each generation including gen(0)
+    LAMBDA = 150  # Number of new individuals generated per generation
+    N_GEN = 10
+    N_HOF = int((0.1) * MU * N_GEN)
+    #N_HOF = 2
+
+    # Telemetry must be on before the workers start.
+    if args.telemetry is not None:
+        telemetry.enable(args.telemetry)
+        telemetry_start = telemetry.read_records(args.telemetry)[1]
+
+    if args.islands is not None:
+        # The population, offspring and workers are split between the islands.
+        n_workers = args.workers if args.workers is not None else os.cpu_count()
+        island_args = argparse.Namespace(**vars(args))
+        island_args.workers = max(1, n_workers // args.islands)
+        seed = args.seed if args.seed is not None else random.randrange(2**31)
+        print('Islands: '+str(args.islands)+' x (mu,lambda): ('+str(MU // args.islands)+','
+              + str(LAMBDA // args.islands)+')')
+        run_start = time.time()
+        pops, hofs, logbooks, hof = eaIslands(partial(island_setup, ExperAPSet=cell_2,
+                                                      args=island_args, cache=cache,
+                                                      pacing=pacing),
+                                              args.islands, mu=MU // args.islands,
+                                              lambda_=LAMBDA // args.islands, cxpb=0.6,
+                                              mutpb=0.3, ngen=N_GEN,
+                                              interval=args.migration_interval,
+                                              n_migrants=args.migrants,
+                                              topology=args.migration_topology,
+                                              hof_size=N_HOF, seed=seed)
+        if args.telemetry is not None:
+            telemetry.write_run_summary(telemetry_start, time.time() - run_start, n_workers)
+        now = datetime.now()
+        dt = now.strftime("%m%d%y_%H%M%S")
+        print('Run end time: '+dt)
+        if cache is not None:
+            cache.evict()
+            print('Evaluation cache: '+str(cache.stats()))
+        for i in range(args.islands):
+            write_outputs('island'+str(i)+'_', dt, pops[i], hofs[i], logbooks[i])
+        # Merged outputs: all final populations and the logbooks with an island column.
+        logbook = [dict(record, island=i) for i in range(args.islands) for record in logbooks[i]]
+        write_outputs('', dt, [ind for pop in pops for ind in pop], hof, logbook)
+        return
+
+    # To speed things up with multi-threading
+    if args.ship_ap_set:
+        p = make_executor(args, setup='iPSC_DEAP_fit:create_deap_classes')
+    else:
+        # The tasks carry a reference to cell_2, each worker loads it once.
+        cell_2.by_reference = True
+        p = make_executor(args, initializer=init_worker, initargs=(cell_2.spec(),),
+                          setup='iPSC_DEAP_fit:create_deap_classes')
+    if args.split_conditions:
+        toolbox.register("map", SplitConditionMap(p.map, cell_2, cache=cache,
+                                                  timeout=args.timeout,
+                                                  condition_timeout=args.condition_timeout,
+                                                  pacing=pacing))
+    elif args.multi_fidelity:
+        toolbox.register("map", MultiFidelityMap(p.map, cell_2, promote_frac=args.mf_promote,
+                                                 keys=args.mf_keys, n_cheap=args.mf_n_cheap,
+                                                 hof_size=N_HOF, cache=cache,
+                                                 timeout=args.timeout,
+                                                 condition_timeout=args.condition_timeout,
+                                                 pacing=pacing))
+    elif (args.sim_batch_size is not None):
+        toolbox.register("map", BatchMap(p.map, cell_2, args.sim_batch_size, cache=cache,
+                                         pacing=pacing))
+    elif args.racing:
+        toolbox.register("map", RacingMap(p.map, cell_2, MU, slack=args.racing_slack,
+                                          cache=cache, timeout=args.timeout,
+                                          condition_timeout=args.condition_timeout,
+                                          pacing=pacing))
+    elif args.elite_archive:
+        elite_map = EliteTraceMap(p.map, cell_2, cache=cache, timeout=args.timeout,
+                                  condition_timeout=args.condition_timeout, pacing=pacing)
+        toolbox.register("map", elite_map)
+    elif (args.timeout is not None or args.condition_timeout is not None
+          or args.adaptive_pacing):
+        # The statuses and simulated seconds of every generation go to the logbook.
+        toolbox.register("map", StatusMap(p.map, cell_2, cache=cache, timeout=args.timeout,
+                                          condition_timeout=args.condition_timeout,
+                                          pacing=pacing))
+    else:
+        toolbox.register("map", p.map)
+
+    surrogate = None
+    if args.surrogate:
+        n_real = args.surrogate_real
+        if n_real is None:
+            n_real = max(MU, LAMBDA // 3) if args.surrogate_mode == 'discard' else LAMBDA // 3
+        surrogate = SurrogateScreen(n_real, ExperimentalAPSet.MAX_SCORE * len(cell_2.AP_set),
+                                    oversample=args.surrogate_oversample,
+                                    explore_frac=args.surrogate_explore,
+                                    mode=args.surrogate_mode)
+
+    if args.resume:
+        filename = args.resume
+        checkpoint_dir = args.checkpoint_dir
+        if not os.path.isfile(filename):
+            if checkpoint_dir is None:
+                print('--resume with a run id needs --checkpoint-dir.')
+                return
+            filename = latest_checkpoint(checkpoint_dir, args.resume)
+            if filename is None:
+                print('No checkpoint of run '+args.resume+' found in '+checkpoint_dir)
+                return
+        elif checkpoint_dir is None:
+            checkpoint_dir = os.path.dirname(filename) or '.'
+        print('Resuming from '+filename)
+        state = load_checkpoint(filename)
+        pop = state['population']
+        hof = state['halloffame']
+        logbook = state['logbook']
+        start_gen = state['gen']
+        if (state['map_state'] is not None and hasattr(registered(toolbox.map), 'set_state')):
+            registered(toolbox.map).set_state(state['map_state'])
+        if (surrogate is not None and state.get('surrogate_state') is not None):
+            surrogate.set_state(state['surrogate_state'])
+        checkpointer = Checkpointer(checkpoint_dir, state['run_id'])
+    else:
+        if args.seed is not None:
+            random.seed(args.seed)
+            np.random.seed(args.seed)
+        hof = tools.HallOfFame(N_HOF)
+        logbook = None
+        start_gen = 0
+        pop = toolbox.population(n=MU)
+        pop_first_df = pd.DataFrame(pop, columns=PARAM_NAMES)
+        pop_first_df.to_csv('pop_first_'+dt+'.txt', sep=' ', index=False)
+        checkpointer = None
+        if args.checkpoint_dir is not None:
+            checkpointer = Checkpointer(args.checkpoint_dir, dt)
+
+    if args.elite_archive:
+        elite_map.hof = hof
+    print('(mu,lambda): ('+str(MU)+','+str(LAMBDA)+')')
+    n_workers = args.workers if args.workers is not None else os.cpu_count()
+    if (args.telemetry is not None and not args.async_es):
+        toolbox.register("map", telemetry.TelemetryMap(registered(toolbox.map), n_workers,
+                                                       gen=start_gen+1 if args.resume else 0))
+    run_start = time.time()
+
+    if args.async_es:
+        # The statuses give the timeouts and simulated seconds of the logbook.
+        toolbox.register("evaluate", fitness_values_status, ExperAPSet=cell_2, cache=cache,
+                         timeout=args.timeout, condition_timeout=args.condition_timeout,
+                         pacing=pacing)
+        # Same evaluation budget as the generational run.
+        pop, logbook = eaAsyncSteadyState(pop, toolbox, p, mu=MU, cxpb=0.6, mutpb=0.3,
+                                          n_evals=MU+N_GEN*LAMBDA,
+                                          in_flight=args.async_in_flight, stats=stats,
+                                          halloffame=hof, log_every=LAMBDA,
+                                          max_age=args.async_max_age,
+                                          start_frac=args.async_start_frac, with_status=True,
+                                          verbose=False)
+    else:
+        pop, logbook = eaMuCommaLambdaCheckpoint(pop, toolbox, mu=MU, lambda_=LAMBDA,
+                                                 cxpb=0.6, mutpb=0.3, ngen=N_GEN, stats=stats,
+                                                 halloffame=hof, verbose=False,
+                                                 checkpointer=checkpointer,
+                                                 start_gen=start_gen, logbook=logbook,
+                                                 surrogate=surrogate)
+
+    refine_history = None
+    if (args.refine_top > 0):
+        refine_history = refine_hof(hof, args.refine_top, p.map,
+                                    partial(fitness, ExperAPSet=cell_2, cache=cache,
+                                            timeout=args.timeout,
+                                            condition_timeout=args.condition_timeout,
+                                            pacing=pacing),
+                                    args.refine_budget, step=args.refine_step,
+                                    min_step=args.refine_min_step)
+        if (len(refine_history) > 0):
+            print('Refinement: '+str(refine_history[-1]['nevals'])+' evaluations, best '
+                  + str(min(refine_history[-1]['best'])))
+
+    p.close()
+    if args.telemetry is not None:
+        telemetry.write_run_summary(telemetry_start, time.time() - run_start, n_workers)
+    now = datetime.now()
+    dt = now.strftime("%m%d%y_%H%M%S")
+    print('Run end time: '+dt)
+    if cache is not None:
+        cache.evict()
+        print('Evaluation cache: '+str(cache.stats()))
+    write_outputs('', dt, pop, hof, logbook)
+    if refine_history:
+        refine_df = pd.DataFrame([[r['iteration'], r['nevals']] + r['best']
+                                  for r in refine_history],
+                                 columns=['iteration', 'nevals'] +
+                                 ['best_'+str(i) for i in range(len(refine_history[0]['best']))])
+        refine_df.to_csv('refine_'+dt+'.txt', sep=' ', index=False)
+    if args.elite_archive:
+        n = elite_map.write_archive('elite_traces_'+dt+'.aps')
+        print('Elite trace archive: '+str(n)+' of '+str(len(hof))+' Hall of Fame individuals')
+
+    if surrogate is not None:
+        surrogate_df = pd.DataFrame(surrogate.history)
+        surrogate_df.to_csv('surrogate_'+dt+'.txt', sep=' ', index=False)
 
 if __name__ == '__main__':
-    main()
+    main(sys.argv[1:])
@@ -0,0 +1,107 @@
+"""Island-model (mu,lambda) ES.
+
+Every island is a process that runs eaMuCommaLambdaCheckpoint on its own
+population with its own executor (a group of worker processes). Every
+interval generations each island sends copies of its n_migrants best
+individuals to another island through a multiprocessing.Queue and
+replaces its worst individuals with the ones it receives. The islands
+only wait for their migrants, there is no global barrier per generation.
+The topology is a ring (island i sends to i+1) or random: a seeded random
+derangement per migration, so every island still receives exactly one
+group of migrants.
+"""
+import queue
+import random
+import multiprocessing
+import numpy as np
+
+from deap import tools
+
+from checkpoint import eaMuCommaLambdaCheckpoint
+
+
+def migration_targets(n_islands, topology, epoch, seed):
+    """Destination island of the migrants of every island."""
+    if (topology == 'ring'):
+        return [(i + 1) % n_islands for i in range(n_islands)]
+    rng = np.random.RandomState(seed + epoch)
+    while True:
+        targets = rng.permutation(n_islands)
+        if np.all(targets != np.arange(n_islands)):
+            return [int(i) for i in targets]
+
+
+def run_island(island, n_islands, setup, inboxes, results, mu, lambda_, cxpb, mutpb,
+               ngen, interval, n_migrants, topology, hof_size, seed):
+    """Process target of one island. setup(island) returns the (toolbox,
+    stats, executor) of the island. The final (island, population, hof,
+    logbook) is put on results."""
+    random.seed(seed + island)
+    np.random.seed(seed + island)
+    toolbox, stats, executor = setup(island)
+    pop = toolbox.population(n=mu)
+    hof = tools.HallOfFame(hof_size)
+    logbook = None
+    gen = 0
+    epoch = 0
+    while (gen < ngen):
+        end = min(gen + interval, ngen)
+        pop, logbook = eaMuCommaLambdaCheckpoint(pop, toolbox, mu=mu, lambda_=lambda_,
+                                                 cxpb=cxpb, mutpb=mutpb, ngen=end,
+                                                 stats=stats, halloffame=hof, verbose=False,
+                                                 start_gen=gen, logbook=logbook)
+        gen = end
+        if (gen < ngen and n_islands > 1):
+            epoch += 1
+            target = migration_targets(n_islands, topology, epoch, seed)[island]
+            migrants = [toolbox.clone(ind) for ind in tools.selBest(pop, n_migrants)]
+            inboxes[target].put(migrants)
+            immigrants = inboxes[island].get()
+            pop[:] = tools.selBest(pop, len(pop) - len(immigrants)) + immigrants
+    executor.close()
+    results.put((island, pop, hof, logbook))
+
+
+def eaIslands(setup, n_islands, mu, lambda_, cxpb, mutpb, ngen, interval=5, n_migrants=2,
+              topology='ring', hof_size=1, seed=0):
+    """Run n_islands islands of (mu,lambda) in parallel processes.
+    setup(island) is called in the island process and returns its (toolbox,
+    stats, executor), it must be picklable (e.g. a partial of a module
+    function). An island that dies stops the run with RuntimeError.
+    Returns (populations, hofs, logbooks, hof): the per-island results and
+    the HallOfFame of hof_size merged from the islands."""
+    inboxes = [multiprocessing.Queue() for i in range(n_islands)]
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=run_island,
+                                     args=(i, n_islands, setup, inboxes, results, mu, lambda_,
+                                           cxpb, mutpb, ngen, interval, n_migrants, topology,
+                                           hof_size, seed))
+             for i in range(n_islands)]
+    for p in procs:
+        p.start()
+
+    pops = [None] * n_islands
+    hofs = [None] * n_islands
+    logbooks = [None] * n_islands
+    n_done = 0
+    while (n_done < n_islands):
+        try:
+            island, pop, hof, logbook = results.get(timeout=5.0)
+        except queue.Empty:
+            for i, p in enumerate(procs):
+                if (pops[i] is None and p.exitcode is not None and p.exitcode != 0):
+                    for q in procs:
+                        q.terminate()
+                    raise RuntimeError('Island '+str(i)+' exited with code '+str(p.exitcode))
+            continue
+        pops[island] = pop
+        hofs[island] = hof
+        logbooks[island] = logbook
+        n_done += 1
+    for p in procs:
+        p.join()
+
+    merged = tools.HallOfFame(hof_size)
+    for hof in hofs:
+        merged.update(list(hof))
+    return pops, hofs, logbooks, merged
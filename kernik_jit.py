@@ -0,0 +1,550 @@
+"""Numba-compiled Kernik model for the dynamic-clamp simulations.
+
+Opt-in backend of run_ind_dclamp (pacing backend 'numba', --backend numba).
+init_model wraps the configured KernikModel in a JitKernikModel whose
+generate_response integrates the same PacedProtocol with the same solver
+(LSODA, max_step 0.8 ms) as cell_models, but the right-hand side (incl. the
+Ishihara IK1 and the no_ion_selective leak currents) is a compiled function
+of a flat parameter vector and the stiff solver gets a compiled Jacobian
+(forward differences of the compiled right-hand side) instead of estimating
+it through 23 Python calls.
+
+The kinetics, base conductances and constants are read from the wrapped
+KernikModel, so the port follows the installed cell_models parameters.
+The step sizes differ, so the traces are not bit-identical: validate
+compares the last APs of both backends interpolated onto the Python time
+points and accepts an RMSE of V (the scored column) up to V_RMSE_TOL mV
+and of I up to I_RMSE_TOL pA/pF per condition, and the same AP Failure
+outcome. The stimulus edges and the INa spike of I are a fraction of a ms
+wide, so I is compared outside of the UPSTROKE ms around the upstroke
+(t = 0).
+
+  python kernik_jit.py validate [--n 3] [--seed 2021]
+
+The functions are compiled on the first call of each process (cached in
+__pycache__ when possible). They use the floating-point semantics of NumPy
+(error_model='numpy'): a division by zero gives inf or nan as in
+cell_models instead of raising ZeroDivisionError. Without numba the
+module imports, but JitKernikModel raises ImportError.
+"""
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import integrate
+from scipy.signal import argrelextrema
+from cell_models.current_models import Ishi
+
+try:
+    from numba import njit
+    from numba import types
+    from numba.extending import overload
+    from numba.extending import register_jitable
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+    def register_jitable(func):
+        return func
+
+
+V_RMSE_TOL = 1.0
+I_RMSE_TOL = 0.05
+UPSTROKE = (-10.0, 10.0)
+
+N_STATES = 23
+# Relative step of the finite-difference Jacobians (sqrt of the float64 eps).
+FD_STEP = 1.4901161193847656e-08
+
+# Scalings of the model (KernikModel.default_parameters) in the order of
+# the parameter vector.
+SCALINGS = ['G_K1', 'G_K1_Ishi', 'G_Kr', 'G_Ks', 'G_to', 'P_CaL', 'G_CaT', 'G_Na',
+            'G_F', 'K_NaCa', 'P_NaK', 'VmaxUp', 'V_leak', 'ks', 'G_b_Na', 'G_b_Ca',
+            'G_PCa']
+# Base conductances of KernikCurrents.model_conductances.
+BASE_CONDUCTANCES = ['G_K1', 'G_Kr', 'G_Ks', 'G_To', 'G_CaL', 'G_CaT', 'G_Na', 'G_F']
+# Currents a no_ion_selective leak can be proportional to.
+LEAK_CURRENTS = ['I_K1', 'I_To', 'I_Kr', 'I_Ks', 'I_CaL', 'I_NaK', 'I_Na', 'I_NaCa',
+                 'I_pCa', 'I_F', 'I_bNa', 'I_bCa', 'I_CaT', 'I_up', 'I_leak', 'I_K1_Ishi']
+
+# Layout of the parameter vector.
+KIN = 0
+COND = 58
+SCALE = COND + len(BASE_CONDUCTANCES)
+LEAK = SCALE + len(SCALINGS)
+NAI = LEAK + len(LEAK_CURRENTS)
+KI = NAI + 1
+STIM_AMP = KI + 1
+STIM_PERIOD = STIM_AMP + 1
+STIM_DUR = STIM_PERIOD + 1
+STIM_START = STIM_DUR + 1
+STIM_END = STIM_START + 1
+ISHI_GATE = STIM_END + 1
+KO = ISHI_GATE + 1
+CAO = KO + 1
+NAO = CAO + 1
+T_KELVIN = NAO + 1
+R_GAS = T_KELVIN + 1
+F_FARADAY = R_GAS + 1
+KM_NA = F_FARADAY + 1
+CM = KM_NA + 1
+VC = CM + 1
+V_SR = VC + 1
+N_PARAMS = V_SR + 1
+
+ISHI_MG_IN = float(Ishi.Mg_in)
+ISHI_SPM_IN = float(Ishi.SPM_in)
+ISHI_PHI = float(Ishi.phi)
+
+
+def ishi_gate_is_derivative():
+    """cell_models releases differ in the second value of Ishi.I_K1: the
+    derivative of y1 or y1 itself. The port does what the installed one
+    does."""
+    y1 = 0.5
+    return Ishi.I_K1(-80.0, -85.0, y1, 5.4, 1.0)[1] != y1
+
+
+ISHI_GATE_IS_DERIVATIVE = ishi_gate_is_derivative()
+
+
+def select(cond, a, b):
+    """np.where(cond, a, b) of kernik_rhs: element-wise on a population.
+    Compiled on scalars it is a plain branch (see _select), np.where would
+    return a 0-d array there."""
+    return np.where(cond, a, b)
+
+
+if HAVE_NUMBA:
+    @overload(select)
+    def _select(cond, a, b):
+        if isinstance(cond, types.Array):
+            return lambda cond, a, b: np.where(cond, a, b)
+
+        def branch(cond, a, b):
+            if cond:
+                return a
+            return b
+        return branch
+
+
+@register_jitable
+def ishi_ik1(v, E_K, y1, Ko, g_K1):
+    """Ishihara IK1, returns (I_K1, d_y1)."""
+    IK1_alpha = (0.17*np.exp(-0.07*((v-E_K) + 8*ISHI_MG_IN)))/(1+0.01*np.exp(0.12*(v-E_K)+8*ISHI_MG_IN))
+    IK1_beta = (ISHI_SPM_IN*280*np.exp(0.15*(v-E_K)+8*ISHI_MG_IN))/(1+0.01*np.exp(0.13*(v-E_K)+8*ISHI_MG_IN))
+    Kd_spm_l = 0.04*np.exp(-(v-E_K)/9.1)
+    Kd_mg = 0.45*np.exp(-(v-E_K)/20)
+    fo = 1/(1 + (ISHI_MG_IN/Kd_mg))
+    y2 = 1/(1 + ISHI_SPM_IN/Kd_spm_l)
+    d_y1 = IK1_alpha*(1-y1) - IK1_beta*fo**3*y1
+    gK1 = 2.5*(Ko/5.4)**.4 * g_K1
+    return gK1*(v-E_K)*(ISHI_PHI*fo*y1 + (1-ISHI_PHI)*y2), d_y1
+
+
+@register_jitable
+def _gate(v, a1, a2, a5, a6, tau_const, x):
+    """Derivative of a Kernik two-exponential gate."""
+    a3 = a5*a1
+    a4 = 1/((1/a2)+(1/a6))
+    alpha = a1*np.exp(v/a2)
+    beta = a3*np.exp(v/a4)
+    x_inf = alpha/(alpha+beta)
+    tau = (1./(alpha+beta)) + tau_const
+    return (x_inf-x)/tau
+
+
+@register_jitable
+def kernik_rhs(t, y, p, dy):
+    """Fills dy with the derivatives of the Kernik state y at time t (ms)
+    under the PacedProtocol stimulus in p, as KernikModel with
+    is_no_ion_selective. Returns the summed current of the time point (the
+    I of a cell_models trace).
+    Written with NumPy functions only, so it also runs uncompiled on a
+    population: y (23, n), p (N_PARAMS, n) and dy (23, n), see batch_sim."""
+    kin = p[KIN:COND]
+    Ko = p[KO]
+    Cao = p[CAO]
+    Nao = p[NAO]
+    RT_F = p[R_GAS]*p[T_KELVIN]/p[F_FARADAY]
+    F_RT = p[F_FARADAY]/(p[R_GAS]*p[T_KELVIN])
+    F = p[F_FARADAY]
+    Cm = p[CM]
+    Vc = p[VC]
+
+    v = y[0]
+    Ca_SR = y[1]
+    # cell_models resets a negative Cai.
+    Cai = select(y[2] > 0.0, y[2], 4.88E-5)
+    Nai = select(np.isnan(p[NAI]), y[3], p[NAI])
+    Ki = select(np.isnan(p[KI]), y[4], p[KI])
+
+    E_Ca = 0.5*RT_F*np.log(Cao/Cai)
+    E_Na = RT_F*np.log(Nao/Nai)
+    E_K = RT_F*np.log(Ko/Ki)
+
+    # I_K1
+    alpha_xK1 = kin[0]*np.exp((v+kin[2])/kin[1])
+    beta_xK1 = np.exp((v+kin[4])/kin[3])
+    XK1_inf = alpha_xK1/(alpha_xK1+beta_xK1)
+    i_K1 = p[COND+0]*p[SCALE+0]*XK1_inf*(v-E_K)*np.sqrt(Ko/5.4)
+
+    i_K1_ishi, d_y1 = ishi_ik1(v, E_K, y[5], Ko, p[SCALE+1])
+    dy[5] = select(p[ISHI_GATE] > 0.0, d_y1, y[5])
+
+    # I_Kr
+    dy[9] = _gate(v, kin[5], kin[6], kin[7], kin[8], kin[13], y[9])
+    dy[10] = _gate(v, kin[9], kin[10], kin[11], kin[12], kin[14], y[10])
+    i_Kr = p[COND+1]*p[SCALE+2]*(v-E_K)*y[9]*y[10]*np.sqrt(Ko/5.4)
+
+    # I_Ks
+    dy[11] = _gate(v, kin[15], kin[16], kin[17], kin[18], kin[19], y[11])
+    i_Ks = p[COND+2]*p[SCALE+3]*(v-E_K)*(y[11]**2)
+
+    # I_to
+    dy[16] = _gate(v, kin[24], kin[25], kin[26], kin[27], kin[29], y[16])
+    dy[17] = _gate(v, kin[20], kin[21], kin[22], kin[23], kin[28], y[17])
+    i_to = p[COND+3]*p[SCALE+4]*(v-E_K)*y[16]*y[17]
+
+    # I_CaL
+    d, f, fCa = y[6], y[7], y[8]
+    dy[6] = _gate(v, kin[30], kin[31], kin[32], kin[33], kin[38], d)
+    dy[7] = _gate(v, kin[34], kin[35], kin[36], kin[37], kin[39], f)
+    scale_Ical_Fca_Cadep = 1.2
+    alpha_fCa = 1.0/(1.0+((scale_Ical_Fca_Cadep*Cai)/.000325) ** 8.0)
+    beta_fCa = 0.1/(1.0+np.exp((scale_Ical_Fca_Cadep*Cai-.0005)/0.0001))
+    gamma_fCa = .2/(1.0+np.exp((scale_Ical_Fca_Cadep*Cai-0.00075)/0.0008))
+    fCa_inf = ((alpha_fCa+beta_fCa+gamma_fCa+.23)/(1.46))
+    k_fca = select((fCa_inf > fCa) & (v > -60), 0.0, 1.0)
+    dy[8] = k_fca*(fCa_inf-fCa)/2.0
+
+    p_CaL = p[COND+4]*p[SCALE+5]
+    p_tot = 5.4e-4 + 1.5e-8 + 2.7e-7
+    p_CaL_Ca = 5.4e-4/p_tot*p_CaL
+    p_CaL_Na = 1.5e-8/p_tot*p_CaL
+    p_CaL_K = 2.7e-7/p_tot*p_CaL
+    e2 = np.exp(2.0*v*F_RT)
+    e1 = np.exp(v*F_RT)
+    ibarca = p_CaL_Ca*4.0*v*F ** 2.0/(p[R_GAS]*p[T_KELVIN]) * \
+        (.341*Cai*e2-0.341*Cao)/(e2-1.0)
+    ibarna = p_CaL_Na*v*F ** 2.0/(p[R_GAS]*p[T_KELVIN]) * (.75*Nai*e1-0.75*Nao)/(e1-1.0)
+    ibark = p_CaL_K*v*F ** 2.0/(p[R_GAS]*p[T_KELVIN]) * (.75*Ki*e1-0.75*Ko)/(e1-1.0)
+    i_CaL_Ca = ibarca*d*f*fCa
+    i_CaL_Na = ibarna*d*f*fCa
+    i_CaL_K = ibark*d*f*fCa
+    i_CaL = i_CaL_Ca+i_CaL_Na+i_CaL_K
+
+    # I_CaT
+    dcat_inf = 1./(1+np.exp(-(v + 26.3)/6))
+    tau_dcat = 1./(1.068*np.exp((v+26.3)/30) + 1.068*np.exp(-(v+26.3)/30))
+    dy[18] = (dcat_inf-y[18])/tau_dcat
+    fcat_inf = 1./(1+np.exp((v + 61.7)/5.6))
+    tau_fcat = 1./(.0153*np.exp(-(v+61.7)/83.3) + 0.015*np.exp((v+61.7)/15.38))
+    dy[19] = (fcat_inf-y[19])/tau_fcat
+    i_CaT = p[COND+5]*p[SCALE+6]*(v-E_Ca)*y[18]*y[19]
+
+    # I_Na (j shares h5 and h6 with h)
+    dy[12] = _gate(v, kin[44], kin[45], kin[46], kin[47], kin[51], y[12])
+    dy[13] = _gate(v, kin[48], kin[49], kin[46], kin[47], kin[52], y[13])
+    dy[14] = _gate(v, kin[40], kin[41], kin[42], kin[43], kin[50], y[14])
+    i_Na = p[COND+6]*p[SCALE+7]*y[14] ** 3.0*y[12]*y[13]*(v-E_Na)
+
+    # I_f
+    dy[15] = _gate(v, kin[53], kin[54], kin[55], kin[56], kin[57], y[15])
+    g_f = p[COND+7]*p[SCALE+8]
+    Na_frac = .491/(.491+1)
+    i_fNa = Na_frac*g_f*y[15]*(v-E_Na)
+    i_fK = (1-Na_frac)*g_f*y[15]*(v-E_K)
+    i_f = i_fNa+i_fK
+
+    # I_NaCa
+    KmCa = 1.38
+    KmNai = 87.5
+    Ksat = 0.1
+    gamma = 0.35*2
+    alpha = 2.5*1.1
+    kNaCa = 1000*1.1*p[SCALE+9]
+    i_NaCa = kNaCa*((np.exp(gamma*v*F_RT)*(Nai ** 3.0)*Cao) -
+                    (np.exp((gamma-1.0)*v*F_RT)*(Nao ** 3.0)*Cai*alpha)) / \
+        (((KmNai ** 3.0)+(Nao ** 3.0))*(KmCa+Cao)*(1.0+Ksat*np.exp((gamma-1.0)*v*F_RT)))
+
+    # I_NaK
+    PNaK = 1.362*1.818*p[SCALE+10]
+    i_NaK = PNaK*((Ko*Nai)/((Ko+1.0)*(Nai+p[KM_NA]) *
+                            (1.0 + 0.1245*np.exp(-0.1*v*F_RT)+0.0353*np.exp(-v*F_RT))))
+
+    # SR fluxes
+    Kup = 0.00025*0.702
+    i_up = 0.000425*0.26*p[SCALE+11]/(1.0+Kup ** 2.0/Cai ** 2.0)
+    i_leak = (Ca_SR-Cai)*p[SCALE+12]*0.00008*0.02
+
+    ks = 12.5*p[SCALE+13]
+    koCa = 56320*11.43025
+    kiCa = 54*0.3425
+    kom = 1.5*0.1429
+    kim = 0.001*0.5571
+    kCaSR = 15 - (15-1)/(1+(0.45/Ca_SR)**2.5)
+    koSRCa = koCa/kCaSR
+    kiSRCa = kiCa*kCaSR
+    R, O, I = y[20], y[21], y[22]
+    RI = 1-R-O-I
+    dy[20] = (kim*RI-kiSRCa*Cai*R) - (koSRCa*Cai**2*R-kom*O)
+    dy[21] = (koSRCa*Cai**2*R-kom*O) - (kiSRCa*Cai*O-kim*I)
+    dy[22] = (kiSRCa*Cai*O-kim*I) - (kom*I-koSRCa*Cai**2*RI)
+    i_rel = ks*O*(Ca_SR-Cai)*(p[V_SR]/Vc)
+
+    i_b_Na = .00029*1.5*p[SCALE+14]*(v-E_Na)
+    i_b_Ca = .000592*0.62*p[SCALE+15]*(v-E_Ca)
+    i_PCa = 0.025*10.5*p[SCALE+16]*Cai/(Cai+0.0005)
+
+    # Concentrations
+    Ca_SR_bufSR = 1/(1.0+10.0*1.2*0.3/(Ca_SR+0.3)**2.0)
+    dy[1] = Ca_SR_bufSR*Vc/p[V_SR]*(i_up-(i_rel+i_leak))
+    Cai_bufc = 1/(1.0+.06*.0006/(Cai+.0006)**2.0)
+    dy[2] = Cai_bufc*(i_leak-i_up+i_rel -
+                      (i_CaL_Ca+i_CaT+i_b_Ca+i_PCa-2*i_NaCa)*Cm/(2.0*Vc*F))
+    dy[3] = -Cm*(i_Na+i_b_Na+i_fNa+3.0*i_NaK+3.0*i_NaCa+i_CaL_Na)/(F*Vc)
+    dy[4] = -Cm*(i_K1+i_to+i_Kr+i_Ks+i_fK-2.*i_NaK+i_CaL_K)/(F*Vc)
+
+    # no_ion_selective leak, in the order of LEAK_CURRENTS
+    leak = p[LEAK:NAI]
+    i_no_ion = (leak[0]*i_K1 + leak[1]*i_to + leak[2]*i_Kr + leak[3]*i_Ks +
+                leak[4]*i_CaL_Ca + leak[5]*i_NaK + leak[6]*i_Na + leak[7]*i_NaCa +
+                leak[8]*i_PCa + leak[9]*i_f + leak[10]*i_b_Na + leak[11]*i_b_Ca +
+                leak[12]*i_CaT + leak[13]*i_up + leak[14]*i_leak)
+    i_no_ion = i_no_ion + leak[15]*ishi_ik1(v, E_K, y[5], Ko, 1.0)[0]
+
+    # PacedProtocol stimulus
+    period = p[STIM_PERIOD]
+    start = p[STIM_START]
+    i_stim = select((t - start - period*np.floor((t - start)/period) <= p[STIM_DUR]) &
+                    (t <= p[STIM_END]) & (t >= start), p[STIM_AMP]/Cm, 0.0)
+
+    dy[0] = -(i_K1+i_to+i_Kr+i_Ks+i_CaL+i_CaT+i_NaK+i_Na+i_NaCa +
+              i_PCa+i_f+i_b_Na+i_b_Ca+i_K1_ishi+i_no_ion) + i_stim
+
+    return (i_K1+i_K1_ishi+i_to+i_Kr+i_Ks+i_CaL_Ca+i_NaK+i_Na+i_NaCa+i_PCa+i_f +
+            i_b_Na+i_b_Ca+i_CaT+i_up+i_leak+i_no_ion+i_stim)
+
+
+@njit(cache=True, error_model='numpy')
+def kernik_rhs_jit(t, y, p, dy):
+    """Compiled kernik_rhs of one model."""
+    return kernik_rhs(t, y, p, dy)
+
+
+@njit(cache=True, error_model='numpy')
+def kernik_jac(t, y, p):
+    """Forward-difference Jacobian of kernik_rhs."""
+    n = y.shape[0]
+    f0 = np.empty(n)
+    f1 = np.empty(n)
+    jac = np.empty((n, n))
+    kernik_rhs(t, y, p, f0)
+    yh = y.copy()
+    for j in range(n):
+        h = FD_STEP*max(abs(y[j]), 1e-3)
+        yh[j] = y[j] + h
+        kernik_rhs(t, yh, p, f1)
+        for i in range(n):
+            jac[i, j] = (f1[i] - f0[i])/h
+        yh[j] = y[j]
+    return jac
+
+
+@njit(cache=True, error_model='numpy')
+def summed_current(t, y, p):
+    """Summed current of each time point of a solution (y is (23, n))."""
+    dy = np.empty(y.shape[0])
+    current = np.empty(t.shape[0])
+    for k in range(t.shape[0]):
+        current[k] = kernik_rhs(t[k], y[:, k].copy(), p, dy)
+    return current
+
+
+def model_parameters(m, protocol, is_no_ion_selective=True):
+    """Flat parameter vector of kernik_rhs of a configured KernikModel m
+    paced with protocol."""
+    p = np.zeros(N_PARAMS)
+    p[KIN:COND] = np.asarray(m.kinetics, dtype=np.float64)
+    conductances = m.kernik_currents.model_conductances
+    p[COND:SCALE] = [conductances[c] for c in BASE_CONDUCTANCES]
+    p[SCALE:LEAK] = [m.default_parameters[s] for s in SCALINGS]
+    if is_no_ion_selective:
+        for name, scale in m._CellModel__no_ion_selective.items():
+            p[LEAK + LEAK_CURRENTS.index(name)] = scale
+    p[NAI] = np.nan if m.nai_millimolar is None else m.nai_millimolar
+    p[KI] = m.ki_millimolar if m.ki_millimolar else np.nan
+    p[STIM_AMP] = protocol.stim_amplitude
+    p[STIM_PERIOD] = m.time_conversion / protocol.pace
+    p[STIM_DUR] = protocol.stim_duration
+    p[STIM_START] = protocol.stim_start
+    p[STIM_END] = protocol.stim_end
+    p[ISHI_GATE] = 1.0 if ISHI_GATE_IS_DERIVATIVE else 0.0
+    p[KO] = m.Ko
+    p[CAO] = m.Cao
+    p[NAO] = m.Nao
+    p[T_KELVIN] = m.t_kelvin
+    p[R_GAS] = m.r_joule_per_mole_kelvin
+    p[F_FARADAY] = m.f_coulomb_per_mmole
+    p[KM_NA] = m.Km_Na
+    p[CM] = m.cm_farad
+    p[VC] = m.kernik_currents.Vc
+    p[V_SR] = m.kernik_currents.V_SR
+    return p
+
+
+class JitTrace:
+    """ The part of a cell_models Trace run_condition uses: t, y (V), the
+    summed current and get_last_ap, which sets last_ap."""
+
+    def __init__(self, t, y, current):
+        self.t = t
+        self.y = y
+        self.current = current
+        self.last_ap = None
+
+    def get_last_ap(self):
+        dv_dt = np.diff(self.y) / np.diff(self.t)
+
+        dv_dt_inds = argrelextrema(dv_dt, np.greater, order=450)
+        bounds = dv_dt_inds[0][-4:-2]
+
+        cycle = self.t[bounds[1]] - self.t[bounds[0]]
+        cycle_25p = cycle *.25
+        start_time = self.t[bounds[0]] - cycle_25p
+        end_time = start_time + cycle
+
+        start_idx = np.abs(self.t - start_time).argmin()
+        end_idx = np.abs(self.t - end_time).argmin()
+
+        self.last_ap = pd.DataFrame({'t': self.t[start_idx:end_idx] - self.t[bounds[0]],
+                                     'V': self.y[start_idx:end_idx],
+                                     'I': self.current[start_idx:end_idx]})
+
+        return self.last_ap, [start_idx, end_idx], self.t[bounds[0]]
+
+
+class JitKernikModel:
+    """ KernikModel stand-in whose generate_response integrates the compiled
+    right-hand side. Every other attribute (y_initial, default_parameters,
+    the no_ion_selective leak...) is read from and set on the wrapped
+    model, so init_model and run_condition configure it as before.
+    Only PacedProtocol responses without experimental artefacts.
+    """
+
+    def __init__(self, model):
+        if not HAVE_NUMBA:
+            raise ImportError('The numba backend needs numba (pip install numba).')
+        if model.is_exp_artefact:
+            raise ValueError('The numba backend has no experimental artefacts.')
+        self.__dict__['model'] = model
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.model, name, value)
+
+    def generate_response(self, protocol, is_no_ion_selective=True):
+        """Pace the model from y_initial with a PacedProtocol, y_initial
+        becomes the final state. Returns a JitTrace. OverflowError is raised
+        if the solution is not finite (cell_models raises it from math.exp)."""
+        p = model_parameters(self.model, protocol, is_no_ion_selective)
+        dy = np.empty(N_STATES)
+        nai = self.model.nai_millimolar
+        ki = self.model.ki_millimolar
+
+        def rhs(t, y):
+            # cell_models pins Nai and Ki in the solver state the same way.
+            if nai is not None:
+                y[3] = nai
+            if ki:
+                y[4] = ki
+            kernik_rhs_jit(t, y, p, dy)
+            return dy.copy()
+
+        def jac(t, y):
+            return kernik_jac(t, y, p)
+
+        solution = integrate.solve_ivp(rhs, [0, protocol.stim_end],
+                                       np.array(self.model.y_initial, dtype=np.float64),
+                                       method='LSODA', jac=jac,
+                                       max_step=8e-4*self.model.time_conversion)
+        if not np.all(np.isfinite(solution.y)):
+            raise OverflowError('Kernik solution is not finite.')
+        self.model.y_initial = solution.y[:, -1]
+        return JitTrace(solution.t, solution.y[0], summed_current(solution.t, solution.y, p))
+
+
+def compare_aps(ap_python, ap_jit):
+    """RMSE of V and I of the JIT last AP interpolated onto the time points
+    of the Python last AP (where they overlap, I outside of UPSTROKE)."""
+    t = np.asarray(ap_python.t)
+    t = t[(t >= ap_jit.t.min()) & (t <= ap_jit.t.max())]
+    rmse = {}
+    for c in ['V', 'I']:
+        if (c == 'I'):
+            t = t[(t < UPSTROKE[0]) | (t > UPSTROKE[1])]
+        ref = np.interp(t, ap_python.t, ap_python[c])
+        new = np.interp(t, ap_jit.t, ap_jit[c])
+        rmse[c] = float(np.sqrt(np.mean((ref - new)**2))) if len(t) else np.inf
+    return rmse
+
+
+def validate(n=3, seed=2021):
+    """Simulate the baseline model and n random individuals with both
+    backends and compare the last AP of every condition. Returns the
+    number of failed comparisons."""
+    from run_dclamp_simulation import run_ind_dclamp
+    from run_dclamp_simulation import FixedPacing
+
+    rng = np.random.RandomState(seed)
+    inds = {'baseline': [0.5] + [1.0] * 13}
+    for i in range(n):
+        inds['random_%d' % i] = [rng.uniform(0.0, 1.0)] + list(10**rng.uniform(-0.5, 0.5, 13))
+
+    failed = 0
+    print('%-10s %-12s %10s %10s %s' % ('model', 'condition', 'rmse_V', 'rmse_I', ''))
+    for name, ind in inds.items():
+        t0 = time.perf_counter()
+        ref = run_ind_dclamp(ind, pacing=FixedPacing(backend='python'))
+        t1 = time.perf_counter()
+        new = run_ind_dclamp(ind, pacing=FixedPacing(backend='numba'))
+        t2 = time.perf_counter()
+        if (ref[1] != new[1] or set(ref[0]) != set(new[0])):
+            print('%-10s AP Failure differs: python %s, numba %s' % (name, ref[1], new[1]))
+            failed += 1
+            continue
+        for key in ref[0]:
+            rmse = compare_aps(ref[0][key], new[0][key])
+            ok = rmse['V'] <= V_RMSE_TOL and rmse['I'] <= I_RMSE_TOL
+            failed += not ok
+            print('%-10s %-12s %10.4f %10.4f %s' % (name, key, rmse['V'], rmse['I'],
+                                                    '' if ok else 'FAIL'))
+        print('%-10s python %.2fs numba %.2fs' % (name, t1 - t0, t2 - t1))
+    return failed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Compiled Kernik backend.')
+    sub = parser.add_subparsers(dest='command')
+    p_val = sub.add_parser('validate', help='compare the last APs with the Python backend')
+    p_val.add_argument('--n', type=int, default=3, help='random individuals besides the baseline')
+    p_val.add_argument('--seed', type=int, default=2021)
+    args = parser.parse_args(argv)
+
+    if (args.command == 'validate'):
+        failed = validate(args.n, args.seed)
+        print('%d comparisons outside the tolerance' % failed)
+        return 1 if failed else 0
+    parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
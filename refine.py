@@ -0,0 +1,141 @@
+"""Memetic refinement of the Hall of Fame by parallel pattern search.
+
+Each of the top-K individuals is refined by a compass (pattern) search in
+the search space of the ES: phi linear, clipped to [0, PHI_MAX], and the
+log of the other parameters. Every iteration polls the 2*14 points one
+step away along each coordinate of every active search, all polls of an
+iteration are evaluated in one map call so they spread over the worker
+pool. A search moves to its best improving poll point and doubles its
+step (up to MAX_STEP), or halves its step when none improves, and stops
+below min_step. The run stops when the evaluation budget is spent or
+every search has stopped.
+"""
+import numpy as np
+from es_array import log_params
+
+
+PHI_MAX = 1.0 - 1e-6
+# Largest step after expansions (log units, a factor e).
+MAX_STEP = 1.0
+
+
+def from_search(z):
+    x = np.array(z, dtype=np.float64)
+    x[0] = min(max(z[0], 0.0), PHI_MAX)
+    x[1:] = np.exp(z[1:])
+    return x
+
+
+class PatternSearch:
+    """ Compass search of one individual.
+    Attributes:
+      z: current point in the search space.
+      fitness: fitness of the current point.
+      step: current step (log units, phi_scale * step for phi).
+      nevals: evaluations of the polls.
+    """
+
+    def __init__(self, x, fitness, step=0.2, phi_scale=0.25, max_step=1.0):
+        self.z = log_params(x)
+        self.fitness = fitness
+        self.step = step
+        self.phi_scale = phi_scale
+        self.max_step = max_step
+        self.nevals = 0
+
+    def x(self):
+        return from_search(self.z)
+
+    def poll(self):
+        """Points one step away along each coordinate. The moves of phi
+        that the bound cancels are left out."""
+        points = []
+        for j in range(len(self.z)):
+            h = self.step * (self.phi_scale if j == 0 else 1.0)
+            for sign in (1.0, -1.0):
+                z = self.z.copy()
+                z[j] += sign * h
+                if (j == 0):
+                    z[0] = min(max(z[0], 0.0), PHI_MAX)
+                    if (z[0] == self.z[0]):
+                        continue
+                points.append(z)
+        return points
+
+    def update(self, points, fitnesses):
+        """Move to the best improving point and double the step (up to
+        max_step), or halve the step."""
+        self.nevals += len(points)
+        if (len(points) > 0 and min(fitnesses) < self.fitness):
+            best = int(np.argmin(fitnesses))
+            self.z = points[best]
+            self.fitness = fitnesses[best]
+            self.step = min(2.0 * self.step, self.max_step)
+        else:
+            self.step *= 0.5
+
+
+def pattern_search(starts, fitnesses, evaluate_many, budget, step=0.2, min_step=0.01,
+                   phi_scale=0.25):
+    """Refine the starts (parameter lists) of fitness fitnesses with
+    PatternSearch. evaluate_many(list of parameter arrays) returns their
+    fitnesses and is called once per iteration. The last iteration polls
+    the searches in order until the budget is reached.
+    Returns (searches, history) with the history of the best fitness of
+    every search per iteration."""
+    searches = [PatternSearch(x, f, step, phi_scale, MAX_STEP)
+                for x, f in zip(starts, fitnesses)]
+    history = []
+    nevals = 0
+    iteration = 0
+    while (nevals < budget):
+        active = [s for s in searches if s.step >= min_step]
+        if (len(active) == 0):
+            break
+        polls = []
+        points = []
+        for s in active:
+            z = s.poll()[:budget - nevals - len(points)]
+            if (len(z) == 0):
+                break
+            polls.append((s, len(points), len(z)))
+            points.extend(z)
+        fits = evaluate_many([from_search(z) for z in points])
+        nevals += len(points)
+        iteration += 1
+        for s, start, n in polls:
+            s.update(points[start:start+n], fits[start:start+n])
+        history.append({'iteration': iteration, 'nevals': nevals,
+                        'best': [s.fitness for s in searches],
+                        'step': [s.step for s in searches]})
+    return searches, history
+
+
+def refine_hof(hof, k, map_func, evaluate, budget, step=0.2, min_step=0.01,
+               phi_scale=0.25):
+    """Refine the top k individuals of a HallOfFame with pattern_search,
+    evaluated with map_func(evaluate, individuals) (evaluate returns a
+    fitness tuple). The refined individuals (a clone of their start with
+    the new parameters and fitness) are added to the Hall of Fame.
+    Returns the history of pattern_search (empty for an empty Hall of
+    Fame)."""
+    if (len(hof) == 0):
+        return []
+    starts = [hof[i] for i in range(min(k, len(hof)))]
+    ind_clss = type(starts[0])
+
+    def evaluate_many(points):
+        return [fit[0] for fit in map_func(evaluate, [ind_clss(list(x)) for x in points])]
+
+    searches, history = pattern_search([list(ind) for ind in starts],
+                                       [ind.fitness.values[0] for ind in starts],
+                                       evaluate_many, budget, step, min_step, phi_scale)
+    refined = []
+    for ind, s in zip(starts, searches):
+        if (s.fitness < ind.fitness.values[0]):
+            new = ind_clss(list(s.x()))
+            new.strategy = type(ind.strategy)(ind.strategy)
+            new.fitness.values = (s.fitness,)
+            refined.append(new)
+    hof.update(refined)
+    return history
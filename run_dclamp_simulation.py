@@ -1,33 +1,240 @@
+import time
+import signal
+import threading
+import numpy as np
+from collections import namedtuple
 from cell_models import protocols
 from cell_models.kernik import KernikModel
+from kernik_jit import JitKernikModel
+import warm_start
+import telemetry
 
 
-def run_ind_dclamp(ind, dc_ik1=1.0, nai=10.0, ki=130.0):
-    """ Create model from individual DEAP object.
-    The optimized parameters are limited to the membrane conductances/fluxes.
-    There is an additional parameter: phi for leak on the dynamic clamp.
-     ind[0] = phi [0:1)
-     ind[1]  =  'G_K1'
-     ind[2]  =  'G_Kr'
-     ind[3]  =  'G_Ks'
-     ind[4]  =  'G_to'
-     ind[5]  =  'P_CaL'
-     ind[6]  =  'G_CaT'
-     ind[7]  =  'G_Na'
-     ind[8]  =  'G_F'
-     ind[9]  =  'K_NaCa'
-     ind[10] = 'P_NaK'
-     ind[11] = 'G_b_Na'
-     ind[12] = 'G_b_Ca'
-     ind[13] = 'G_PCa'
+# Dynamic-clamp conditions in the order they are run. The control paces
+# with the Ishihara IK1 leak only, every perturbation adds scale * phi of
+# current to the leak and starts from the control steady state. The key
+# names the experimental AP of the condition (see ExperimentalAPSet).
+Condition = namedtuple('Condition', ['key', 'current', 'scale'])
+
+CONDITIONS = [Condition('cntrl', None, 0.0),
+              Condition('-0.15_ical', 'I_CaL', -0.15),
+              Condition('0.7_ical', 'I_CaL', 0.7),
+              Condition('-0.25_ikr', 'I_Kr', -0.25),
+              Condition('0.9_ikr', 'I_Kr', 0.9),
+              Condition('-0.9_ito', 'I_To', -0.9),
+              Condition('1.5_ito', 'I_To', 1.5),
+              Condition('10_iks', 'I_Ks', 10.0),
+              Condition('4_iks', 'I_Ks', 4.0)]
+
+CONDITION_KEYS = [c.key for c in CONDITIONS]
+
+# key: (current, scale) of the perturbations.
+PERTURBATIONS = dict((c.key, (c.current, c.scale)) for c in CONDITIONS
+                     if c.current is not None)
+
+# Minimum duration (ms) of a recorded last AP, shorter traces are failures.
+MIN_AP_DURATION = 800.0
+
+
+class SimulationTimeout(Exception):
+    """Raised when a simulation runs out of its wall-clock time budget."""
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise SimulationTimeout()
+
+
+class TimeBudget:
+    """ Wall-clock budget of one evaluation (timeout) and of each of its
+    conditions (condition_timeout), in seconds. None means unlimited.
+    run() calls generate_response under a SIGALRM timer set to the smaller of
+    the two remaining budgets; the handler raises SimulationTimeout inside
+    the solver, which unwinds the simulation and releases its trace.
+    The timer needs the main thread of the worker process (Pool, process
+    futures and broker workers): run() raises a RuntimeError for a budget
+    in another thread (e.g. a thread pool executor), where it could not be
+    enforced. A solver stuck inside a single C call is only interrupted when
+    it returns to Python.
+    simulated_ms counts the model time the pacing ran under the budget.
     """
 
-    ap_failure = False
-    
+    def __init__(self, timeout=None, condition_timeout=None):
+        self.timeout = timeout
+        self.condition_timeout = condition_timeout
+        self.simulated_ms = 0.0
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = time.monotonic() + timeout
+
+    def remaining(self):
+        limits = []
+        if self.condition_timeout is not None:
+            limits.append(self.condition_timeout)
+        if self.deadline is not None:
+            limits.append(self.deadline - time.monotonic())
+        if (len(limits) == 0):
+            return None
+        return min(limits)
+
+    def run(self, func, *args, **kwargs):
+        seconds = self.remaining()
+        if seconds is None:
+            return telemetry.timed('generate_response', func, *args, **kwargs)
+        if threading.current_thread() is not threading.main_thread():
+            raise RuntimeError('A simulation time budget needs the main thread of the '
+                               'worker process, use a process executor.')
+        if (seconds <= 0.0):
+            raise SimulationTimeout()
+        old_handler = signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+        try:
+            return telemetry.timed('generate_response', func, *args, **kwargs)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, old_handler)
+
+
+class FixedPacing:
+    """ The original pacing: every condition is one PacedProtocol of
+    duration ms (10 beats at 1 Hz) and the last AP is taken from it.
+    backend is the model init_model creates: 'python' (KernikModel) or
+    'numba' (kernik_jit.JitKernikModel)."""
+
+    def __init__(self, duration=10000, backend='python'):
+        self.duration = duration
+        self.backend = backend
+
+    def key(self):
+        """Suffix of the cache namespace, None for the default pacing."""
+        parts = []
+        if (self.duration != 10000):
+            parts.append('fixed_%d' % self.duration)
+        if (self.backend != 'python'):
+            parts.append(self.backend)
+        if (len(parts) == 0):
+            return None
+        return '_'.join(parts)
+
+    def steady_states(self):
+        """No warm start: the 10 s are paced whatever the initial state."""
+        return None
+
+    def run(self, kci, budget):
+        protocol = protocols.PacedProtocol(model_name="Kernik", stim_end=self.duration,
+                                           stim_mag=2)
+        tr = budget.run(kci.generate_response, protocol, is_no_ion_selective=True)
+        budget.simulated_ms += self.duration
+        telemetry.count('simulated_ms', self.duration)
+        return tr
+
+
+class AdaptivePacing:
+    """ Beat-by-beat pre-pacing that stops at the limit cycle.
+    The model is paced one beat (bcl ms) at a time from its current state
+    until the state at the end of a beat differs from the previous one by
+    less than rtol*|y| + atol in every variable, or max_beats - record_beats
+    beats were run. The last AP is then taken from a final run of
+    record_beats beats (get_last_ap takes the beat of the 4th last upstroke,
+    with 5 beats the window before it is still inside the run).
+    The number of simulated ms is counted in the TimeBudget and in the
+    telemetry record.
+    backend as in FixedPacing.
+    With a warm_start_radius the control starts from the steady state of
+    the nearest individual evaluated by the same process within that
+    distance (warm_start.SteadyStateCache of warm_start_entries states),
+    so fewer beats are needed to reach the limit cycle.
+    """
+
+    def __init__(self, rtol=1e-3, atol=1e-6, max_beats=10, record_beats=5, bcl=1000,
+                 backend='python', warm_start_radius=None, warm_start_entries=10000):
+        self.rtol = rtol
+        self.atol = atol
+        self.max_beats = max_beats
+        self.record_beats = record_beats
+        self.bcl = bcl
+        self.backend = backend
+        self.warm_start_radius = warm_start_radius
+        self.warm_start_entries = warm_start_entries
+
+    def key(self):
+        key = 'adaptive_%g_%g_%d_%d_%d' % (self.rtol, self.atol, self.max_beats,
+                                            self.record_beats, self.bcl)
+        if (self.backend != 'python'):
+            key += '_'+self.backend
+        if self.warm_start_radius is not None:
+            key += '_warm_%g' % self.warm_start_radius
+        return key
+
+    def steady_states(self):
+        """SteadyStateCache of this process, None without warm start."""
+        if self.warm_start_radius is None:
+            return None
+        return warm_start.process_cache(self.warm_start_entries, self.warm_start_radius)
+
+    def run(self, kci, budget):
+        beat = protocols.PacedProtocol(model_name="Kernik", stim_end=self.bcl, stim_mag=2)
+        n_beats = 0
+        y_prev = np.array(kci.y_initial, dtype=np.float64)
+        while (n_beats < self.max_beats - self.record_beats):
+            budget.run(kci.generate_response, beat, is_no_ion_selective=True)
+            n_beats += 1
+            y = np.array(kci.y_initial, dtype=np.float64)
+            if np.all(np.abs(y - y_prev) <= self.rtol * np.abs(y) + self.atol):
+                break
+            y_prev = y
+        record = protocols.PacedProtocol(model_name="Kernik",
+                                         stim_end=self.record_beats * self.bcl, stim_mag=2)
+        tr = budget.run(kci.generate_response, record, is_no_ion_selective=True)
+        n_beats += self.record_beats
+        budget.simulated_ms += n_beats * self.bcl
+        telemetry.count('simulated_ms', n_beats * self.bcl)
+        telemetry.count('beats', n_beats)
+        return tr
+
+
+def add_pacing_args(parser):
+    """Add the pacing options to an argparse parser."""
+    parser.add_argument('--adaptive-pacing', action='store_true',
+                        help='pace beat by beat until the limit cycle instead of 10 s')
+    parser.add_argument('--pacing-rtol', type=float, default=1e-3,
+                        help='relative beat-to-beat state change of the limit cycle')
+    parser.add_argument('--pacing-max-beats', type=int, default=10,
+                        help='maximum beats per condition with --adaptive-pacing')
+    parser.add_argument('--pacing-record-beats', type=int, default=5,
+                        help='beats of the final run the last AP is taken from')
+    parser.add_argument('--backend', default='python', choices=['python', 'numba'],
+                        help='Kernik right-hand side: cell_models (python) or the '
+                        'compiled port of kernik_jit.py (numba)')
+    parser.add_argument('--warm-start-radius', type=float, default=None,
+                        help='with --adaptive-pacing, start the control from the steady '
+                        'state of the nearest evaluated individual within this distance '
+                        '(log parameters)')
+    parser.add_argument('--warm-start-entries', type=int, default=10000,
+                        help='steady states kept per worker for --warm-start-radius')
+
+
+def make_pacing(args):
+    """Create the pacing selected by the add_pacing_args options."""
+    if args.adaptive_pacing:
+        return AdaptivePacing(rtol=args.pacing_rtol, max_beats=args.pacing_max_beats,
+                              record_beats=args.pacing_record_beats, backend=args.backend,
+                              warm_start_radius=args.warm_start_radius,
+                              warm_start_entries=args.warm_start_entries)
+    if args.warm_start_radius is not None:
+        print('--warm-start-radius needs --adaptive-pacing, ignored.')
+    return FixedPacing(backend=args.backend)
+
+
+def init_model(ind, dc_ik1=1.0, nai=10.0, ki=130.0, backend='python'):
+    """ Create a KernikModel with the dynamic-clamp Ishihara IK1 leak and the
+    membrane parameters of the individual (see run_ind_dclamp for the layout),
+    wrapped in a JitKernikModel for backend 'numba'.
+    Returns (kci, ik1_leak) or None if the individual is out of range.
+    """
     # Create the model from the DEAP individual.
-    kci = KernikModel()
+    kci = telemetry.timed('model_init', KernikModel)
 
-   
     # Apply dynamic-clamp leak
     if (ind[0] >= 0.0 and ind[0] < 1.0):
         ik1_leak = dc_ik1 * ind[0]
@@ -36,7 +243,6 @@ def run_ind_dclamp(ind, dc_ik1=1.0, nai=10.0, ki=130.0):
         print('phi != [0:1)')
         return None
 
-   
     # Check bounds on ind
     for i in range(1, len(ind)):
         if (ind[i] < 0.0):
@@ -62,107 +268,136 @@ def run_ind_dclamp(ind, dc_ik1=1.0, nai=10.0, ki=130.0):
     kci.nai_millimolar = nai
     kci.ki_millimolar = ki
 
-    # Create 10s paced protocol
-    KERNIK_PROTOCOL = protocols.PacedProtocol(model_name="Kernik", stim_end=10000, stim_mag=2)
+    if (backend == 'numba'):
+        kci = JitKernikModel(kci)
+    return kci, ik1_leak
 
-    # Create AP_set dict
-    ap_set = {'cntrl': None,
-              '-0.15_ical': None,
-              '0.7_ical': None,
-              '-0.25_ikr': None,
-              '0.9_ikr': None,
-              '-0.9_ito': None,
-              '1.5_ito': None,
-              '10_iks': None,
-              '4_iks': None}
 
-    try:
-        # Run Ishihara IK1
-        tr_ishi = kci.generate_response(KERNIK_PROTOCOL, is_no_ion_selective=True)
-        y_ishi_final = kci.y_initial
-        tr_ishi.get_last_ap()
-        ap_set['cntrl'] = tr_ishi.last_ap
-        del tr_ishi
-   
-        # Run ICal -0.15
-        kci.y_initial = y_ishi_final
-        ical_leak = ind[0] * -0.15
-        kci._CellModel__no_ion_selective = {'I_K1_Ishi': ik1_leak, 'I_CaL': ical_leak}
-        tr_ical_decrease = kci.generate_response(KERNIK_PROTOCOL, is_no_ion_selective=True)
-        tr_ical_decrease.get_last_ap()
-        ap_set['-0.15_ical'] = tr_ical_decrease.last_ap
-        del tr_ical_decrease
-   
-        # Run ICal 0.7
-        kci.y_initial = y_ishi_final
-        ical_leak = ind[0] * 0.7
-        kci._CellModel__no_ion_selective = {'I_K1_Ishi': ik1_leak, 'I_CaL': ical_leak}
-        tr_ical_increase = kci.generate_response(KERNIK_PROTOCOL, is_no_ion_selective=True)
-        tr_ical_increase.get_last_ap()
-        ap_set['0.7_ical'] = tr_ical_increase.last_ap
-        del tr_ical_increase
-
-        # Run IKr -0.25
-        kci.y_initial = y_ishi_final
-        ikr_leak = ind[0] * -0.25
-        kci._CellModel__no_ion_selective = {'I_K1_Ishi': ik1_leak, 'I_Kr': ikr_leak}
-        tr_ikr_decrease = kci.generate_response(KERNIK_PROTOCOL, is_no_ion_selective=True)
-        tr_ikr_decrease.get_last_ap()
-        ap_set['-0.25_ikr'] = tr_ikr_decrease.last_ap
-        del tr_ikr_decrease
-
-        # Run IKr 0.9
-        kci.y_initial = y_ishi_final
-        ikr_leak = ind[0] * 0.9
-        kci._CellModel__no_ion_selective = {'I_K1_Ishi': ik1_leak, 'I_Kr': ikr_leak}
-        tr_ikr_increase = kci.generate_response(KERNIK_PROTOCOL, is_no_ion_selective=True)
-        tr_ikr_increase.get_last_ap()
-        ap_set['0.9_ikr'] = tr_ikr_increase.last_ap
-        del tr_ikr_increase
-
-        # Run Ito -0.9
-        kci.y_initial = y_ishi_final
-        ito_leak = ind[0] * -0.9
-        kci._CellModel__no_ion_selective = {'I_K1_Ishi': ik1_leak, 'I_To': ito_leak}
-        tr_ito_decrease = kci.generate_response(KERNIK_PROTOCOL, is_no_ion_selective=True)
-        tr_ito_decrease.get_last_ap()
-        ap_set['-0.9_ito'] = tr_ito_decrease.last_ap
-        del tr_ito_decrease
-
-        # Run Ito 1.5
-        kci.y_initial = y_ishi_final
-        ito_leak = ind[0] * 1.5
-        kci._CellModel__no_ion_selective = {'I_K1_Ishi': ik1_leak, 'I_To': ito_leak}
-        tr_ito_increase = kci.generate_response(KERNIK_PROTOCOL, is_no_ion_selective=True)
-        tr_ito_increase.get_last_ap()
-        ap_set['1.5_ito'] = tr_ito_increase.last_ap
-        del tr_ito_increase
-
-        # Run IKs 10
-        kci.y_initial = y_ishi_final
-        iks_leak = ind[0] * 10.0
-        kci._CellModel__no_ion_selective = {'I_K1_Ishi': ik1_leak, 'I_Ks': iks_leak}
-        tr_iks_10 = kci.generate_response(KERNIK_PROTOCOL, is_no_ion_selective=True)
-        tr_iks_10.get_last_ap()
-        ap_set['10_iks'] = tr_iks_10.last_ap
-        del tr_iks_10
-
-        # Run IKs 4
-        kci.y_initial = y_ishi_final
-        iks_leak = ind[0] * 4.0
-        kci._CellModel__no_ion_selective = {'I_K1_Ishi': ik1_leak, 'I_Ks': iks_leak}
-        tr_iks_4 = kci.generate_response(KERNIK_PROTOCOL, is_no_ion_selective=True)
-        tr_iks_4.get_last_ap()
-        ap_set['4_iks'] = tr_iks_4.last_ap
-        del tr_iks_4
-
-        # Check if APs were generated
-        for i in ap_set.keys():
-            if ((max(ap_set[i].t)-min(ap_set[i].t)) < 800.0):
-                ap_failure = True
+@telemetry.evaluation('run_ind_dclamp')
+def run_ind_dclamp(ind, dc_ik1=1.0, nai=10.0, ki=130.0, budget=None, pacing=None):
+    """ Create model from individual DEAP object.
+    The optimized parameters are limited to the membrane conductances/fluxes.
+    There is an additional parameter: phi for leak on the dynamic clamp.
+     ind[0] = phi [0:1)
+     ind[1]  =  'G_K1'
+     ind[2]  =  'G_Kr'
+     ind[3]  =  'G_Ks'
+     ind[4]  =  'G_to'
+     ind[5]  =  'P_CaL'
+     ind[6]  =  'G_CaT'
+     ind[7]  =  'G_Na'
+     ind[8]  =  'G_F'
+     ind[9]  =  'K_NaCa'
+     ind[10] = 'P_NaK'
+     ind[11] = 'G_b_Na'
+     ind[12] = 'G_b_Ca'
+     ind[13] = 'G_PCa'
+    A TimeBudget limits the wall-clock time of the simulations, when it
+    runs out SimulationTimeout is raised to the caller. pacing runs each
+    condition (FixedPacing, the 10 s protocol, by default) and selects the
+    backend (FixedPacing(backend='numba') for the compiled model).
+    """
+    result = run_ind_conditions(ind, dc_ik1=dc_ik1, nai=nai, ki=ki, budget=budget,
+                                pacing=pacing)
+    if result is None:
+        return None
+    ap_set, y_ishi_final, ap_failure = result
+    return ap_set, ap_failure
+
+
+def run_condition(kci, ind, ik1_leak, condition, budget, pacing):
+    """ Pace kci under one Condition from its current state.
+    Returns the last AP of the trace."""
+    telemetry.set_condition(condition.key)
+    leak = {'I_K1_Ishi': ik1_leak}
+    if condition.current is not None:
+        leak[condition.current] = ind[0] * condition.scale
+    kci._CellModel__no_ion_selective = leak
+    tr = pacing.run(kci, budget)
+    telemetry.timed('get_last_ap', tr.get_last_ap)
+    return tr.last_ap
+
+
+def ap_failed(last_ap):
+    """True if the last AP is shorter than MIN_AP_DURATION."""
+    return (max(last_ap.t)-min(last_ap.t)) < MIN_AP_DURATION
+
+
+def run_ind_conditions(ind, keys=None, y_initial=None, dc_ik1=1.0, nai=10.0, ki=130.0,
+                       budget=None, pacing=None):
+    """ Run the conditions of CONDITIONS named in keys (default all) in the
+    order of the table. The control is run first to reach the steady state
+    the perturbations start from, unless that state is given as y_initial.
+    The run stops at the first AP Failure. With a warm start pacing the
+    control starts from the nearest cached steady state and its final
+    state is cached.
+    Returns (ap_set, y_ishi_final, ap_failure) with the last AP of each
+    condition that was run, or None if the individual is out of range.
+    SimulationTimeout is raised when the TimeBudget runs out.
+    """
+    if pacing is None:
+        pacing = FixedPacing()
+    model = init_model(ind, dc_ik1=dc_ik1, nai=nai, ki=ki, backend=pacing.backend)
+    if model is None:
+        return None
+    kci, ik1_leak = model
+    if budget is None:
+        budget = TimeBudget()
+    if keys is None:
+        keys = CONDITION_KEYS
+    steady_states = pacing.steady_states()
 
+    ap_set = {}
+    try:
+        if y_initial is None:
+            if steady_states is not None:
+                y_warm = steady_states.get(ind, dc_ik1)
+                if y_warm is not None:
+                    kci.y_initial = y_warm
+                    telemetry.count('warm_starts', 1)
+            ap_set['cntrl'] = run_condition(kci, ind, ik1_leak, CONDITIONS[0], budget, pacing)
+            y_initial = kci.y_initial
+            if ap_failed(ap_set['cntrl']):
+                return ap_set, y_initial, True
+            if steady_states is not None:
+                steady_states.put(ind, dc_ik1, y_initial)
+        for condition in CONDITIONS[1:]:
+            if condition.key in keys:
+                kci.y_initial = y_initial
+                ap_set[condition.key] = run_condition(kci, ind, ik1_leak, condition,
+                                                      budget, pacing)
+                if ap_failed(ap_set[condition.key]):
+                    return ap_set, y_initial, True
     except (OverflowError, IndexError):
-        ap_failure = True
-        ap_set = {}
-       
-    return ap_set, ap_failure
+        return {}, None, True
+
+    return ap_set, y_initial, False
+
+
+def run_ind_cntrl(ind, dc_ik1=1.0, nai=10.0, ki=130.0, budget=None, pacing=None):
+    """ Run only the control (Ishihara IK1) pacing of an individual.
+    Returns (last_ap, y_ishi_final, ap_failure). The final state y_ishi_final
+    is the starting point of every perturbation in run_ind_perturbation.
+    SimulationTimeout is raised when the TimeBudget runs out.
+    """
+    result = run_ind_conditions(ind, keys=['cntrl'], dc_ik1=dc_ik1, nai=nai, ki=ki,
+                                budget=budget, pacing=pacing)
+    if result is None:
+        return None, None, True
+    ap_set, y_ishi_final, ap_failure = result
+    return ap_set.get('cntrl'), y_ishi_final, ap_failure
+
+
+def run_ind_perturbation(ind, key, y_initial, dc_ik1=1.0, nai=10.0, ki=130.0,
+                         budget=None, pacing=None):
+    """ Run a single dynamic-clamp perturbation (a key of PERTURBATIONS)
+    starting from the control steady state y_initial.
+    Returns (last_ap, ap_failure).
+    SimulationTimeout is raised when the TimeBudget runs out.
+    """
+    result = run_ind_conditions(ind, keys=[key], y_initial=y_initial, dc_ik1=dc_ik1,
+                                nai=nai, ki=ki, budget=budget, pacing=pacing)
+    if result is None:
+        return None, True
+    ap_set, y_ishi_final, ap_failure = result
+    return ap_set.get(key), ap_failure
@@ -0,0 +1,118 @@
+"""Initial populations seeded from the outputs of earlier runs.
+
+A seed file is a table of the 14 parameters written by write_outputs
+(pop_final_*.txt, hof_*.txt or island<i>_...). Its fitness and strategy
+are read from the files of the same run next to it: pop_fitness_* and
+pop_strategy_* for pop_final_*, hof_fitness_* for hof_* (the Hall of Fame
+has no strategy file, those individuals get new strategies as in
+generateES). The fitness only ranks the seeds, every seeded individual is
+evaluated again.
+"""
+import os
+import numpy as np
+import pandas as pd
+from scipy.stats import lognorm
+
+
+# Seed file prefix: (fitness file prefix, strategy file prefix).
+COMPANIONS = {'pop_final_': ('pop_fitness_', 'pop_strategy_'),
+              'hof_': ('hof_fitness_', None)}
+
+
+def companion(filename, kind):
+    """Path of the fitness (kind 0) or strategy (kind 1) file of a seed
+    file, or None."""
+    directory, name = os.path.split(filename)
+    for prefix, files in COMPANIONS.items():
+        i = name.find(prefix)
+        if (i >= 0 and files[kind] is not None):
+            path = os.path.join(directory, name[:i] + files[kind] + name[i+len(prefix):])
+            if os.path.exists(path):
+                return path
+    return None
+
+
+def read_seeds(filename, param_names):
+    """Returns (params, fitness, strategy) arrays of a seed file. The
+    fitness is NaN and the strategy None where the files are missing."""
+    params = pd.read_csv(filename, delimiter=' ')[param_names].to_numpy(dtype=np.float64)
+    fitness = np.full(len(params), np.nan)
+    strategy = None
+    fitness_file = companion(filename, 0)
+    if fitness_file is not None:
+        fitness = pd.read_csv(fitness_file, delimiter=' ')['fitness'].to_numpy(dtype=np.float64)
+    strategy_file = companion(filename, 1)
+    if strategy_file is not None:
+        strategy = pd.read_csv(strategy_file, delimiter=' ')[param_names].to_numpy(
+            dtype=np.float64)
+    if (len(fitness) != len(params) or (strategy is not None and len(strategy) != len(params))):
+        print('Fitness or strategy file does not match '+filename+', ignored.')
+        fitness = np.full(len(params), np.nan)
+        strategy = None
+    return params, fitness, strategy
+
+
+def new_strategy(size):
+    """Strategy drawn as in generateES."""
+    return np.concatenate((np.random.uniform(low=0.0, high=1.0, size=1),
+                           lognorm.rvs(s=0.5, size=(size-1))))
+
+
+def seed_population(n, filenames, param_names, ind_clss, strategy_clss, generate,
+                    top_k=None, dedup_tol=1e-3, jitter=0.0, part=0, n_parts=1):
+    """Initial population of n individuals from the seed files.
+    The seeds of all files are ranked by fitness (unknown last), the ones
+    out of range (phi not in [0,1), a negative parameter) are dropped and
+    of the seeds within dedup_tol of each other in log-parameter space only
+    the best is kept. The top_k best (default n) are used, with jitter their
+    parameters are multiplied by log-normal numbers of shape jitter (phi is
+    shifted by jitter * N(0,1) and kept in [0,1)). The rest of the
+    population is filled with generate().
+    With n_parts populations (the islands of eaIslands) the ranked seeds
+    are dealt round-robin, population part gets the ranks part,
+    part+n_parts, ... so the populations start from different seeds of
+    the same quality. top_k is then per population."""
+    params, fitness, strategy = [], [], []
+    for filename in filenames:
+        p, f, s = read_seeds(filename, param_names)
+        if s is None:
+            s = np.array([new_strategy(len(param_names)) for i in range(len(p))])
+        params.append(p)
+        fitness.append(f)
+        strategy.append(s.reshape(len(p), len(param_names)))
+    params = np.concatenate(params)
+    fitness = np.concatenate(fitness)
+    strategy = np.concatenate(strategy)
+
+    valid = (params[:, 0] >= 0.0) & (params[:, 0] < 1.0) & np.all(params[:, 1:] >= 0.0, axis=1)
+    order = [i for i in np.argsort(np.where(np.isnan(fitness), np.inf, fitness), kind='stable')
+             if valid[i]]
+    if top_k is None:
+        top_k = n
+    keys = set()
+    seeds = []
+    for i in order:
+        if (len(seeds) >= min(top_k, n) * n_parts):
+            break
+        key = tuple(np.round(np.r_[params[i, 0], np.log(np.maximum(params[i, 1:], 1e-12))]
+                             / dedup_tol).astype(np.int64))
+        if key in keys:
+            continue
+        keys.add(key)
+        seeds.append(i)
+    seeds = seeds[part::n_parts]
+
+    pop = []
+    for i in seeds:
+        x = params[i].copy()
+        if (jitter > 0.0):
+            x[0] = np.clip(x[0] + jitter * np.random.standard_normal(), 0.0, np.nextafter(1.0, 0.0))
+            x[1:] *= np.exp(jitter * np.random.standard_normal(len(x) - 1))
+        ind = ind_clss(list(x))
+        ind.strategy = strategy_clss(list(strategy[i]))
+        pop.append(ind)
+    print('Seeded '+str(len(pop))+' of '+str(n)+' individuals from '+str(len(filenames))
+          + ' files ('+str(len(params))+' candidates).')
+    while (len(pop) < n):
+        pop.append(generate())
+    return pop
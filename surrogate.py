@@ -0,0 +1,133 @@
+import numpy as np
+from scipy.stats import spearmanr
+
+
+class SurrogateScreen:
+    """ Surrogate pre-screening of offspring before the full simulation.
+    A random-forest regressor of log(total RMSD) and a random-forest AP
+    Failure classifier are trained on the archive of really evaluated
+    individuals (14 parameters, phi linear and the conductances in log).
+    Each generation the over-generated offspring are ranked by predicted
+    fitness: the n_real - n_explore most promising and the n_explore most
+    uncertain (spread across trees) are simulated, the rest get the
+    predicted fitness (mode 'predict') or are discarded (mode 'discard').
+    Until min_train individuals have been evaluated everything is simulated.
+    The accuracy of the surrogate on each generation's real evaluations
+    (before they are added to the archive) is kept in history.
+    scikit-learn is needed for this stage only.
+    Attributes:
+      n_real: number of real evaluations per generation.
+      oversample: offspring generated per real evaluation slot (lambda*oversample).
+      failure_fitness: total fitness of an AP Failure (MAX_SCORE * number of APs).
+      history: list of accuracy dicts, one per generation.
+    """
+
+    def __init__(self, n_real, failure_fitness, oversample=1, explore_frac=0.2,
+                 mode='predict', min_train=50, n_trees=100):
+        try:
+            from sklearn.ensemble import RandomForestRegressor
+            from sklearn.ensemble import RandomForestClassifier
+        except ImportError:
+            raise ImportError('The surrogate stage needs scikit-learn (pip install scikit-learn).')
+        self.RandomForestRegressor = RandomForestRegressor
+        self.RandomForestClassifier = RandomForestClassifier
+        self.n_real = n_real
+        self.failure_fitness = failure_fitness
+        self.oversample = oversample
+        self.n_explore = int(round(explore_frac * n_real))
+        self.mode = mode
+        self.min_train = min_train
+        self.n_trees = n_trees
+        self.X = []
+        self.y = []
+        self.seed = None
+        self.regressor = None
+        self.classifier = None
+        self.history = []
+
+    def features(self, inds):
+        X = np.array([list(i) for i in inds], dtype=np.float64)
+        X[:, 1:] = np.log(np.maximum(X[:, 1:], 1e-12))
+        return X
+
+    def fit(self):
+        X = np.array(self.X)
+        y = np.array(self.y)
+        failed = y >= self.failure_fitness
+        self.regressor = None
+        self.classifier = None
+        if ((~failed).sum() >= 2):
+            self.regressor = self.RandomForestRegressor(self.n_trees, random_state=self.seed)
+            self.regressor.fit(X[~failed], np.log(y[~failed]))
+        if (failed.any() and (~failed).any()):
+            self.classifier = self.RandomForestClassifier(self.n_trees, random_state=self.seed)
+            self.classifier.fit(X, failed)
+
+    def predict(self, inds):
+        """Returns (predicted fitness, uncertainty, failure probability)."""
+        X = self.features(inds)
+        p_fail = np.zeros(len(X))
+        if self.classifier is not None:
+            p_fail = self.classifier.predict_proba(X)[:, 1]
+        if self.regressor is None:
+            fit = np.full(len(X), self.failure_fitness)
+            return fit, np.ones(len(X)), p_fail
+        per_tree = np.array([t.predict(X) for t in self.regressor.estimators_])
+        fit = np.exp(per_tree.mean(axis=0))
+        fit = np.where(p_fail > 0.5, self.failure_fitness, fit)
+        return fit, per_tree.std(axis=0), p_fail
+
+    def ready(self):
+        return (len(self.y) >= self.min_train and self.regressor is not None)
+
+    def screen(self, inds):
+        """Split individuals into (simulated, predicted)."""
+        if (not self.ready() or len(inds) <= self.n_real):
+            return list(inds), []
+        fit, spread, p_fail = self.predict(inds)
+        order = list(np.argsort(fit))
+        n_best = self.n_real - self.n_explore
+        chosen = order[:n_best]
+        rest = order[n_best:]
+        # The most uncertain of the rest explore the surrogate's blind spots.
+        rest.sort(key=lambda i: -spread[i])
+        chosen += rest[:self.n_explore]
+        chosen = set(chosen)
+        real = [inds[i] for i in range(len(inds)) if i in chosen]
+        predicted = [inds[i] for i in range(len(inds)) if i not in chosen]
+        for i in range(len(inds)):
+            if i not in chosen and self.mode == 'predict':
+                inds[i].fitness.values = (fit[i],)
+        return real, predicted
+
+    def update(self, inds, gen=None):
+        """Log the accuracy on the really evaluated individuals, add them to
+        the archive and refit."""
+        if (len(inds) == 0):
+            return
+        if self.ready():
+            fit, spread, p_fail = self.predict(inds)
+            y = np.array([i.fitness.values[0] for i in inds])
+            failed = y >= self.failure_fitness
+            record = {'gen': gen, 'n': len(inds),
+                      'failure_accuracy': float(np.mean((p_fail > 0.5) == failed))}
+            if ((~failed).sum() >= 2):
+                record['mae'] = float(np.mean(np.abs(fit[~failed] - y[~failed])))
+                record['spearman'] = float(spearmanr(fit[~failed], y[~failed])[0])
+            self.history.append(record)
+            print('Surrogate: '+str(record))
+        self.X += [list(x) for x in self.features(inds)]
+        self.y += [i.fitness.values[0] for i in inds]
+        self.seed = np.random.randint(2**31 - 1)
+        self.fit()
+
+    def get_state(self):
+        return {'X': self.X, 'y': self.y, 'seed': self.seed, 'history': self.history}
+
+    def set_state(self, state):
+        self.X = state['X']
+        self.y = state['y']
+        self.seed = state['seed']
+        self.history = state['history']
+        if self.y:
+            self.fit()
@@ -0,0 +1,339 @@
+"""Opt-in timing telemetry of the evaluations.
+
+Enabled by enable(filename) in the driver (or the DCLAMP_TELEMETRY
+environment variable, which the pool and local broker workers inherit).
+Every process appends JSON lines to the same file:
+  {"event": "evaluation", "kind", "pid", "start", "wall", "stages",
+   "conditions", "payload_bytes", "rss_mb", "max_rss_mb", "status"}
+one per call of an @evaluation function, with the seconds spent in each
+stage (model_init, generate_response, get_last_ap, score) and counters
+(simulated_ms) in total and per dynamic-clamp condition, and the pickled
+size of the result sent back to the driver. TelemetryMap adds a
+"generation" summary per toolbox.map call.
+Disabled, the hooks are a global check and a direct call.
+Broker workers on other machines only write records if the file is on a
+shared file system.
+"""
+import os
+import sys
+import json
+import time
+import pickle
+import threading
+import functools
+import numpy as np
+
+
+ENV_VAR = 'DCLAMP_TELEMETRY'
+
+_filename = os.environ.get(ENV_VAR)
+_file = None
+_pid = None
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def enable(filename):
+    """Turn telemetry on in this process and in the workers it starts."""
+    global _filename
+    _filename = os.path.abspath(filename)
+    os.environ[ENV_VAR] = _filename
+
+
+def enabled():
+    return _filename is not None
+
+
+def write(record):
+    """Append a record as one JSON line (a single write, so lines from
+    different processes are not interleaved)."""
+    global _file, _pid
+    line = json.dumps(record, default=float) + '\n'
+    with _write_lock:
+        if _file is None or _pid != os.getpid():
+            _file = open(_filename, 'a')
+            _pid = os.getpid()
+        _file.write(line)
+        _file.flush()
+
+
+def rss_mb():
+    """Returns (current, peak) resident set size of the process in MB."""
+    peak = None
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        if (sys.platform == 'darwin'):
+            peak /= 1024.0
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2.0**20
+    except (OSError, ValueError):
+        current = peak
+    return current, peak
+
+
+def evaluation(kind):
+    """Decorator of a worker entry point (fitness, run_ind_dclamp...).
+    Writes one evaluation record per outermost call, nested instrumented
+    calls are counted in the outer record."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if (_filename is None or getattr(_local, 'record', None) is not None):
+                return func(*args, **kwargs)
+            record = {'event': 'evaluation', 'kind': kind, 'pid': os.getpid(),
+                      'start': time.time(), 'stages': {}, 'conditions': {}}
+            _local.record = record
+            _local.condition = None
+            t0 = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+                record['wall'] = time.perf_counter() - t0
+                record['payload_bytes'] = len(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+                # The fitness functions return the status with other fields,
+                # e.g. (total, status, simulated_s).
+                if isinstance(result, tuple):
+                    status = [r for r in result if isinstance(r, str)]
+                    if status:
+                        record['status'] = status[0]
+                return result
+            except BaseException as e:
+                record['wall'] = time.perf_counter() - t0
+                record['status'] = type(e).__name__
+                raise
+            finally:
+                _local.record = None
+                record['rss_mb'], record['max_rss_mb'] = rss_mb()
+                write(record)
+        return wrapper
+    return decorator
+
+
+def set_condition(key):
+    """Label the following stages of the current evaluation with a
+    dynamic-clamp condition."""
+    if _filename is not None:
+        _local.condition = key
+
+
+def _add(record, name, condition, dt):
+    record['stages'][name] = record['stages'].get(name, 0.0) + dt
+    if condition is not None:
+        stages = record['conditions'].setdefault(condition, {})
+        stages[name] = stages.get(name, 0.0) + dt
+
+
+def timed(name, func, *args, **kwargs):
+    """Call func and add its wall time to the stage name of the current
+    evaluation."""
+    record = getattr(_local, 'record', None) if _filename is not None else None
+    if record is None:
+        return func(*args, **kwargs)
+    t0 = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _add(record, name, _local.condition, time.perf_counter() - t0)
+
+
+def count(name, value):
+    """Add value to the counter name of the current evaluation (e.g. the
+    simulated ms), in total and for the current condition."""
+    record = getattr(_local, 'record', None) if _filename is not None else None
+    if record is None:
+        return
+    counters = record.setdefault('counters', {})
+    counters[name] = counters.get(name, 0.0) + value
+    if _local.condition is not None:
+        stages = record['conditions'].setdefault(_local.condition, {})
+        stages[name] = stages.get(name, 0.0) + value
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, record, name, condition):
+        self.record = record
+        self.name = name
+        self.condition = condition
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _add(self.record, self.name, self.condition, time.perf_counter() - self.t0)
+        return False
+
+
+def stage(name, condition=None):
+    """Context manager form of timed() for a block of code. The block is
+    counted under condition, or the current condition if None."""
+    record = getattr(_local, 'record', None) if _filename is not None else None
+    if record is None:
+        return _NULL_STAGE
+    if condition is None:
+        condition = _local.condition
+    return _Stage(record, name, condition)
+
+
+def read_records(filename, offset=0):
+    """Returns (records, new offset) of the complete lines after offset."""
+    records = []
+    if not os.path.exists(filename):
+        return records, offset
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    for line in data[:end].splitlines():
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            pass
+    return records, offset + end
+
+
+def percentiles(values):
+    values = np.asarray(values, dtype=np.float64)
+    if (len(values) == 0):
+        return None
+    return {'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)),
+            'max': float(values.max())}
+
+
+def summarize(evaluations, wall, n_workers):
+    """Summary of the evaluation records of one window of wall seconds:
+    p50/p95/max of the evaluation and stage times, the payload and RSS,
+    evaluations/s and the worker utilisation (busy time / (wall*workers))."""
+    busy = sum(e.get('wall', 0.0) for e in evaluations)
+    summary = {'nevals': len(evaluations), 'wall': wall,
+               'evals_per_s': len(evaluations) / wall if wall > 0 else None,
+               'utilisation': busy / (wall * n_workers) if wall > 0 else None,
+               'eval': percentiles([e.get('wall', 0.0) for e in evaluations]),
+               'payload_bytes': percentiles([e.get('payload_bytes', 0) for e in evaluations]),
+               'max_rss_mb': max([e.get('max_rss_mb') or 0.0 for e in evaluations], default=None),
+               'status': {}, 'stages': {}}
+    for e in evaluations:
+        status = e.get('status', 'ok')
+        summary['status'][status] = summary['status'].get(status, 0) + 1
+    names = set(n for e in evaluations for n in e['stages'])
+    for name in sorted(names):
+        summary['stages'][name] = percentiles([e['stages'].get(name, 0.0) for e in evaluations])
+    names = set(n for e in evaluations for n in e.get('counters', {}))
+    if names:
+        summary['counters'] = {}
+    for name in sorted(names):
+        summary['counters'][name] = percentiles([e.get('counters', {}).get(name, 0.0)
+                                                 for e in evaluations])
+    return summary
+
+
+class TelemetryMap:
+    """Wrapper of toolbox.map that writes a "generation" summary of the
+    evaluation records written during each call and prints a short line.
+    get_state/set_state and the status counts are passed on to the wrapped
+    map.
+    Attributes:
+      gen: generation of the next call.
+      n_workers: number of workers for the utilisation.
+    """
+
+    def __init__(self, map_func, n_workers, gen=0):
+        self.map_func = map_func
+        self.n_workers = n_workers
+        self.gen = gen
+        self.offset = os.path.getsize(_filename) if os.path.exists(_filename) else 0
+
+    def __call__(self, func, inds):
+        t0 = time.time()
+        results = self.map_func(func, inds)
+        wall = time.time() - t0
+        records, self.offset = read_records(_filename, self.offset)
+        evaluations = [r for r in records if r.get('event') == 'evaluation']
+        summary = summarize(evaluations, wall, self.n_workers)
+        write(dict(event='generation', gen=self.gen, **summary))
+        print(format_summary(self.gen, summary))
+        self.gen += 1
+        return results
+
+    @property
+    def counts(self):
+        return getattr(self.map_func, 'counts', [])
+
+    def get_state(self):
+        if hasattr(self.map_func, 'get_state'):
+            return self.map_func.get_state()
+        return None
+
+    def set_state(self, state):
+        if hasattr(self.map_func, 'set_state'):
+            self.map_func.set_state(state)
+
+
+def format_summary(gen, summary):
+    line = 'Telemetry gen '+str(gen)+': '+str(summary['nevals'])+' evals'
+    if summary['evals_per_s'] is not None:
+        line += ', %.2f evals/s, utilisation %.0f%%' % (summary['evals_per_s'],
+                                                        100.0 * summary['utilisation'])
+    if summary['eval'] is not None:
+        line += ', eval p50 %.2fs p95 %.2fs max %.2fs' % (summary['eval']['p50'],
+                                                          summary['eval']['p95'],
+                                                          summary['eval']['max'])
+    if ('simulated_ms' in summary.get('counters', {})):
+        line += ', simulated p50 %.1fs' % (summary['counters']['simulated_ms']['p50'] / 1000.0)
+    return line
+
+
+def write_run_summary(offset, wall, n_workers):
+    """Write and print the "run" summary of the evaluation records written
+    after offset (telemetry.read_records(filename)[1] at the start)."""
+    records = read_records(_filename, offset)[0]
+    evaluations = [r for r in records if r.get('event') == 'evaluation']
+    summary = summarize(evaluations, wall, n_workers)
+    write(dict(event='run', **summary))
+    print(format_summary('all', summary))
+    return summary
+
+
+def summarize_file(filename, n_workers=1):
+    """Per-generation table of a telemetry file (python telemetry.py FILE)."""
+    records, offset = read_records(filename)
+    rows = []
+    for r in records:
+        if (r.get('event') == 'generation'):
+            row = {'gen': r['gen'], 'nevals': r['nevals'], 'wall': r['wall'],
+                   'evals_per_s': r['evals_per_s'], 'utilisation': r['utilisation']}
+            for name, p in list(r['stages'].items()) + list(r.get('counters', {}).items()):
+                row[name+'_p50'] = p['p50']
+                row[name+'_p95'] = p['p95']
+            rows.append(row)
+    if (len(rows) == 0):
+        evaluations = [r for r in records if r.get('event') == 'evaluation']
+        if evaluations:
+            wall = max(e['start'] + e['wall'] for e in evaluations) - \
+                min(e['start'] for e in evaluations)
+            print(json.dumps(summarize(evaluations, wall, n_workers), indent=1))
+        return
+    import pandas as pd
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) == 2):
+        summarize_file(sys.argv[1])
+    else:
+        print('telemetry.py telemetry.jsonl')
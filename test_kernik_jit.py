@@ -0,0 +1,23 @@
+"""The compiled Kernik backend against the Python model.
+
+  python -m pytest test_kernik_jit.py
+"""
+import pytest
+
+pytest.importorskip('numba')
+
+from kernik_jit import V_RMSE_TOL
+from kernik_jit import compare_aps
+from run_dclamp_simulation import FixedPacing
+from run_dclamp_simulation import run_ind_cntrl
+
+BASELINE = [0.5] + [1.0] * 13
+
+
+def test_baseline_last_ap():
+    last_ap, y_python, failure = run_ind_cntrl(BASELINE, pacing=FixedPacing(backend='python'))
+    last_ap_jit, y_jit, failure_jit = run_ind_cntrl(BASELINE,
+                                                    pacing=FixedPacing(backend='numba'))
+    assert not failure
+    assert not failure_jit
+    assert compare_aps(last_ap, last_ap_jit)['V'] <= V_RMSE_TOL
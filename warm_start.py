@@ -0,0 +1,95 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from es_array import log_params
+
+
+def features(ind, dc_ik1=1.0):
+    """Point of an individual in the space of the nearest-neighbour search:
+    the dynamic-clamp leak dc_ik1*phi and the log of the other parameters."""
+    x = log_params(ind)
+    x[0] = dc_ik1 * x[0]
+    return x
+
+
+class SteadyStateCache:
+    """ In-memory cache of the control steady states of evaluated
+    individuals, to start the control pacing of a new individual from the
+    state of its nearest evaluated neighbour.
+    The states are kept in arrays of at most max_entries rows, the least
+    recently used row is overwritten once the cache is full. The neighbour
+    is found with a cKDTree of the features (rebuilt after a put) and is
+    only used within radius, otherwise get returns None and the model
+    starts from its default y_initial. Nai and Ki are pinned by the model,
+    so the states are valid for any nai and ki.
+    Attributes:
+      max_entries: maximum number of stored states.
+      radius: maximum Euclidean distance of the features of a neighbour.
+      hits, misses: counts of the get calls.
+    """
+
+    def __init__(self, max_entries=10000, radius=1.0):
+        self.max_entries = max_entries
+        self.radius = radius
+        self.keys = None
+        self.states = None
+        self.last_used = np.zeros(max_entries, dtype=np.int64)
+        self.n = 0
+        self.clock = 0
+        self.tree = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return self.n
+
+    def get(self, ind, dc_ik1=1.0):
+        """Steady state of the nearest stored individual within radius, or None."""
+        if (self.n == 0):
+            self.misses += 1
+            return None
+        if self.tree is None:
+            self.tree = cKDTree(self.keys[:self.n])
+        dist, i = self.tree.query(features(ind, dc_ik1), distance_upper_bound=self.radius)
+        if not np.isfinite(dist):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.clock += 1
+        self.last_used[i] = self.clock
+        return self.states[i].copy()
+
+    def put(self, ind, dc_ik1, state):
+        """Store the control steady state of an individual, states that are
+        not finite are ignored."""
+        state = np.array(state, dtype=np.float64)
+        if not np.all(np.isfinite(state)):
+            return
+        if self.keys is None:
+            self.keys = np.empty((self.max_entries, len(ind)))
+            self.states = np.empty((self.max_entries, len(state)))
+        if (self.n < self.max_entries):
+            i = self.n
+            self.n += 1
+        else:
+            i = np.argmin(self.last_used)
+        self.keys[i] = features(ind, dc_ik1)
+        self.states[i] = state
+        self.clock += 1
+        self.last_used[i] = self.clock
+        self.tree = None
+
+    def stats(self):
+        return {'entries': self.n, 'hits': self.hits, 'misses': self.misses}
+
+
+# Caches of this process, keyed by (max_entries, radius).
+_PROCESS_CACHES = {}
+
+
+def process_cache(max_entries, radius):
+    """Returns the SteadyStateCache of this process (each pool worker
+    keeps its own) for the given size and radius."""
+    key = (max_entries, radius)
+    if key not in _PROCESS_CACHES:
+        _PROCESS_CACHES[key] = SteadyStateCache(max_entries, radius)
+    return _PROCESS_CACHES[key]
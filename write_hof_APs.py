@@ -1,36 +1,220 @@
 import sys
 import os
+import time
+import queue
+import argparse
 import numpy as np
 import pandas as pd
-from multiprocessing import Pool
 
 from run_dclamp_simulation import run_ind_dclamp
+from run_dclamp_simulation import add_pacing_args
+from run_dclamp_simulation import make_pacing
 from cell_recording import ExperimentalAPSet
+from cell_recording import init_worker
+from executors import add_executor_args
+from executors import make_executor
+from ap_store import APTraceStore
+from ap_store import TraceCollector
+import telemetry
+
+
+@telemetry.evaluation('simulate_and_score')
+def simulate_and_score(ind, model_id, ExperAPSet, nai=10.0, ki=130.0, traces='scored',
+                       collect=False, step=1, dtype=np.float64, pacing=None):
+    """Worker side of --worker-scoring: simulate one model and score it
+    in the worker. Returns (scores, traces) where traces is a TraceCollector
+    of the scored APs (and the simulated APs with traces='all') if collect,
+    otherwise None and the scored APs are written to text files by the
+    worker. traces='none' writes no traces at all."""
+    model_APSet = run_ind_dclamp(ind, dc_ik1=ExperAPSet.dc_ik1, nai=nai, ki=ki,
+                                 pacing=pacing)
+    collector = None
+    if collect:
+        collector = TraceCollector(step=step, dtype=dtype)
+        if (traces == 'all' and model_APSet is not None and not model_APSet[1]):
+            for key, last_ap in model_APSet[0].items():
+                collector.write(model_id, key, last_ap, list(last_ap.columns),
+                                kind='simulated')
+    scores = ExperAPSet.score(model_APSet, model_id, write_data=(traces != 'none'),
+                              store=collector)
+    return scores, collector
+
+
+def read_streamed_ids(filename, columns):
+    """Model ids already written to a streamed .scrs file. A last row left
+    incomplete by a crash is cut off. Returns None if the file is not a
+    streamed file with these columns."""
+    if (not os.path.exists(filename) or os.path.getsize(filename) == 0):
+        return set()
+    with open(filename) as f:
+        lines = f.readlines()
+    if (lines[0].split() != columns):
+        return None
+    done = set()
+    size = len(lines[0])
+    for line in lines[1:]:
+        if (not line.endswith('\n') or len(line.split()) != len(columns)):
+            break
+        done.add(int(line.split()[0]))
+        size += len(line)
+    if (size < os.path.getsize(filename)):
+        with open(filename, 'r+') as f:
+            f.truncate(size)
+    return done
+
+
+def read_archive(filename, inds, keys):
+    """Simulated APs of the Hall of Fame individuals from the elite trace
+    archive of iPSC_DEAP_fit.py --elite-archive. Returns a list with the
+    model AP set (as returned by run_ind_dclamp) of every individual, or
+    None where the archive has no traces of it: the parameters stored for
+    its row (at float32 precision) differ or an AP is missing."""
+    archive = APTraceStore(filename, mode='r')
+    model_APSets = []
+    for i, ind in enumerate(inds):
+        params = archive.records(i, 'params', kind='params')
+        if (len(params) == 0 or
+                not np.allclose(archive.read(params[0]).to_numpy()[0], ind, rtol=1e-5)):
+            model_APSets.append(None)
+            continue
+        ap_set = {}
+        for key in keys:
+            records = archive.records(i, key, kind='simulated')
+            if (len(records) == 0):
+                break
+            ap_set[key] = archive.read(records[0]).astype(np.float64)
+        model_APSets.append((ap_set, False) if len(ap_set) == len(keys) else None)
+    archive.close()
+    return model_APSets
+
+
+def stream_scores(p, ExperAPSet, inds, fout_name, args, pacing, store=None,
+                  dtype=np.float64, in_flight=8, nai=10.0, ki=130.0):
+    """Simulate and score the models inds in the workers with at most
+    in_flight tasks running, and append the row of each model (model_id
+    first) to fout_name as soon as it completes. Models already in
+    fout_name are skipped, a model whose task raises is reported and left
+    out so a rerun retries it. A model that a crash left in store without
+    its row does not get its records written twice.
+    Returns the number of models written."""
+    columns = ['model_id'] + list(ExperAPSet.AP_set.keys())
+    done = read_streamed_ids(fout_name, columns)
+    if done is None:
+        print(fout_name+' is not a streamed scores file of this AP set.')
+        return 0
+    todo = [i for i in range(len(inds)) if i not in done]
+    # Models whose traces were written before the crash of an earlier run.
+    stored = set(store.model_ids()) if store is not None else set()
+    print('Models: '+str(len(todo))+' to simulate, '+str(len(done))+' already in '+fout_name)
+    fout = open(fout_name, 'a')
+    if (len(done) == 0 and fout.tell() == 0):
+        fout.write(' '.join(columns)+'\n')
+        fout.flush()
+
+    results = queue.Queue()
+
+    def submit(i):
+        task = (inds[i], i, ExperAPSet, nai, ki, args.traces, store is not None,
+                args.trace_step, dtype, pacing)
+        p.submit(simulate_and_score, task,
+                 callback=lambda result, i=i: results.put((i, result, None)),
+                 error_callback=lambda exc, i=i: results.put((i, None, exc)))
+
+    n_submitted = 0
+    n_finished = 0
+    n_written = 0
+    start = time.time()
+    report_every = max(1, len(todo) // 100)
+    while (n_finished < len(todo)):
+        while (n_submitted < len(todo) and n_submitted - n_finished < in_flight):
+            submit(todo[n_submitted])
+            n_submitted += 1
+        i, result, exc = results.get()
+        n_finished += 1
+        if exc is not None:
+            print('Model '+str(i)+' failed: '+repr(exc))
+        else:
+            scores, collector = result
+            # The traces go first, a row in the file means the model is complete.
+            if collector is not None:
+                collector.replay(store, skip_stored=i in stored)
+            row = [str(i)] + [str(float(scores.get(key, ExperAPSet.MAX_SCORE)))
+                              for key in columns[1:]]
+            fout.write(' '.join(row)+'\n')
+            fout.flush()
+            n_written += 1
+        if (n_finished % report_every == 0 or n_finished == len(todo)):
+            elapsed = time.time() - start
+            rate = n_finished / elapsed if elapsed > 0 else 0.0
+            eta = (len(todo) - n_finished) / rate if rate > 0 else 0.0
+            print('%d/%d models, %.2f models/s, ETA %.0f s' % (n_finished, len(todo), rate, eta))
+    fout.close()
+    return n_written
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(usage='write_hof_APs.py hof_file NUM_MODELS [options]')
+    parser.add_argument('hof_file')
+    parser.add_argument('NUM_MODELS', type=int)
+    parser.add_argument('--store', default=None,
+                        help='write the scored and simulated APs to this indexed '
+                        'trace file (ap_store.APTraceStore) instead of text files')
+    parser.add_argument('--telemetry', default=None,
+                        help='append per-simulation timings to this JSONL file')
+    parser.add_argument('--worker-scoring', action='store_true',
+                        help='load the AP set once per worker and score there, '
+                        'only the scores (and requested traces) come back')
+    parser.add_argument('--traces', default='scored', choices=['none', 'scored', 'all'],
+                        help='traces written with --worker-scoring (all: also the '
+                        'simulated APs, needs --store)')
+    parser.add_argument('--trace-step', type=int, default=1,
+                        help='keep every N-th point of the traces sent to --store')
+    parser.add_argument('--float32', action='store_true',
+                        help='send and store the traces as float32')
+    parser.add_argument('--stream', action='store_true',
+                        help='score in the workers and append each model to the '
+                        '.scrs file as it completes, models already in it are skipped')
+    parser.add_argument('--in-flight', type=int, default=None,
+                        help='tasks running at once with --stream (default 2 per worker)')
+    parser.add_argument('--from-archive', default=None,
+                        help='score the APs of this elite trace archive '
+                        '(iPSC_DEAP_fit.py --elite-archive), only the models '
+                        'missing from it are simulated')
+    add_pacing_args(parser)
+    add_executor_args(parser)
+    return parser.parse_args(argv)
 
 
 def main(argv):
-    if (len(argv) != 2):
+    if (len(argv) < 2):
         print('write_hof_APs.py hof_file NUM_MODELS')
         return
-    elif (os.path.exists(argv[0]) != True):
+    args = parse_args(argv)
+    if (os.path.exists(args.hof_file) != True):
         print('Cannot find hof_file.')
         print('write_hof_APs.py hof_file NUM_MODELS')
         return
     else:
         # Load Hall of Fame File
-        hof_filename = argv[0]
+        hof_filename = args.hof_file
         fout_prefix = hof_filename.split('.txt')[0]
         fout_suffix = '.scrs'
         hof = pd.read_csv(hof_filename, delimiter=' ')
         # Check number of requested Individuals
-        if (hof.shape[0] < int(argv[1])):
+        if (hof.shape[0] < args.NUM_MODELS):
             print('Too many individuals requested. Check inputs.')
             return
         if (hof.shape[1] != 14):
             print('Number of model paramters unequal to hof_file. Check inputs.')
             return
         
-        NUM_MODELS = int(argv[1])
+        NUM_MODELS = args.NUM_MODELS
+        if (args.traces == 'all' and args.store is None):
+            print('--traces all needs --store.')
+            return
+        if (args.from_archive is not None and (args.worker_scoring or args.stream)):
+            print('--from-archive cannot be combined with --worker-scoring or --stream.')
+            return
         
         # Load in experimental AP set
         # Cell 1 recorded 12/24/20 Ishihara dynamic-clamp 0.75 pA/pF
@@ -46,18 +230,74 @@ def main(argv):
         model_id = range(NUM_MODELS)
         for i in range(NUM_MODELS):
             inds.append(list(hof.iloc[i, :]))
-        tasks = [*zip(inds, dc_ik1, nai, ki)]
+        pacing = make_pacing(args)
+        tasks = [(inds[i], dc_ik1[i], nai[i], ki[i], None, pacing) for i in range(NUM_MODELS)]
+
+        if args.telemetry is not None:
+            telemetry.enable(args.telemetry)
+            telemetry_start = telemetry.read_records(args.telemetry)[1]
 
         # To speed things up with multi-threading
-        p = Pool()
+        if (args.worker_scoring or args.stream):
+            # Send a reference to the AP set instead of the traces.
+            cell_1.by_reference = True
+            p = make_executor(args, initializer=init_worker, initargs=(cell_1.spec(),))
+        else:
+            p = make_executor(args)
 
         # Run HoF simulations and get APs
-        hof_APs = p.starmap(run_ind_dclamp, iterable=tasks)
+        run_start = time.time()
+        dtype = np.float32 if args.float32 else np.float64
+        store = None
+        if args.store is not None:
+            store = APTraceStore(args.store, dtype=dtype)
+        n_workers = args.workers if args.workers is not None else os.cpu_count()
+        if args.stream:
+            in_flight = args.in_flight if args.in_flight is not None else 2 * n_workers
+            stream_scores(p, cell_1, inds, fout_prefix + fout_suffix, args, pacing,
+                          store, dtype, in_flight)
+            p.close()
+            if store is not None:
+                store.close()
+            if args.telemetry is not None:
+                telemetry.write_run_summary(telemetry_start, time.time() - run_start, n_workers)
+            return
+        if args.worker_scoring:
+            worker_tasks = [(inds[i], model_id[i], cell_1, nai[i], ki[i], args.traces,
+                             store is not None, args.trace_step, dtype, pacing)
+                            for i in range(NUM_MODELS)]
+            results = p.starmap(simulate_and_score, worker_tasks)
+            p.close()
+            hof_scores = []
+            for scores, collector in results:
+                hof_scores.append(scores)
+                if collector is not None:
+                    collector.replay(store)
+        else:
+            if args.from_archive is not None:
+                hof_APs = read_archive(args.from_archive, inds, list(cell_1.AP_set.keys()))
+                missing = [i for i in range(NUM_MODELS) if hof_APs[i] is None]
+                print('Elite trace archive: '+str(NUM_MODELS-len(missing))+' of '
+                      + str(NUM_MODELS)+' models, simulating '+str(len(missing)))
+                for i, model_APSet in zip(missing,
+                                          p.starmap(run_ind_dclamp, [tasks[i] for i in missing])):
+                    hof_APs[i] = model_APSet
+            else:
+                hof_APs = p.starmap(run_ind_dclamp, tasks)
+            p.close()
 
-        # Score AP_set against Cell 1
-        hof_scores = []
-        for i in range(len(hof_APs)):
-            hof_scores.append(cell_1.score(hof_APs[i], model_id[i], write_data=True))
+            # Score AP_set against Cell 1
+            if store is not None:
+                for i in range(len(hof_APs)):
+                    if (hof_APs[i] is not None and not hof_APs[i][1]):
+                        for key, last_ap in hof_APs[i][0].items():
+                            store.write(model_id[i], key, last_ap, list(last_ap.columns),
+                                        kind='simulated')
+            hof_scores = cell_1.score_many(hof_APs, model_id, write_data=True, store=store)
+        if store is not None:
+            store.close()
+        if args.telemetry is not None:
+            telemetry.write_run_summary(telemetry_start, time.time() - run_start, n_workers)
 
         # Order the dict: Format output file
         column_names = []